@@ -1,24 +1,56 @@
 import asyncio
+import heapq
 import logging
-from datetime import datetime, timedelta
-from typing import List
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
 
 from bot.database.connection import get_connection
-from bot.database.repository import CryptoPayInvoiceRepository, UserBalanceRepository
-from bot.crypto_pay_api import CryptoPayAPI
-from bot.config import Config
+from bot.database.models import CryptoPayInvoice
+from bot.database.repository import CryptoPayInvoiceRepository, OrderRepository
+from bot.crypto_pay_api import get_crypto_pay_api
+from bot.fulfillment import fulfillment_manager, parse_order_payload
+from bot.config import get_config
+from bot.send_queue import send_queue, PRIORITY_PAYMENT
 
 logger = logging.getLogger(__name__)
 
 
+# Adaptive polling: (max invoice age in seconds, delay between checks in seconds).
+# Fresh invoices are the ones most likely to be paid right now, old ones rarely are.
+POLL_SCHEDULE = [
+    (120, 5),      # first 2 minutes: every 5 seconds
+    (600, 15),     # up to 10 minutes: every 15 seconds
+    (1800, 60),    # up to 30 minutes: every minute
+]
+POLL_DELAY_MAX = 180  # older invoices: every 3 minutes
+
+# Seconds past expires_at before the sweep expires an invoice. The poller checks every
+# invoice at least once in this window, so a payment made just before expiry is seen.
+EXPIRY_GRACE = 2 * POLL_DELAY_MAX
+
+
 class BackgroundTaskManager:
     """Manager for background tasks"""
     
     def __init__(self, bot=None):
         self.running = False
-        self.check_interval = 60  # seconds - check every minute
-        self.config = None  # Will be initialized when needed
+        self.check_interval = 60  # seconds - rescan database for pending invoices every minute
+        self.webhook_check_interval = 300  # seconds - rescan interval when webhook is enabled
+        self.min_poll_delay = 0  # seconds - lower bound for per-invoice delay (raised in webhook mode)
+        self.invoice_batch_size = 100  # invoice ids per getInvoices request
         self.bot = bot  # Bot instance for sending notifications
+        
+        # In-memory schedule of pending invoices: heap of (next_check, invoice_id) plus
+        # invoice_id -> (next_check, invoice). Heap entries whose next_check no longer
+        # matches the tracked one are stale and skipped.
+        self._invoice_queue: List[Tuple[float, str]] = []
+        self._tracked_invoices: Dict[str, Tuple[float, CryptoPayInvoice]] = {}
+        self._wakeup = asyncio.Event()
+        
+        # Invoice checks and paid-invoice processing run as tasks bounded by a semaphore
+        self.invoice_semaphore = asyncio.Semaphore(10)
+        self._invoice_tasks: Set[asyncio.Task] = set()
     
     def set_bot(self, bot):
         """Set bot instance for notifications"""
@@ -26,10 +58,8 @@ class BackgroundTaskManager:
         logger.info("Bot instance set for background tasks")
     
     def _get_config(self):
-        """Get config instance, initialize if needed"""
-        if self.config is None:
-            self.config = Config()
-        return self.config
+        """Get current config snapshot"""
+        return get_config()
     
     async def start(self):
         """Start background tasks"""
@@ -40,6 +70,15 @@ class BackgroundTaskManager:
         self.running = True
         logger.info("Starting background tasks...")
         
+        config = self._get_config()
+        self.invoice_semaphore = asyncio.Semaphore(config.invoice_check_concurrency)
+        
+        # With webhooks delivering payments instantly, polling is only a safety net
+        if config.crypto_pay_webhook_enabled:
+            self.check_interval = self.webhook_check_interval
+            self.min_poll_delay = 60
+            logger.info(f"Crypto Pay webhook enabled, polling every {self.check_interval} seconds")
+        
         # Start invoice checking task
         asyncio.create_task(self.check_pending_invoices())
         
@@ -49,566 +88,297 @@ class BackgroundTaskManager:
     async def stop(self):
         """Stop background tasks"""
         self.running = False
+        self._wakeup.set()
         logger.info("Stopping background tasks...")
+        
+        # Let in-flight invoice processing finish so no payment is left half-done
+        if self._invoice_tasks:
+            await asyncio.gather(*self._invoice_tasks, return_exceptions=True)
+    
+    def _poll_delay(self, invoice: CryptoPayInvoice) -> float:
+        """Delay before next check of invoice, grows with invoice age"""
+        created_at = invoice.created_at or datetime.now(timezone.utc)
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        age = (datetime.now(timezone.utc) - created_at).total_seconds()
+        
+        delay = POLL_DELAY_MAX
+        for max_age, age_delay in POLL_SCHEDULE:
+            if age < max_age:
+                delay = age_delay
+                break
+        return max(delay, self.min_poll_delay)
+    
+    def schedule_invoice(self, invoice: CryptoPayInvoice, delay: Optional[float] = None):
+        """Add invoice to polling schedule (or move its next check)"""
+        if delay is None:
+            delay = self._poll_delay(invoice)
+        next_check = time.monotonic() + delay
+        self._tracked_invoices[invoice.invoice_id] = (next_check, invoice)
+        heapq.heappush(self._invoice_queue, (next_check, invoice.invoice_id))
+        self._wakeup.set()
+    
+    def _seconds_until_next_check(self) -> float:
+        """Seconds until earliest scheduled invoice check"""
+        while self._invoice_queue:
+            next_check, invoice_id = self._invoice_queue[0]
+            tracked = self._tracked_invoices.get(invoice_id)
+            if tracked and tracked[0] == next_check:
+                return next_check - time.monotonic()
+            heapq.heappop(self._invoice_queue)  # Stale entry
+        return float("inf")
+    
+    def _pop_due_invoices(self) -> List[CryptoPayInvoice]:
+        """Remove and return invoices whose check time has come"""
+        now = time.monotonic()
+        due = []
+        while self._invoice_queue and self._invoice_queue[0][0] <= now:
+            next_check, invoice_id = heapq.heappop(self._invoice_queue)
+            tracked = self._tracked_invoices.get(invoice_id)
+            if tracked and tracked[0] == next_check:
+                due.append(tracked[1])
+        return due
     
     async def check_pending_invoices(self):
-        """Check all pending invoices for payment status"""
+        """Check pending invoices for payment status on an adaptive schedule"""
         logger.info("Background task: check_pending_invoices started")
+        last_scan = None
         while self.running:
             try:
-                logger.debug("Background task: checking pending invoices...")
-                await self._check_pending_invoices_once()
-                logger.debug(f"Background task: waiting {self.check_interval} seconds before next check")
-                await asyncio.sleep(self.check_interval)
+                if last_scan is None or time.monotonic() - last_scan >= self.check_interval:
+                    last_scan = time.monotonic()
+                    await self._expire_stale_invoices()
+                    logger.debug("Background task: loading pending invoices...")
+                    await self._load_pending_invoices()
+                
+                due_invoices = self._pop_due_invoices()
+                if due_invoices:
+                    await self._check_invoices(due_invoices)
             except Exception as e:
                 logger.error(f"Error in check_pending_invoices task: {e}")
-                await asyncio.sleep(self.check_interval)
+            
+            # Sleep until the next invoice is due, the next database rescan or a new invoice
+            self._wakeup.clear()
+            timeout = min(self._seconds_until_next_check(),
+                          last_scan + self.check_interval - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0.5))
+            except asyncio.TimeoutError:
+                pass
     
-    async def _check_pending_invoices_once(self):
-        """Check pending invoices once"""
+    async def _expire_stale_invoices(self):
+        """Expire pending invoices past their expiry and grace period in one query, notify their users"""
         config = self._get_config()
-        logger.debug(f"Background task: config loaded, crypto_pay_token: {'configured' if config.crypto_pay_token else 'not configured'}")
+        if not config.crypto_pay_token:
+            return
         
+        invoice_repo = CryptoPayInvoiceRepository(config.database_url)
+        expired_invoices = await invoice_repo.expire_stale_invoices(EXPIRY_GRACE)
+        if not expired_invoices:
+            return
+        
+        logger.info(f"Expired {len(expired_invoices)} stale invoices")
+        for invoice in expired_invoices:
+            self._tracked_invoices.pop(invoice.invoice_id, None)
+            self._spawn_invoice_task(self._send_expiration_notification(invoice))
+    
+    async def _load_pending_invoices(self):
+        """Add pending invoices from database that are not scheduled yet.
+        
+        Picks up invoices created before a restart or by another bot process.
+        """
+        config = self._get_config()
         if not config.crypto_pay_token:
             logger.debug("Crypto Pay token not configured, skipping invoice check")
             return
         
-        logger.info(f"Background task: using Crypto Pay API with token: {config.crypto_pay_token[:10]}...")
-        logger.info(f"Background task: testnet mode: {config.crypto_pay_testnet}")
+        invoice_repo = CryptoPayInvoiceRepository(config.database_url)
+        pending_invoices = await invoice_repo.get_pending_invoices(EXPIRY_GRACE)
+        
+        new_count = 0
+        for invoice in pending_invoices:
+            if invoice.invoice_id not in self._tracked_invoices:
+                self.schedule_invoice(invoice, delay=0)
+                new_count += 1
+        
+        if new_count:
+            logger.info(f"Scheduled {new_count} pending invoices from database")
+    
+    async def _check_invoices(self, invoices: List[CryptoPayInvoice]):
+        """Fetch statuses of given invoices and start their checks as concurrent tasks.
+        
+        Does not wait for the checks: a slow fulfillment only holds its own semaphore slot,
+        the scheduler loop keeps picking up due invoices.
+        """
+        config = self._get_config()
+        if not config.crypto_pay_token:
+            return
         
         try:
-            logger.debug("Background task: getting database connection...")
-            # Get connection to database
-            pool = await get_connection(config.database_url)
-            invoice_repo = CryptoPayInvoiceRepository(pool)
-            balance_repo = UserBalanceRepository(pool)
-            
-            logger.debug("Background task: getting pending invoices...")
-            # Get all pending invoices
-            pending_invoices = await invoice_repo.get_pending_invoices()
+            logger.debug(f"Checking {len(invoices)} due invoices...")
             
-            if not pending_invoices:
-                logger.debug("No pending invoices to check")
-                return
+            # Shared Crypto Pay API client
+            crypto_api = get_crypto_pay_api(config.crypto_pay_token, config.crypto_pay_testnet)
             
-            logger.info(f"Checking {len(pending_invoices)} pending invoices...")
+            # Fetch statuses in batches: one getInvoices call per chunk, chunks in parallel
+            chunks = [invoices[i:i + self.invoice_batch_size]
+                      for i in range(0, len(invoices), self.invoice_batch_size)]
+            results = await asyncio.gather(*[
+                self._fetch_invoice_chunk(crypto_api, chunk) for chunk in chunks
+            ])
             
-            # Initialize Crypto Pay API
-            crypto_api = CryptoPayAPI(config.crypto_pay_token, config.crypto_pay_testnet)
+            invoice_data_by_id = {}
+            for items in results:
+                for item in items or []:
+                    invoice_data_by_id[str(item.get("invoice_id"))] = item
             
-            # Test API connection first
-            logger.info("Testing Crypto Pay API connection...")
-            me_info = await crypto_api.get_me()
-            if me_info:
-                logger.info(f"Crypto Pay API connection successful: {me_info}")
-            else:
-                logger.error("Crypto Pay API connection failed!")
-                return
-            
-            # Check each pending invoice
-            for invoice in pending_invoices:
-                try:
-                    await self._check_single_invoice(invoice, crypto_api, invoice_repo, balance_repo)
-                except Exception as e:
-                    logger.error(f"Error checking invoice {invoice.invoice_id}: {e}")
-                    continue
-                
-                # Small delay between API calls to avoid rate limiting
-                await asyncio.sleep(0.5)
-            
-            logger.info(f"Invoice check completed, processed {len(pending_invoices)} invoices")
+            for invoice in invoices:
+                invoice_data = invoice_data_by_id.get(str(invoice.invoice_id))
+                self._spawn_invoice_task(self._run_invoice_check(invoice, invoice_data))
             
         except Exception as e:
-            logger.error(f"Error in _check_pending_invoices_once: {e}")
+            logger.error(f"Error in _check_invoices: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
+            # Keep invoices scheduled so a transient failure does not drop them
+            for invoice in invoices:
+                self.schedule_invoice(invoice)
+    
+    async def _fetch_invoice_chunk(self, crypto_api, chunk: List[CryptoPayInvoice]):
+        """Get Crypto Pay data for one chunk of invoices"""
+        async with self.invoice_semaphore:
+            items = await crypto_api.get_invoices([invoice.invoice_id for invoice in chunk])
+        if items is None:
+            logger.warning(f"Could not get status for {len(chunk)} invoices, will retry")
+        return items
     
-    async def _check_single_invoice(self, invoice, crypto_api, invoice_repo, balance_repo):
-        """Check single invoice status and update if paid"""
+    def _spawn_invoice_task(self, coro):
+        """Run invoice coroutine as tracked background task"""
+        task = asyncio.create_task(coro)
+        self._invoice_tasks.add(task)
+        task.add_done_callback(self._invoice_tasks.discard)
+        return task
+    
+    async def _run_invoice_check(self, invoice: CryptoPayInvoice, invoice_data):
+        """Check one invoice under the concurrency limit and reschedule it if still pending"""
+        config = self._get_config()
+        invoice_repo = CryptoPayInvoiceRepository(config.database_url)
+        
+        still_pending = True
         try:
-            # Check if invoice is expired (3 minutes from creation)
-            from datetime import timezone
-            current_time = datetime.now(timezone.utc)
-            
-            # Make sure created_at is timezone-aware
-            created_at = invoice.created_at
-            if created_at.tzinfo is None:
-                created_at = created_at.replace(tzinfo=timezone.utc)
-            
-            # Set expiration to 3 minutes from creation
-            expiration_time = created_at + timedelta(minutes=3)
-            
-            if current_time > expiration_time and invoice.status not in ["expired", "paid"]:
-                logger.info(f"Invoice {invoice.invoice_id} expired, marking as expired")
-                await invoice_repo.update_invoice_status(invoice.invoice_id, "expired")
-                
-                # Send expiration notification to user
-                await self._send_expiration_notification(invoice)
-                return
-            
-            # Get current status from Crypto Pay API
-            invoice_data = await crypto_api.get_invoice(invoice.invoice_id)
+            async with self.invoice_semaphore:
+                still_pending = await self._check_single_invoice(invoice, invoice_data, invoice_repo)
+        except Exception as e:
+            # Errors stay with this invoice, other checks are not affected
+            logger.error(f"Error checking invoice {invoice.invoice_id}: {e}")
+        
+        if still_pending and self.running:
+            self.schedule_invoice(invoice)
+        else:
+            self._tracked_invoices.pop(invoice.invoice_id, None)
+    
+    async def _check_single_invoice(self, invoice, invoice_data, invoice_repo) -> bool:
+        """Check single invoice against its Crypto Pay data and update if paid.
+        
+        Returns True while the invoice is still pending and should be polled again.
+        """
+        try:
+            # Current status comes from the batched Crypto Pay lookup
             if not invoice_data:
                 logger.warning(f"Could not get status for invoice {invoice.invoice_id}")
-                return
+                return True
             
             status = invoice_data.get("status")
             logger.debug(f"Invoice {invoice.invoice_id} status: {status}")
             
             if status == "paid" and invoice.status != "paid":
-                logger.info(f"Invoice {invoice.invoice_id} paid, updating balance for user {invoice.user_id}")
-                
-                # Update invoice status with timezone-aware datetime
-                await invoice_repo.update_invoice_status(invoice.invoice_id, "paid", current_time)
-                
-                # Check if this is a subscription payment invoice
-                if invoice.payload and "premium_" in invoice.payload:
-                    # This is a subscription payment - create Fragment order
-                    await self._process_subscription_payment(invoice)
-                elif invoice.payload and "stars_" in invoice.payload:
-                    # This is a stars payment - create Fragment order
-                    await self._process_stars_payment(invoice)
-                else:
-                    # Regular balance top-up
-                    success = await balance_repo.add_to_balance(
-                        invoice.user_id, 
-                        invoice.amount_usd, 
-                        0  # No USDT balance for now
-                    )
-                    
-                    if success:
-                        logger.info(f"Successfully added ${invoice.amount_usd} to user {invoice.user_id} balance")
-                        
-                        # Send payment success notification to user
-                        await self._send_payment_success_notification(invoice, invoice.amount_usd)
-                    else:
-                        logger.error(f"Failed to add balance for user {invoice.user_id}")
+                await self._process_paid_invoice(invoice, invoice_repo)
+                return False
                 
             elif status in ["expired", "cancelled"] and invoice.status != status:
                 logger.info(f"Invoice {invoice.invoice_id} status changed to {status}")
-                await invoice_repo.update_invoice_status(invoice.invoice_id, status)
+                # Only the first of poller and expiry sweep to move it out of pending notifies
+                updated = await invoice_repo.update_invoice_status(invoice.invoice_id, status,
+                                                                   expected_status="pending")
                 
-                if status == "expired":
+                if updated and status == "expired":
                     # Send expiration notification to user
                     await self._send_expiration_notification(invoice)
-                
-        except Exception as e:
-            logger.error(f"Error checking single invoice {invoice.invoice_id}: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
-    
-    async def _process_subscription_payment(self, invoice):
-        """Process subscription payment - create Fragment order"""
-        try:
-            logger.info(f"Processing subscription payment for invoice {invoice.invoice_id}")
-            
-            # Parse payload: user_{user_id}_premium_{months}m_{username}
-            payload_parts = invoice.payload.split("_")
-            if len(payload_parts) >= 4:
-                user_id = int(payload_parts[1])
-                months = int(payload_parts[3].replace("m", ""))
-                username = payload_parts[4]
-                
-                logger.info(f"Creating Fragment order: {months} months for @{username}")
-                
-                # Get config and create Fragment API instance
-                config = self._get_config()
-                from bot.fragment_api import FragmentAPI
-                
-                fragment_api = FragmentAPI(
-                    token=config.token_fragment,
-                    demo_mode=not bool(config.token_fragment and config.token_fragment.strip())
-                )
-                
-                # Create Fragment order
-                order, error_info = await fragment_api.create_premium_order(username, months, show_sender=False)
-                
-                if order:
-                    logger.info(f"Fragment order created successfully: {order.id}")
-                    
-                    # Send success notification to user
-                    await self._send_subscription_success_notification(invoice, order, months, username)
-                    
-                    # Notify admins
-                    await self._notify_admins_subscription_created(invoice, order, months, username)
-                    
-                else:
-                    logger.error(f"Failed to create Fragment order: {error_info}")
-                    # Send error notification to user
-                    await self._send_subscription_error_notification(invoice, error_info, months, username)
-                    
-            else:
-                logger.error(f"Invalid payload format for subscription invoice: {invoice.payload}")
-                
-        except Exception as e:
-            logger.error(f"Error processing subscription payment: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
-    
-    async def _process_stars_payment(self, invoice):
-        """Process stars payment - create Fragment order"""
-        try:
-            logger.info(f"Processing stars payment for invoice {invoice.invoice_id}")
+                return False
             
-            # Parse payload: user_{user_id}_stars_{stars_count}_{username}
-            payload_parts = invoice.payload.split("_")
-            if len(payload_parts) >= 4:
-                user_id = int(payload_parts[1])
-                stars_count = int(payload_parts[3])
-                username = payload_parts[4]
-                
-                logger.info(f"Creating Fragment stars order: {stars_count} stars for @{username}")
-                
-                # Get config and create Fragment API instance
-                config = self._get_config()
-                from bot.fragment_api import FragmentAPI
-                
-                fragment_api = FragmentAPI(
-                    token=config.token_fragment,
-                    demo_mode=not bool(config.token_fragment and config.token_fragment.strip())
-                )
-                
-                # Create Fragment order
-                order, error_info = await fragment_api.create_stars_order(username, stars_count, show_sender=False)
-                
-                if order:
-                    logger.info(f"Fragment stars order created successfully: {order.id}")
-                    
-                    # Send success notification to user
-                    await self._send_stars_success_notification(invoice, order, stars_count, username)
-                    
-                    # Notify admins
-                    await self._notify_admins_stars_created(invoice, order, stars_count, username)
-                    
-                else:
-                    logger.error(f"Failed to create Fragment stars order: {error_info}")
-                    # Send error notification to user
-                    await self._send_stars_error_notification(invoice, error_info, stars_count, username)
-                    
-            else:
-                logger.error(f"Invalid payload format for stars invoice: {invoice.payload}")
+            return True
                 
         except Exception as e:
-            logger.error(f"Error processing stars payment: {e}")
+            logger.error(f"Error checking single invoice {invoice.invoice_id}: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
+            return True
     
-    async def _send_subscription_success_notification(self, invoice, order, months, username):
-        """Send subscription success notification to user"""
-        try:
-            if not self.bot:
-                logger.warning("Bot instance not available, cannot send notification")
-                return
-            
-            message_text = (
-                f"🎉 **Telegram Premium активирован!**\n\n"
-                f"✅ Подписка успешно создана\n"
-                f"📱 **Период:** {months} месяцев\n"
-                f"👤 **Для аккаунта:** @{username}\n"
-                f"💰 **Сумма:** ${invoice.amount_usd:.2f}\n"
-                f"🆔 **ID заказа:** {order.id}\n\n"
-                f"🎊 **Наслаждайтесь Premium возможностями!**\n\n"
-                f"💡 **Что дальше:**\n"
-                f"• Подписка активна в Telegram\n"
-                f"• Все Premium функции доступны\n"
-                f"• Срок действия: {months} месяцев"
-            )
-            
-            try:
-                # Try to send to user_id first, then try to get telegram_id from database
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    from bot.database.repository import get_connection
-                    from bot.database.connection import get_connection as get_db_connection
-                    
-                    try:
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Subscription success notification sent to user {invoice.user_id} (chat_id: {chat_id})")
-            except Exception as e:
-                logger.error(f"Failed to send subscription success notification to user {invoice.user_id}: {e}")
-                
-        except Exception as e:
-            logger.error(f"Error in subscription success notification: {e}")
-    
-    async def _send_subscription_error_notification(self, invoice, error_info, months, username):
-        """Send subscription error notification to user"""
-        try:
-            if not self.bot:
-                logger.warning("Bot instance not available, cannot send notification")
-                return
-            
-            message_text = (
-                f"❌ **Ошибка активации Premium!**\n\n"
-                f"💳 Платеж прошел успешно (${invoice.amount_usd:.2f})\n"
-                f"📱 **Период:** {months} месяцев\n"
-                f"👤 **Для аккаунта:** @{username}\n\n"
-                f"🚨 **Проблема:** Не удалось активировать подписку\n\n"
-                f"💡 **Что делать:**\n"
-                f"• Обратитесь в поддержку\n"
-                f"• Укажите ID счета: {invoice.invoice_id}\n"
-                f"• Деньги будут возвращены"
-            )
-            
-            try:
-                # Get config for database connection
-                config = self._get_config()
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    
-                    try:
-                        from bot.database.connection import get_connection as get_db_connection
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Subscription error notification sent to user {invoice.user_id} (chat_id: {chat_id})")
-            except Exception as e:
-                logger.error(f"Failed to send subscription error notification to user {invoice.user_id}: {e}")
-                
-        except Exception as e:
-            logger.error(f"Error in subscription error notification: {e}")
-    
-    async def _send_stars_success_notification(self, invoice, order, stars_count, username):
-        """Send stars success notification to user"""
-        try:
-            if not self.bot:
-                logger.warning("Bot instance not available, cannot send notification")
-                return
-            
-            message_text = (
-                f"🎉 **Telegram Stars отправлены!**\n\n"
-                f"✅ Stars успешно отправлены\n"
-                f"⭐ **Количество:** {stars_count} stars\n"
-                f"👤 **Для аккаунта:** @{username}\n"
-                f"💰 **Сумма:** ${invoice.amount_usd:.2f}\n"
-                f"🆔 **ID заказа:** {order.id}\n\n"
-                f"🎊 **Наслаждайтесь Stars!**\n\n"
-                f"💡 **Что дальше:**\n"
-                f"• Stars активны в Telegram\n"
-                f"• Все Stars функции доступны\n"
-                f"• Stars не имеют срока действия"
-            )
-            
-            try:
-                # Try to send to user_id first, then try to get telegram_id from database
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    
-                    try:
-                        from bot.database.connection import get_connection as get_db_connection
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"Stars success notification sent to user {invoice.user_id}")
-                
-            except Exception as e:
-                logger.error(f"Error sending stars success notification: {e}")
-                
-        except Exception as e:
-            logger.error(f"Error sending stars success notification: {e}")
-            import traceback
-            logger.error(f"Traceback: {traceback.format_exc()}")
+    async def _process_paid_invoice(self, invoice, invoice_repo):
+        """Credit balance or create Fragment order for a paid invoice.
+        
+        Shared by the poller and the Crypto Pay webhook. Marking the invoice paid and the
+        credit or order insert are one statement, so a payment reported by both is
+        processed once and a failure leaves the invoice pending to be retried.
+        """
+        order_request = parse_order_payload(invoice.payload)
+        if order_request:
+            # Premium or Stars paid directly - queue the order for fulfillment
+            await self._queue_invoice_order(invoice, *order_request)
+            return
+        
+        # Regular balance top-up
+        new_balance = await invoice_repo.credit_paid_invoice(invoice.invoice_id)
+        if new_balance is None:
+            logger.info(f"Invoice {invoice.invoice_id} already processed, skipping")
+            return
+        
+        logger.info(f"Invoice {invoice.invoice_id} paid, added ${invoice.amount_usd} to user {invoice.user_id} balance")
+        
+        # Send payment success notification to user
+        await self._send_payment_success_notification(invoice, invoice.amount_usd, new_balance)
     
-    async def _send_stars_error_notification(self, invoice, error_info, stars_count, username):
-        """Send stars error notification to user"""
+    async def handle_paid_invoice(self, invoice_id: str) -> bool:
+        """Process invoice reported as paid by Crypto Pay webhook"""
         try:
-            if not self.bot:
-                logger.warning("Bot instance not available, cannot send notification")
-                return
+            config = self._get_config()
+            invoice_repo = CryptoPayInvoiceRepository(config.database_url)
             
-            error_message = "Неизвестная ошибка"
-            if error_info and "message" in error_info:
-                error_message = error_info["message"]
+            invoice = await invoice_repo.get_invoice_by_id(invoice_id)
+            if not invoice:
+                logger.warning(f"Webhook: invoice {invoice_id} not found in database")
+                return False
             
-            message_text = (
-                f"❌ **Ошибка при отправке Stars**\n\n"
-                f"⚠️ Не удалось отправить Stars\n"
-                f"⭐ **Количество:** {stars_count} stars\n"
-                f"👤 **Для аккаунта:** @{username}\n"
-                f"💰 **Сумма:** ${invoice.amount_usd:.2f}\n"
-                f"🚫 **Ошибка:** {error_message}\n\n"
-                f"💡 **Что делать:**\n"
-                f"• Обратитесь в поддержку\n"
-                f"• Укажите ID заказа\n"
-                f"• Мы решим проблему"
-            )
+            async with self.invoice_semaphore:
+                await self._process_paid_invoice(invoice, invoice_repo)
+            self._tracked_invoices.pop(invoice_id, None)
+            return True
             
-            try:
-                # Try to send to user_id first, then try to get telegram_id from database
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    
-                    try:
-                        from bot.database.connection import get_connection as get_db_connection
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                
-                logger.info(f"Stars error notification sent to user {invoice.user_id}")
-                
-            except Exception as e:
-                logger.error(f"Error sending stars error notification: {e}")
-                
         except Exception as e:
-            logger.error(f"Error sending stars error notification: {e}")
+            logger.error(f"Error handling paid invoice {invoice_id}: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
+            return False
     
-    async def _notify_admins_subscription_created(self, invoice, order, months, username):
-        """Notify admins about successful subscription creation"""
-        try:
-            if not self.bot:
-                return
-            
-            config = self._get_config()
-            if not config.admin_ids:
-                return
-            
-            admin_message = (
-                f"🎉 **Новая Premium подписка активирована!**\n\n"
-                f"👤 **Пользователь:** {invoice.user_id}\n"
-                f"📱 **Период:** {months} месяцев\n"
-                f"👤 **Для аккаунта:** @{username}\n"
-                f"💰 **Сумма:** ${invoice.amount_usd:.2f}\n"
-                f"🆔 **Fragment ID:** {order.id}\n"
-                f"💳 **Счет:** {invoice.invoice_id}\n"
-                f"⏰ **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            )
-            
-            for admin_id in config.admin_ids:
-                try:
-                    await self.bot.send_message(
-                        chat_id=admin_id,
-                        text=admin_message,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error notifying admins: {e}")
+    async def _queue_invoice_order(self, invoice, service: str, quantity: int, username: str):
+        """Queue the order paid by invoice, the fulfillment workers buy it on Fragment"""
+        config = self._get_config()
+        order_repo = OrderRepository(config.database_url)
+        
+        order = await order_repo.create_paid_invoice_order(invoice.invoice_id, service, quantity, username)
+        if order:
+            logger.info(f"Invoice {invoice.invoice_id} paid, queued order {order.id}: {service} {quantity} for @{username}")
+            fulfillment_manager.notify()
+        else:
+            logger.info(f"Invoice {invoice.invoice_id} already processed, skipping")
     
-    async def _notify_admins_stars_created(self, invoice, order, stars_count, username):
-        """Notify admins about successful stars creation"""
-        try:
-            if not self.bot:
-                return
-            
-            config = self._get_config()
-            if not config.admin_ids:
-                return
-            
-            admin_message = (
-                f"🎉 **Новые Stars отправлены!**\n\n"
-                f"👤 **Пользователь:** {invoice.user_id}\n"
-                f"⭐ **Количество:** {stars_count} stars\n"
-                f"👤 **Для аккаунта:** @{username}\n"
-                f"💰 **Сумма:** ${invoice.amount_usd:.2f}\n"
-                f"🆔 **Fragment ID:** {order.id}\n"
-                f"💳 **Счет:** {invoice.invoice_id}\n"
-                f"⏰ **Время:** {datetime.now().strftime('%d.%m.%Y %H:%M')}"
-            )
-            
-            for admin_id in config.admin_ids:
-                try:
-                    await self.bot.send_message(
-                        chat_id=admin_id,
-                        text=admin_message,
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify admin {admin_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"Error notifying admins about stars: {e}")
+    async def _send_user_message(self, invoice, message_text: str):
+        """Queue notification to invoice owner, telegram_id comes with the invoice query"""
+        if not invoice.telegram_id:
+            raise ValueError(f"telegram_id unknown for invoice {invoice.invoice_id}")
+        send_queue.enqueue(invoice.telegram_id, message_text, PRIORITY_PAYMENT, parse_mode="Markdown")
     
-    async def _send_payment_success_notification(self, invoice, amount_usd):
+    async def _send_payment_success_notification(self, invoice, amount_usd, new_balance):
         """Send payment success notification to user"""
         try:
             if not self.bot:
@@ -618,43 +388,13 @@ class BackgroundTaskManager:
             message_text = (
                 f"✅ **Ваш баланс пополнен на ${amount_usd}!**\n\n"
                 f"Теперь вы можете покупать Telegram Premium подписки.\n\n"
-                f"💰 **Текущий баланс**: ${amount_usd}\n"
+                f"💰 **Текущий баланс**: ${new_balance:.2f}\n"
                 f"📱 **Что дальше**: Выберите период подписки в главном меню"
             )
             
             try:
-                # Get config for database connection
-                config = self._get_config()
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    
-                    try:
-                        from bot.database.connection import get_connection as get_db_connection
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Payment success notification sent to user {invoice.user_id} (chat_id: {chat_id})")
+                await self._send_user_message(invoice, message_text)
+                logger.info(f"Payment success notification queued for user {invoice.user_id} (chat_id: {invoice.telegram_id})")
             except Exception as e:
                 logger.error(f"Failed to send payment success notification to user {invoice.user_id}: {e}")
                 
@@ -679,38 +419,8 @@ class BackgroundTaskManager:
             )
             
             try:
-                # Get config for database connection
-                config = self._get_config()
-                chat_id = invoice.user_id
-                
-                # Check if we can send message to this user
-                try:
-                    await self.bot.send_chat_action(chat_id=chat_id, action="typing")
-                except Exception:
-                    # If user_id doesn't work, try to get telegram_id from database
-                    logger.warning(f"Cannot send to user_id {chat_id}, trying to get telegram_id from database")
-                    
-                    try:
-                        from bot.database.connection import get_connection as get_db_connection
-                        pool = get_db_connection(config.database_url)
-                        async with pool.acquire() as conn:
-                            result = await conn.fetchrow(
-                                "SELECT telegram_id FROM users WHERE id = $1",
-                                invoice.user_id
-                            )
-                            if result and result['telegram_id']:
-                                chat_id = result['telegram_id']
-                                logger.info(f"Using telegram_id {chat_id} from database for user {invoice.user_id}")
-                    except Exception as db_error:
-                        logger.error(f"Failed to get telegram_id from database: {db_error}")
-                        return
-                
-                await self.bot.send_message(
-                    chat_id=chat_id,
-                    text=message_text,
-                    parse_mode="Markdown"
-                )
-                logger.info(f"Expiration notification sent to user {invoice.user_id} (chat_id: {chat_id})")
+                await self._send_user_message(invoice, message_text)
+                logger.info(f"Expiration notification queued for user {invoice.user_id} (chat_id: {invoice.telegram_id})")
             except Exception as e:
                 logger.error(f"Failed to send expiration notification to user {invoice.user_id}: {e}")
                 
@@ -726,15 +436,15 @@ class BackgroundTaskManager:
             
             pool = await get_connection(config.database_url)
             invoice_repo = CryptoPayInvoiceRepository(pool)
-            balance_repo = UserBalanceRepository(pool)
             
             invoice = await invoice_repo.get_invoice_by_id(invoice_id)
             if not invoice:
                 return False
             
-            crypto_api = CryptoPayAPI(config.crypto_pay_token, config.crypto_pay_testnet)
+            crypto_api = get_crypto_pay_api(config.crypto_pay_token, config.crypto_pay_testnet)
+            invoice_data = await crypto_api.get_invoice(invoice.invoice_id)
             
-            await self._check_single_invoice(invoice, crypto_api, invoice_repo, balance_repo)
+            await self._check_single_invoice(invoice, invoice_data, invoice_repo)
             return True
             
         except Exception as e:
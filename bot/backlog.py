@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: Update) -> Optional[int]:
+    """Telegram id of the user who caused the update, None for updates without one"""
+    from_user = getattr(update.event, "from_user", None)
+    return from_user.id if from_user else None
+
+
+def update_age(update: Update) -> Optional[float]:
+    """Seconds since the update was sent, None when Telegram gives no date (callback queries)"""
+    event = update.event
+    sent_at = getattr(event, "edit_date", None) or getattr(event, "date", None)
+    if not isinstance(sent_at, datetime):
+        return None
+    return (datetime.now(timezone.utc) - sent_at).total_seconds()
+
+
+def is_stale(update: Update, max_age: int) -> bool:
+    """Update is older than max_age seconds, 0 disables the check"""
+    if not max_age:
+        return False
+    age = update_age(update)
+    return age is not None and age > max_age
+
+
+def collapse_updates(updates: List[Update]) -> List[Update]:
+    """Drop repeated presses of the same button by the same user, the first one is kept"""
+    seen = set()
+    collapsed = []
+    for update in updates:
+        callback = update.callback_query
+        if callback and callback.message:
+            press = (callback.from_user.id, callback.message.message_id, callback.data)
+            if press in seen:
+                continue
+            seen.add(press)
+        collapsed.append(update)
+    return collapsed
+
+
+async def feed_in_user_order(bot: Bot, dp: Dispatcher, updates: List[Update], concurrency: int):
+    """Process updates of different users concurrently, each user's updates in order"""
+    by_user: Dict[Optional[int], List[Update]] = OrderedDict()
+    for update in updates:
+        by_user.setdefault(update_user_id(update), []).append(update)
+    
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def feed_user(user_updates: List[Update]):
+        async with semaphore:
+            for update in user_updates:
+                try:
+                    await dp.feed_update(bot, update)
+                except Exception as e:
+                    logger.error(f"Error processing backlog update {update.update_id}: {e}")
+    
+    await asyncio.gather(*[feed_user(user_updates) for user_updates in by_user.values()])
+
+
+async def drain_pending_updates(bot: Bot, dp: Dispatcher, max_age: int, concurrency: int,
+                                batch_size: int = 100) -> int:
+    """Process updates that queued up while the bot was down, returns processed count.
+    
+    Batches are fetched with getUpdates and confirmed by the next call's offset. Messages
+    older than max_age seconds are skipped and repeated button presses collapsed, the
+    rest run concurrently across users but in order per user.
+    """
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    processed = skipped = 0
+    
+    while True:
+        updates = await bot.get_updates(offset=offset, limit=batch_size, timeout=0,
+                                        allowed_updates=allowed_updates)
+        if not updates:
+            break
+        offset = updates[-1].update_id + 1
+        
+        fresh = collapse_updates([update for update in updates if not is_stale(update, max_age)])
+        skipped += len(updates) - len(fresh)
+        await feed_in_user_order(bot, dp, fresh, concurrency)
+        processed += len(fresh)
+    
+    if processed or skipped:
+        logger.info(f"Startup backlog drained: {processed} updates processed, {skipped} stale or repeated skipped")
+    return processed
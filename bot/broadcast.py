@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from bot.config import get_config
+from bot.database.connection import current_db_shard
+from bot.database.models import BroadcastCampaign
+from bot.database.repository import UserRepository, BroadcastCampaignRepository
+from bot.send_queue import send_queue, PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastManager:
+    """Runs broadcast campaigns in the background.
+    
+    Recipients are streamed from the database page by page (keyset on users.id) and
+    handed to the send queue, which does the rate limiting. After each page the cursor
+    and counters are saved, so a campaign interrupted by a restart resumes where it stopped.
+    """
+    
+    def __init__(self, bot=None):
+        self.bot = bot
+        self.running = False
+        self.batch_size = 200  # recipients per page
+        self.progress_interval = 5  # seconds between admin progress message edits
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._cancelled = set()
+    
+    def set_bot(self, bot):
+        """Set bot instance for progress messages"""
+        self.bot = bot
+    
+    def _get_config(self):
+        """Get current config snapshot"""
+        return get_config()
+    
+    async def start(self):
+        """Resume campaigns left running before restart"""
+        if self.running:
+            return
+        self.running = True
+        
+        config = self._get_config()
+        self.batch_size = config.broadcast_batch_size
+        campaign_repo = BroadcastCampaignRepository(config.database_url)
+        
+        try:
+            campaigns = await campaign_repo.get_running_campaigns()
+        except Exception as e:
+            logger.error(f"Failed to load running broadcast campaigns: {e}")
+            return
+        
+        for campaign in campaigns:
+            logger.info(f"Resuming broadcast campaign {campaign.id} after user {campaign.last_user_id}")
+            self.start_campaign(campaign)
+    
+    async def stop(self):
+        """Stop campaign workers after their current page, progress stays in the database"""
+        self.running = False
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+    
+    def start_campaign(self, campaign: BroadcastCampaign):
+        """Run campaign in a background task"""
+        if campaign.id in self._tasks:
+            return
+        task = asyncio.create_task(self._run_campaign(campaign))
+        self._tasks[campaign.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(campaign.id, None))
+    
+    async def cancel_campaign(self, campaign_id: int) -> bool:
+        """Cancel campaign, the worker stops before its next page"""
+        config = self._get_config()
+        campaign_repo = BroadcastCampaignRepository(config.database_url)
+        cancelled = await campaign_repo.finish_campaign(campaign_id, "cancelled")
+        if cancelled and campaign_id in self._tasks:
+            self._cancelled.add(campaign_id)
+        return cancelled
+    
+    async def _run_campaign(self, campaign: BroadcastCampaign):
+        """Deliver campaign page by page until all recipients are done"""
+        # Started from an admin handler the task inherits its update shard, use the main pool
+        current_db_shard.set(None)
+        config = self._get_config()
+        user_repo = UserRepository(config.database_url)
+        campaign_repo = BroadcastCampaignRepository(config.database_url)
+        last_progress = 0.0
+        
+        try:
+            while self.running and campaign.id not in self._cancelled:
+                users = await user_repo.get_active_users_after(campaign.last_user_id, self.batch_size)
+                if not users:
+                    await campaign_repo.finish_campaign(campaign.id, "completed")
+                    campaign.status = "completed"
+                    break
+                
+                # Whole page goes into the queue at once, the queue paces delivery
+                results = await asyncio.gather(*[
+                    send_queue.enqueue(user.telegram_id, campaign.text, PRIORITY_BROADCAST, parse_mode="HTML")
+                    for user in users
+                ])
+                sent = sum(1 for result in results if result is not None)
+                failed = len(results) - sent
+                
+                campaign.last_user_id = users[-1].id
+                campaign.sent_count += sent
+                campaign.failed_count += failed
+                status = await campaign_repo.advance_cursor(campaign.id, campaign.last_user_id, sent, failed)
+                if status and status != "running":
+                    campaign.status = status
+                    break
+                
+                if time.monotonic() - last_progress >= self.progress_interval:
+                    last_progress = time.monotonic()
+                    await self._update_progress(campaign)
+            
+            if campaign.id in self._cancelled:
+                campaign.status = "cancelled"
+                self._cancelled.discard(campaign.id)
+            
+            if campaign.status != "running":
+                logger.info(f"Broadcast campaign {campaign.id} {campaign.status}: "
+                            f"sent {campaign.sent_count}, failed {campaign.failed_count}")
+            await self._update_progress(campaign)
+        
+        except Exception as e:
+            # Campaign stays running in the database and resumes on next start
+            logger.error(f"Error in broadcast campaign {campaign.id}: {e}")
+            import traceback
+            logger.error(f"Traceback: {traceback.format_exc()}")
+    
+    async def _update_progress(self, campaign: BroadcastCampaign):
+        """Edit admin progress message"""
+        if not self.bot or not campaign.admin_chat_id or not campaign.progress_message_id:
+            return
+        
+        try:
+            await self.bot.edit_message_text(
+                text=format_campaign_progress(campaign),
+                chat_id=campaign.admin_chat_id,
+                message_id=campaign.progress_message_id,
+                reply_markup=campaign_progress_keyboard(campaign),
+                parse_mode="HTML"
+            )
+        except Exception as e:
+            # "message is not modified" and similar are not worth more than a debug line
+            logger.debug(f"Could not update progress of campaign {campaign.id}: {e}")
+
+
+def format_campaign_progress(campaign: BroadcastCampaign) -> str:
+    """Admin progress message text"""
+    status_text = {
+        "running": "⏳ Идет рассылка",
+        "completed": "✅ Рассылка завершена",
+        "cancelled": "⛔ Рассылка отменена",
+    }.get(campaign.status, campaign.status)
+    text_preview = campaign.text[:100] + ("..." if len(campaign.text) > 100 else "")
+    
+    return (
+        f"📢 <b>Рассылка #{campaign.id}</b>\n\n"
+        f"{status_text}\n\n"
+        f"📤 Отправлено: {campaign.sent_count} из {campaign.total_users}\n"
+        f"❌ Ошибок: {campaign.failed_count}\n"
+        f"📝 Текст: {text_preview}"
+    )
+
+
+def campaign_progress_keyboard(campaign: BroadcastCampaign) -> Optional[InlineKeyboardMarkup]:
+    """Cancel button while campaign is running"""
+    if campaign.status != "running":
+        return None
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⛔ Остановить", callback_data=f"admin_broadcast_cancel_{campaign.id}")]
+    ])
+
+
+# Global broadcast manager instance
+broadcast_manager = BroadcastManager()
+
+
+async def start_broadcasts(bot=None):
+    """Start broadcast manager and resume unfinished campaigns"""
+    if bot:
+        broadcast_manager.set_bot(bot)
+    await broadcast_manager.start()
+
+
+async def stop_broadcasts():
+    """Stop broadcast manager"""
+    await broadcast_manager.stop()
@@ -1,16 +1,23 @@
 import os
+import threading
 from dataclasses import dataclass
-from typing import List
+from typing import FrozenSet, Optional
+
+from dotenv import dotenv_values
 
 
 @dataclass
 class Config:
-    """Configuration class for bot settings"""
+    """Configuration class for bot settings.
+    
+    Read-only once loaded: use get_config() for the shared snapshot and
+    reload_config() to replace it.
+    """
     bot_token: str
     database_url: str
     redis_url: str = None
     log_level: str = "INFO"
-    admin_ids: List[int] = None
+    admin_ids: FrozenSet[int] = None
     default_language: str = "ru"
     token_fragment: str = ""
     
@@ -28,7 +35,7 @@ class Config:
         
         # Admin IDs from environment variable
         admin_ids_str = os.getenv("ADMIN_IDS", "6956440009")  # Ваш ID
-        self.admin_ids = [int(x.strip()) for x in admin_ids_str.split(",")]
+        self.admin_ids = frozenset(int(x.strip()) for x in admin_ids_str.split(",") if x.strip())
         
         self.default_language = os.getenv("DEFAULT_LANGUAGE", "ru")
         
@@ -37,4 +44,134 @@ class Config:
         
         # Crypto Bot API token
         self.crypto_pay_token = os.getenv("CRYPTO_PAY_TOKEN", "")
-        self.crypto_pay_testnet = os.getenv("CRYPTO_PAY_TESTNET", "false").lower() == "true" 
\ No newline at end of file
+        self.crypto_pay_testnet = os.getenv("CRYPTO_PAY_TESTNET", "false").lower() == "true"
+        
+        # Invoice lifetime in seconds: sent to Crypto Pay as expires_in and used for local expiry
+        self.invoice_expires_in = int(os.getenv("CRYPTO_PAY_INVOICE_EXPIRES_IN", "3600"))
+        
+        # Max invoices checked/processed concurrently by the background poller
+        self.invoice_check_concurrency = int(os.getenv("INVOICE_CHECK_CONCURRENCY", "10"))
+        
+        # Crypto Pay webhook receiver (invoice_paid updates)
+        self.crypto_pay_webhook_enabled = os.getenv("CRYPTO_PAY_WEBHOOK_ENABLED", "false").lower() == "true"
+        self.crypto_pay_webhook_host = os.getenv("CRYPTO_PAY_WEBHOOK_HOST", "0.0.0.0")
+        self.crypto_pay_webhook_port = int(os.getenv("CRYPTO_PAY_WEBHOOK_PORT", "8081"))
+        self.crypto_pay_webhook_path = os.getenv("CRYPTO_PAY_WEBHOOK_PATH", "/crypto-pay/webhook")
+        
+        # Outbound message queue (Telegram allows ~30 msg/s per bot and ~1 msg/s per chat)
+        self.send_rate_limit = float(os.getenv("SEND_RATE_LIMIT", "30"))
+        self.send_per_chat_interval = float(os.getenv("SEND_PER_CHAT_INTERVAL", "1.0"))
+        self.send_queue_workers = int(os.getenv("SEND_QUEUE_WORKERS", "4"))
+        
+        # Broadcast campaigns: recipients loaded and queued per page
+        self.broadcast_batch_size = int(os.getenv("BROADCAST_BATCH_SIZE", "200"))
+        
+        # Order fulfillment: concurrent Fragment purchases and attempts per order on transient errors
+        self.order_workers = int(os.getenv("ORDER_WORKERS", "4"))
+        self.order_max_attempts = int(os.getenv("ORDER_MAX_ATTEMPTS", "5"))
+        
+        # Fragment order status refresh: seconds between checks of one order, orders per round,
+        # concurrent requests
+        self.order_status_poll_interval = int(os.getenv("ORDER_STATUS_POLL_INTERVAL", "60"))
+        self.order_status_batch_size = int(os.getenv("ORDER_STATUS_BATCH_SIZE", "50"))
+        self.order_status_concurrency = int(os.getenv("ORDER_STATUS_CONCURRENCY", "5"))
+        
+        # Seconds between reloads of the in-memory Premium and Stars prices
+        self.pricing_refresh_interval = int(os.getenv("PRICING_REFRESH_INTERVAL", "300"))
+        
+        # FSM storage: memory (this process only), redis or postgres (shared by replicas);
+        # idle states expire after FSM_STATE_TTL seconds, 0 keeps them forever
+        self.fsm_storage = os.getenv("FSM_STORAGE", "memory").lower()
+        if self.fsm_storage not in ("memory", "redis", "postgres"):
+            raise ValueError(f"FSM_STORAGE must be memory, redis or postgres, got {self.fsm_storage}")
+        if self.fsm_storage == "redis" and not self.redis_url:
+            raise ValueError("REDIS_URL is required for FSM_STORAGE=redis")
+        self.fsm_state_ttl = int(os.getenv("FSM_STATE_TTL", "86400"))
+        
+        # Update ingestion: polling (getUpdates, a single consumer) or webhook (embedded
+        # server, any number of replicas behind WEBHOOK_URL)
+        self.bot_mode = os.getenv("BOT_MODE", "polling").lower()
+        if self.bot_mode not in ("polling", "webhook"):
+            raise ValueError(f"BOT_MODE must be polling or webhook, got {self.bot_mode}")
+        self.webhook_url = os.getenv("WEBHOOK_URL", "")
+        if self.bot_mode == "webhook" and not self.webhook_url:
+            raise ValueError("WEBHOOK_URL is required for BOT_MODE=webhook")
+        self.webhook_host = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+        self.webhook_port = int(os.getenv("WEBHOOK_PORT", "8080"))
+        self.webhook_path = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+        # Checked against X-Telegram-Bot-Api-Secret-Token, derived from BOT_TOKEN when empty
+        self.webhook_secret = os.getenv("WEBHOOK_SECRET", "")
+        # Concurrent update handlers and concurrent connections Telegram may open
+        self.webhook_workers = int(os.getenv("WEBHOOK_WORKERS", "8"))
+        self.webhook_max_connections = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+        
+        # Updates sent while the bot was down: kept and processed on start unless dropped;
+        # messages older than BACKLOG_MAX_AGE seconds are skipped (0 keeps all), the backlog
+        # is processed for up to BACKLOG_CONCURRENCY users at once
+        self.drop_pending_updates = os.getenv("DROP_PENDING_UPDATES", "false").lower() == "true"
+        self.backlog_max_age = int(os.getenv("BACKLOG_MAX_AGE", "3600"))
+        self.backlog_concurrency = int(os.getenv("BACKLOG_CONCURRENCY", "32"))
+        
+        # Database connections per bot process: DB_POOL_SIZE in total, shard pools included
+        self.db_pool_size = int(os.getenv("DB_POOL_SIZE", "20"))
+        
+        # Update sharding: updates run on UPDATE_SHARDS workers keyed by user (0 disables),
+        # each with its own pool of DB_SHARD_POOL_SIZE connections taken from DB_POOL_SIZE
+        self.update_shards = int(os.getenv("UPDATE_SHARDS", "0"))
+        self.db_shard_pool_size = int(os.getenv("DB_SHARD_POOL_SIZE", "3"))
+        if self.db_pool_size - self.update_shards * self.db_shard_pool_size < 5:
+            raise ValueError("DB_POOL_SIZE must leave at least 5 connections besides "
+                             "UPDATE_SHARDS * DB_SHARD_POOL_SIZE for background work")
+        
+        # Per-user anti-flood token buckets: requests per second and burst for navigation,
+        # and for expensive actions (checkout, invoice creation)
+        self.throttle_rate = float(os.getenv("THROTTLE_RATE", "2"))
+        self.throttle_burst = float(os.getenv("THROTTLE_BURST", "10"))
+        self.throttle_expensive_rate = float(os.getenv("THROTTLE_EXPENSIVE_RATE", "0.2"))
+        self.throttle_expensive_burst = float(os.getenv("THROTTLE_EXPENSIVE_BURST", "3"))
+        # Cap on all updates of a user, checked before FSM state is loaded
+        self.throttle_update_rate = float(os.getenv("THROTTLE_UPDATE_RATE", "5"))
+        self.throttle_update_burst = float(os.getenv("THROTTLE_UPDATE_BURST", "20"))
+        
+        self._frozen = True
+    
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("Config is read-only, use reload_config() to change settings")
+        super().__setattr__(name, value)
+
+
+# Process-wide config snapshot, replaced as a whole on reload
+_config: Optional[Config] = None
+_config_lock = threading.Lock()
+
+# Variables of the real environment, taken on import before main loads .env; like at
+# startup, .env never overrides them on reload
+_environment_keys = frozenset(os.environ)
+
+
+def get_config() -> Config:
+    """Get current config snapshot, load it on first use"""
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = Config()
+    return _config
+
+
+def reload_config() -> Config:
+    """Re-read .env and environment and swap in a new snapshot.
+    
+    .env values apply to variables the real environment does not set, the same
+    precedence as load_dotenv() at startup. The new config is fully parsed before the
+    swap, so on error the old one stays active.
+    """
+    global _config
+    with _config_lock:
+        for key, value in dotenv_values().items():
+            if key not in _environment_keys and value is not None:
+                os.environ[key] = value
+        new_config = Config()
+        _config = new_config
+    return new_config
@@ -1,38 +1,105 @@
-import requests
+import aiohttp
+import asyncio
+import hashlib
+import hmac
+import json
 import logging
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# getInvoices returns at most 1000 items per call
+MAX_INVOICES_PER_REQUEST = 1000
+
 
 class CryptoPayAPI:
     """Crypto Bot Crypto Pay API integration for USDT payments"""
     
-    def __init__(self, api_token: str, testnet: bool = False):
+    def __init__(self, api_token: str, testnet: bool = False, timeout: float = 10.0,
+                 max_retries: int = 3, pool_size: int = 20):
         self.api_token = api_token
+        self.testnet = testnet
         self.base_url = "https://testnet-pay.crypt.bot/api" if testnet else "https://pay.crypt.bot/api"
         self.headers = {
             "Crypto-Pay-API-Token": api_token
         }
+        
+        # HTTP transport: one keep-alive session shared by handlers and background tasks
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get shared HTTP session, create it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                timeout=self.timeout
+            )
+        return self._session
+    
+    async def _request(self, http_method: str, api_method: str, idempotent: bool = True,
+                       **kwargs) -> Tuple[int, str]:
+        """Call API method with retries, returns (status, body).
+        
+        Idempotent calls are retried on timeouts, connection errors and 429/5xx.
+        Non-idempotent calls (createInvoice) are retried only when the connection
+        could not be established, so a request is never sent twice.
+        """
+        session = await self._get_session()
+        url = f"{self.base_url}/{api_method}"
+        
+        for attempt in range(self.max_retries + 1):
+            is_last_attempt = attempt == self.max_retries
+            try:
+                async with session.request(http_method, url, **kwargs) as response:
+                    text = await response.text()
+                    if not idempotent or response.status not in RETRY_STATUSES or is_last_attempt:
+                        return response.status, text
+                    logger.warning(f"{api_method} returned {response.status}, retrying (attempt {attempt + 1})")
+            except aiohttp.ClientConnectorError as e:
+                if is_last_attempt:
+                    raise
+                logger.warning(f"{api_method} connection failed: {e}, retrying (attempt {attempt + 1})")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not idempotent or is_last_attempt:
+                    raise
+                logger.warning(f"{api_method} request failed: {e!r}, retrying (attempt {attempt + 1})")
+            
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    
+    async def close(self):
+        """Close HTTP session and release pooled connections"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("Crypto Pay API session closed")
+        self._session = None
     
     async def get_me(self) -> Optional[Dict[str, Any]]:
         """Test API authentication"""
         try:
-            response = requests.get(f"{self.base_url}/getMe", headers=self.headers)
-            if response.status_code == 200:
-                data = response.json()
+            status, text = await self._request("GET", "getMe")
+            if status == 200:
+                data = json.loads(text)
                 if data.get("ok"):
                     return data.get("result")
-            logger.error(f"API error: {response.status_code} - {response.text}")
+            logger.error(f"API error: {status} - {text}")
             return None
         except Exception as e:
             logger.error(f"Error in getMe: {e}")
             return None
     
-    async def create_invoice(self, amount: float, asset: str = "USDT", 
+    async def create_invoice(self, amount: float, asset: str = "USDT",
                            currency_type: str = "crypto", fiat: str = "USD",
-                           description: str = "", payload: str = "") -> Optional[Dict[str, Any]]:
+                           description: str = "", payload: str = "",
+                           expires_in: int = 3600) -> Optional[Dict[str, Any]]:
         """Create payment invoice"""
         try:
             payload_data = {
@@ -41,7 +108,7 @@ class CryptoPayAPI:
                 "currency_type": currency_type,
                 "description": description,
                 "payload": payload,
-                "expires_in": 3600  # 1 hour
+                "expires_in": expires_in
             }
             
             if currency_type == "fiat":
@@ -49,14 +116,14 @@ class CryptoPayAPI:
                 payload_data["accepted_assets"] = "USDT,TON,BTC,ETH"
             
             logger.info(f"Creating invoice with payload: {payload_data}")
-            response = requests.post(f"{self.base_url}/createInvoice", 
-                                  headers=self.headers, json=payload_data)
+            status, text = await self._request("POST", "createInvoice", idempotent=False,
+                                               json=payload_data)
             
-            logger.info(f"Create invoice response status: {response.status_code}")
-            logger.info(f"Create invoice response body: {response.text}")
+            logger.info(f"Create invoice response status: {status}")
+            logger.info(f"Create invoice response body: {text}")
             
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
+                data = json.loads(text)
                 logger.info(f"Create invoice response data: {data}")
                 
                 if data.get("ok") and data.get("result"):
@@ -66,7 +133,7 @@ class CryptoPayAPI:
                 else:
                     logger.error(f"API returned error: {data}")
             
-            logger.error(f"API error: {response.status_code} - {response.text}")
+            logger.error(f"API error: {status} - {text}")
             return None
         except Exception as e:
             logger.error(f"Error in create_invoice: {e}")
@@ -74,68 +141,102 @@ class CryptoPayAPI:
             logger.error(f"Traceback: {traceback.format_exc()}")
             return None
     
-    async def get_invoice(self, invoice_id: str) -> Optional[Dict[str, Any]]:
-        """Get invoice status"""
+    async def get_invoices(self, invoice_ids: List[str]) -> Optional[List[Dict[str, Any]]]:
+        """Get several invoices with one getInvoices call.
+        
+        Returns list of invoice objects (missing ids are simply absent) or None on API error.
+        """
+        if not invoice_ids:
+            return []
+        if len(invoice_ids) > MAX_INVOICES_PER_REQUEST:
+            raise ValueError(f"getInvoices accepts at most {MAX_INVOICES_PER_REQUEST} ids per request")
+        
         try:
-            logger.info(f"Getting invoice status for ID: {invoice_id}")
-            response = requests.get(f"{self.base_url}/getInvoices", 
-                                 headers=self.headers, params={"invoice_ids": invoice_id})
-            
-            logger.info(f"API response status: {response.status_code}")
-            logger.info(f"API response headers: {dict(response.headers)}")
-            logger.info(f"API response body: {response.text}")
+            logger.debug(f"Getting status for {len(invoice_ids)} invoices")
+            status, text = await self._request("GET", "getInvoices", params={
+                "invoice_ids": ",".join(str(invoice_id) for invoice_id in invoice_ids),
+                "count": len(invoice_ids)
+            })
             
-            if response.status_code == 200:
-                data = response.json()
-                logger.info(f"API response data: {data}")
+            if status == 200:
+                data = json.loads(text)
                 
-                if data.get("ok") and data.get("result"):
-                    result = data.get("result")
-                    
-                    # Check if result has items array
-                    if "items" in result and result["items"]:
-                        invoices = result["items"]
-                        if invoices:
-                            logger.info(f"Found invoice: {invoices[0]}")
-                            return invoices[0]
-                        else:
-                            logger.warning("No invoices found in items array")
+                if data.get("ok"):
+                    result = data.get("result") or {}
                     # Fallback for direct result array (old format)
-                    elif isinstance(result, list) and result:
-                        logger.info(f"Found invoice in direct result: {result[0]}")
-                        return result[0]
-                    else:
-                        logger.warning("No invoices found in response")
+                    if isinstance(result, list):
+                        return result
+                    return result.get("items", [])
                 else:
                     logger.error(f"API returned error: {data}")
             else:
-                logger.error(f"API error: {response.status_code} - {response.text}")
+                logger.error(f"API error: {status} - {text}")
                 
         except Exception as e:
-            logger.error(f"Error in get_invoice: {e}")
+            logger.error(f"Error in get_invoices: {e}")
             import traceback
             logger.error(f"Traceback: {traceback.format_exc()}")
         
         return None
     
+    async def get_invoice(self, invoice_id: str) -> Optional[Dict[str, Any]]:
+        """Get invoice status"""
+        logger.info(f"Getting invoice status for ID: {invoice_id}")
+        invoices = await self.get_invoices([invoice_id])
+        if invoices:
+            logger.info(f"Found invoice: {invoices[0]}")
+            return invoices[0]
+        
+        logger.warning(f"No invoices found for ID: {invoice_id}")
+        return None
+    
     async def get_exchange_rates(self) -> Optional[Dict[str, Any]]:
         """Get current exchange rates"""
         try:
-            response = requests.get(f"{self.base_url}/getExchangeRates", headers=self.headers)
+            status, text = await self._request("GET", "getExchangeRates")
             
-            if response.status_code == 200:
-                data = response.json()
+            if status == 200:
+                data = json.loads(text)
                 if data.get("ok"):
                     return data.get("result")
             
-            logger.error(f"API error: {response.status_code} - {response.text}")
+            logger.error(f"API error: {status} - {text}")
             return None
         except Exception as e:
             logger.error(f"Error in get_exchange_rates: {e}")
             return None
     
+    def verify_webhook_signature(self, body: bytes, signature: str) -> bool:
+        """Check crypto-pay-api-signature header of a webhook update.
+        
+        Crypto Pay signs the raw request body with HMAC-SHA256 using SHA256(api_token) as key.
+        """
+        if not signature:
+            return False
+        secret = hashlib.sha256(self.api_token.encode()).digest()
+        expected = hmac.new(secret, body, hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature)
+    
     def get_payment_url(self, invoice_data: Dict[str, Any]) -> Optional[str]:
         """Get payment URL from invoice data"""
         if invoice_data:
             return invoice_data.get("bot_invoice_url") or invoice_data.get("pay_url")
-        return None 
\ No newline at end of file
+        return None
+
+
+# Global Crypto Pay API client instance
+crypto_pay_client: Optional[CryptoPayAPI] = None
+
+
+def get_crypto_pay_api(api_token: str, testnet: bool = False) -> CryptoPayAPI:
+    """Get shared Crypto Pay API client instance"""
+    global crypto_pay_client
+    if not crypto_pay_client:
+        crypto_pay_client = CryptoPayAPI(api_token, testnet)
+    return crypto_pay_client
+
+
+async def close_crypto_pay_api():
+    """Close shared Crypto Pay API client session"""
+    if crypto_pay_client:
+        await crypto_pay_client.close()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+from typing import Optional, Set
+
+from aiohttp import web
+
+from bot.config import Config
+from bot.crypto_pay_api import CryptoPayAPI, get_crypto_pay_api
+from bot.background_tasks import background_manager
+
+logger = logging.getLogger(__name__)
+
+
+class CryptoPayWebhookServer:
+    """Embedded HTTP endpoint for Crypto Pay webhook updates"""
+    
+    def __init__(self, crypto_api: CryptoPayAPI, host: str = "0.0.0.0", port: int = 8081,
+                 path: str = "/crypto-pay/webhook"):
+        self.crypto_api = crypto_api
+        self.host = host
+        self.port = port
+        self.path = path
+        self.runner: Optional[web.AppRunner] = None
+        self._tasks: Set[asyncio.Task] = set()  # Keep references to in-flight processing
+    
+    async def start(self):
+        """Start HTTP server"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Crypto Pay webhook listening on {self.host}:{self.port}{self.path}")
+    
+    async def stop(self):
+        """Stop HTTP server and wait for in-flight payments"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        logger.info("Crypto Pay webhook stopped")
+    
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Handle webhook update from Crypto Pay"""
+        body = await request.read()
+        signature = request.headers.get("crypto-pay-api-signature", "")
+        
+        if not self.crypto_api.verify_webhook_signature(body, signature):
+            logger.warning(f"Crypto Pay webhook: invalid signature from {request.remote}")
+            return web.Response(status=401)
+        
+        try:
+            update = json.loads(body)
+        except ValueError:
+            logger.warning("Crypto Pay webhook: malformed JSON body")
+            return web.Response(status=400)
+        
+        update_type = update.get("update_type")
+        invoice_data = update.get("payload") or {}
+        logger.info(f"Crypto Pay webhook: {update_type} for invoice {invoice_data.get('invoice_id')}")
+        
+        if update_type == "invoice_paid" and invoice_data.get("status") == "paid":
+            # Answer immediately and process in background; the poller is the safety net
+            task = asyncio.create_task(
+                background_manager.handle_paid_invoice(str(invoice_data.get("invoice_id")))
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        
+        return web.json_response({"ok": True})
+
+
+# Global webhook server instance
+webhook_server: Optional[CryptoPayWebhookServer] = None
+
+
+async def start_crypto_pay_webhook(config: Config):
+    """Start Crypto Pay webhook server if enabled in config"""
+    global webhook_server
+    if not config.crypto_pay_webhook_enabled:
+        logger.info("Crypto Pay webhook disabled, relying on polling")
+        return
+    if not config.crypto_pay_token:
+        logger.warning("Crypto Pay webhook enabled but CRYPTO_PAY_TOKEN is not set, skipping")
+        return
+    
+    webhook_server = CryptoPayWebhookServer(
+        crypto_api=get_crypto_pay_api(config.crypto_pay_token, config.crypto_pay_testnet),
+        host=config.crypto_pay_webhook_host,
+        port=config.crypto_pay_webhook_port,
+        path=config.crypto_pay_webhook_path
+    )
+    await webhook_server.start()
+
+
+async def stop_crypto_pay_webhook():
+    """Stop Crypto Pay webhook server"""
+    global webhook_server
+    if webhook_server:
+        await webhook_server.stop()
+        webhook_server = None
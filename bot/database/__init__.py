@@ -3,34 +3,30 @@ Database module for CosmicPerks bot
 """
 
 from .connection import get_connection, get_db_manager
-from .models import User, Chat, Message, PremiumPricing, UserBalance, CryptoPayInvoice
+from .migrations import run_migrations
+from .models import User, Chat, Message, PremiumPricing, StarsPricing, UserBalance, CryptoPayInvoice, BroadcastCampaign, Order, FragmentOrderRecord
 from .repository import (
     UserRepository, 
     ChatRepository, 
     MessageRepository, 
     PremiumPricingRepository,
+    StarsPricingRepository,
     UserBalanceRepository,
-    CryptoPayInvoiceRepository
+    OrderRepository,
+    FragmentOrderRepository,
+    CryptoPayInvoiceRepository,
+    BroadcastCampaignRepository
 )
 
 async def create_tables():
-    """Create database tables"""
-    from .connection import get_db_manager
+    """Bring database schema up to date"""
     import os
     
     database_url = os.getenv("DATABASE_URL")
     if not database_url:
         raise ValueError("DATABASE_URL is not set")
     
-    db_manager = get_db_manager(database_url)
-    pool = await db_manager.get_pool()
-    
-    # Read and execute schema
-    with open("bot/database/schema.sql", "r") as f:
-        schema = f.read()
-    
-    async with pool.acquire() as conn:
-        await conn.execute(schema)
+    await run_migrations(database_url)
 
 __all__ = [
     'get_connection',
@@ -39,13 +35,22 @@ __all__ = [
     'Chat', 
     'Message',
     'PremiumPricing',
+    'StarsPricing',
     'UserBalance',
     'CryptoPayInvoice',
+    'BroadcastCampaign',
+    'Order',
+    'FragmentOrderRecord',
     'UserRepository',
     'ChatRepository',
     'MessageRepository',
     'PremiumPricingRepository',
+    'StarsPricingRepository',
     'UserBalanceRepository',
+    'OrderRepository',
+    'FragmentOrderRepository',
     'CryptoPayInvoiceRepository',
+    'BroadcastCampaignRepository',
+    'run_migrations',
     'create_tables'
 ] 
\ No newline at end of file
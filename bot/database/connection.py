@@ -1,36 +1,78 @@
+import asyncio
 import asyncpg
 import logging
-from typing import Optional
+from contextvars import ContextVar
+from typing import Dict, Optional
 
 logger = logging.getLogger(__name__)
 
+# Update shard the current task works for, set by shard workers; None uses the main pool
+current_db_shard: ContextVar[Optional[int]] = ContextVar("current_db_shard", default=None)
+
 
 class DatabaseManager:
-    """Database connection manager"""
+    """Database connection manager.
+    
+    Tasks of an update shard get a small pool of their own, so one shard's load can't
+    take every connection from the others and from background work. Shard pools are
+    carved out of the pool size, the process never opens more than pool_size connections.
+    """
     
     def __init__(self, database_url: str):
         self.database_url = database_url
         self.pool: Optional[asyncpg.Pool] = None
+        self.pool_size = 20  # connections of the main pool and all shard pools together
+        self.shard_pool_size = 0
+        self.shard_pools: Dict[int, asyncpg.Pool] = {}
+        self.main_pool_size = self.pool_size
+        self._pool_lock = asyncio.Lock()  # concurrent first uses must not open a pool twice
+    
+    def configure_pools(self, pool_size: int, shards: int = 0, shard_pool_size: int = 0):
+        """Split the connection budget between shard pools and the main pool, before first use"""
+        if self.pool:
+            raise RuntimeError("Database pools must be configured before the first connection")
+        self.pool_size = pool_size
+        self.shard_pool_size = shard_pool_size
+        self.main_pool_size = pool_size - shards * shard_pool_size
     
     async def create_pool(self) -> asyncpg.Pool:
         """Create database connection pool"""
-        if not self.pool:
-            self.pool = await asyncpg.create_pool(
-                self.database_url,
-                min_size=5,
-                max_size=20
-            )
-            logger.info("Database connection pool created")
+        async with self._pool_lock:
+            if not self.pool:
+                self.pool = await asyncpg.create_pool(
+                    self.database_url,
+                    min_size=min(5, self.main_pool_size),
+                    max_size=self.main_pool_size
+                )
+                logger.info("Database connection pool created")
         return self.pool
     
+    async def create_shard_pool(self, shard: int) -> asyncpg.Pool:
+        """Create connection pool of an update shard"""
+        async with self._pool_lock:
+            if shard not in self.shard_pools:
+                self.shard_pools[shard] = await asyncpg.create_pool(
+                    self.database_url,
+                    min_size=1,
+                    max_size=self.shard_pool_size
+                )
+                logger.info(f"Database connection pool for shard {shard} created")
+        return self.shard_pools[shard]
+    
     async def get_pool(self) -> asyncpg.Pool:
-        """Get database connection pool"""
+        """Get database connection pool, the shard's own one inside shard workers"""
+        shard = current_db_shard.get()
+        if shard is not None:
+            return self.shard_pools.get(shard) or await self.create_shard_pool(shard)
         if not self.pool:
             await self.create_pool()
         return self.pool
     
     async def close_pool(self):
-        """Close database connection pool"""
+        """Close database connection pools"""
+        for pool in self.shard_pools.values():
+            await pool.close()
+        self.shard_pools = {}
         if self.pool:
             await self.pool.close()
             logger.info("Database connection pool closed")
@@ -0,0 +1,2 @@
+-- Pending invoices by expiry, used by the poller and the expiry sweep
+CREATE INDEX IF NOT EXISTS idx_crypto_pay_invoices_pending ON crypto_pay_invoices(expires_at) WHERE status = 'pending';
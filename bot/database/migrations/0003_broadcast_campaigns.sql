@@ -0,0 +1,15 @@
+-- Broadcast campaigns: recipients are streamed by users.id, last_user_id is the resume cursor
+CREATE TABLE IF NOT EXISTS broadcast_campaigns (
+    id SERIAL PRIMARY KEY,
+    text TEXT NOT NULL,
+    status VARCHAR(20) DEFAULT 'running', -- running, completed, cancelled
+    last_user_id INTEGER DEFAULT 0,
+    total_users INTEGER DEFAULT 0,
+    sent_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    admin_chat_id BIGINT,
+    progress_message_id BIGINT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    finished_at TIMESTAMP WITH TIME ZONE
+);
@@ -0,0 +1,46 @@
+-- Purchases of Premium and Stars, also the fulfillment job queue: workers claim
+-- 'queued' rows due at next_attempt_at with FOR UPDATE SKIP LOCKED
+CREATE TABLE IF NOT EXISTS orders (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    service VARCHAR(20) NOT NULL, -- premium, stars
+    quantity INTEGER NOT NULL, -- months for premium, stars count for stars
+    recipient VARCHAR(255) NOT NULL, -- Telegram username without @
+    amount_usd DECIMAL(10,2) NOT NULL,
+    source VARCHAR(20) NOT NULL, -- balance, invoice
+    invoice_id VARCHAR(255) UNIQUE, -- paying Crypto Pay invoice, one order per invoice
+    status VARCHAR(20) DEFAULT 'queued', -- queued, processing, completed, failed
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    locked_at TIMESTAMP WITH TIME ZONE, -- claimed by a worker
+    fragment_order_id VARCHAR(255),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    completed_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id);
+CREATE INDEX IF NOT EXISTS idx_orders_queued ON orders(next_attempt_at) WHERE status = 'queued';
+
+-- Orders placed on Fragment; status is mirrored from Fragment by the order status poller
+CREATE TABLE IF NOT EXISTS fragment_orders (
+    id VARCHAR(255) PRIMARY KEY, -- Fragment order id
+    order_id INTEGER REFERENCES orders(id) ON DELETE CASCADE UNIQUE,
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    username VARCHAR(255) NOT NULL,
+    months INTEGER, -- For Premium orders
+    stars_count INTEGER, -- For Stars orders
+    price DECIMAL(10,2),
+    currency VARCHAR(10),
+    status VARCHAR(20) DEFAULT 'pending',
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    checked_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(), -- last status check against Fragment
+    completed_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_fragment_orders_user_status ON fragment_orders(user_id, status);
+-- Orders the status poller still has to follow
+CREATE INDEX IF NOT EXISTS idx_fragment_orders_open ON fragment_orders(checked_at)
+    WHERE status NOT IN ('completed', 'failed', 'cancelled', 'expired');
@@ -0,0 +1,17 @@
+-- Telegram Stars Pricing table
+CREATE TABLE IF NOT EXISTS stars_pricing (
+    id SERIAL PRIMARY KEY,
+    stars_count INTEGER NOT NULL UNIQUE, -- 50, 100, 200, 500 stars
+    price_usd DECIMAL(10,2) NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Insert default stars pricing
+INSERT INTO stars_pricing (stars_count, price_usd) VALUES 
+    (50, 0.50),
+    (100, 1.00),
+    (200, 2.00),
+    (500, 5.00)
+ON CONFLICT (stars_count) DO NOTHING;
@@ -0,0 +1,10 @@
+-- FSM states and data of the Postgres FSM storage, one row per key with the same
+-- key format as the Redis storage; rows past expires_at are ignored and purged
+CREATE TABLE IF NOT EXISTS fsm_storage (
+    key VARCHAR(255) PRIMARY KEY, -- fsm:{bot_id}:{chat_id}:{user_id}:{state|data}
+    value TEXT NOT NULL, -- state name or JSON data
+    expires_at TIMESTAMP WITH TIME ZONE, -- NULL never expires
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires_at ON fsm_storage(expires_at) WHERE expires_at IS NOT NULL;
@@ -0,0 +1,106 @@
+"""
+Versioned schema migrations.
+
+Migrations are the numbered NNNN_name.sql files in this directory, applied in order
+once each and recorded in the schema_version table.
+"""
+
+import logging
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import asyncpg
+
+from ..connection import get_db_manager
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# pg_advisory_lock key, serializes migrations of replicas starting at the same time
+MIGRATION_LOCK_ID = 727_001_001
+
+
+@dataclass
+class Migration:
+    """Migration file"""
+    version: int
+    name: str
+    path: Path
+
+
+def load_migrations() -> List[Migration]:
+    """Migration files sorted by version"""
+    migrations = []
+    for path in MIGRATIONS_DIR.glob("*.sql"):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if not match:
+            raise ValueError(f"Invalid migration file name: {path.name}")
+        migrations.append(Migration(int(match.group(1)), match.group(2), path))
+    
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return migrations
+
+
+async def get_schema_version(conn) -> int:
+    """Latest applied migration, 0 for a database without schema_version"""
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def run_migrations(database_url: str) -> int:
+    """Apply pending migrations, returns schema version.
+    
+    When the schema is current this is a single query. Otherwise migrations run under
+    an advisory lock, each in its own transaction, so replicas starting together apply
+    every migration exactly once.
+    """
+    migrations = load_migrations()
+    latest = migrations[-1].version if migrations else 0
+    
+    db_manager = get_db_manager(database_url)
+    pool = await db_manager.get_pool()
+    
+    async with pool.acquire() as conn:
+        current = await get_schema_version(conn)
+        if current >= latest:
+            logger.info(f"Database schema is up to date (version {current})")
+            return current
+        
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            
+            # Another replica may have migrated while we waited for the lock
+            current = await get_schema_version(conn)
+            for migration in migrations:
+                if migration.version <= current:
+                    continue
+                
+                logger.info(f"Applying migration {migration.version:04d}_{migration.name}")
+                async with conn.transaction():
+                    await conn.execute(migration.path.read_text(encoding="utf-8"))
+                    await conn.execute(
+                        "INSERT INTO schema_version (version, name) VALUES ($1, $2)",
+                        migration.version, migration.name
+                    )
+                current = migration.version
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+        
+        logger.info(f"Database schema migrated to version {current}")
+        return current
@@ -53,6 +53,17 @@ class PremiumPricing:
     updated_at: datetime = None
 
 
+@dataclass
+class StarsPricing:
+    """Telegram Stars pricing model"""
+    id: int
+    stars_count: int  # 50, 100, 200, 500 stars
+    price_usd: float
+    is_active: bool = True
+    created_at: datetime = None
+    updated_at: datetime = None
+
+
 @dataclass
 class UserBalance:
     """User balance model"""
@@ -79,4 +90,69 @@ class CryptoPayInvoice:
     created_at: datetime = None
     updated_at: datetime = None
     paid_at: Optional[datetime] = None
-    expires_at: Optional[datetime] = None 
\ No newline at end of file
+    expires_at: Optional[datetime] = None
+    # Owner's Telegram chat and language, filled by queries joining users
+    telegram_id: Optional[int] = None
+    language: Optional[str] = None
+
+
+@dataclass
+class BroadcastCampaign:
+    """Broadcast campaign model"""
+    id: int
+    text: str
+    status: str = "running"  # running, completed, cancelled
+    last_user_id: int = 0  # Keyset cursor: recipients with id <= last_user_id are done
+    total_users: int = 0
+    sent_count: int = 0
+    failed_count: int = 0
+    admin_chat_id: Optional[int] = None
+    progress_message_id: Optional[int] = None
+    created_at: datetime = None
+    updated_at: datetime = None
+    finished_at: Optional[datetime] = None
+
+
+@dataclass
+class Order:
+    """Premium or Stars purchase, fulfilled in the background"""
+    id: int
+    user_id: int
+    service: str  # premium, stars
+    quantity: int  # months for premium, stars count for stars
+    recipient: str  # Telegram username without @
+    amount_usd: float
+    source: str  # balance, invoice
+    invoice_id: Optional[str] = None  # Paying Crypto Pay invoice
+    status: str = "queued"  # queued, processing, completed, failed
+    attempts: int = 0
+    next_attempt_at: Optional[datetime] = None
+    locked_at: Optional[datetime] = None
+    fragment_order_id: Optional[str] = None
+    last_error: Optional[str] = None
+    created_at: datetime = None
+    updated_at: datetime = None
+    completed_at: Optional[datetime] = None
+    # Owner's Telegram chat and language, filled by queries joining users
+    telegram_id: Optional[int] = None
+    language: Optional[str] = None
+    # Fragment side status, filled by queries joining fragment_orders
+    fragment_status: Optional[str] = None
+
+
+@dataclass
+class FragmentOrderRecord:
+    """Order placed on Fragment, as stored locally"""
+    id: str  # Fragment order id
+    order_id: int
+    user_id: int
+    username: str
+    months: Optional[int] = None  # For Premium orders
+    stars_count: Optional[int] = None  # For Stars orders
+    price: Optional[float] = None
+    currency: Optional[str] = None
+    status: str = "pending"
+    created_at: datetime = None
+    updated_at: datetime = None
+    checked_at: datetime = None
+    completed_at: Optional[datetime] = None
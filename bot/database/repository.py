@@ -1,13 +1,36 @@
 import asyncpg
 import logging
-from typing import Optional, List
+from typing import Optional, List, Tuple
 from datetime import datetime, timezone, timedelta
 
-from bot.database.models import User, Chat, Message, PremiumPricing, UserBalance, CryptoPayInvoice
+from bot.database.models import User, Chat, Message, PremiumPricing, StarsPricing, UserBalance, CryptoPayInvoice, BroadcastCampaign, Order, FragmentOrderRecord
 from .connection import get_db_manager
+from .cache import user_cache
 
 logger = logging.getLogger(__name__)
 
+# Get-or-create in one statement; (xmax = 0) is true only for a freshly inserted row.
+# Profile fields follow Telegram, language is only set on insert.
+UPSERT_USER_SQL = """
+    INSERT INTO users (telegram_id, username, first_name, last_name, language, created_at, updated_at)
+    VALUES ($1, $2, $3, $4, $5, NOW(), NOW())
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET username = EXCLUDED.username, first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name, updated_at = NOW()
+    RETURNING id, telegram_id, username, first_name, last_name, language, created_at, updated_at, is_active,
+              (xmax = 0) AS inserted
+"""
+
+UPSERT_CHAT_SQL = """
+    INSERT INTO chats (telegram_id, chat_type, title, username, created_at, updated_at)
+    VALUES ($1, $2, $3, $4, NOW(), NOW())
+    ON CONFLICT (telegram_id) DO UPDATE
+    SET chat_type = EXCLUDED.chat_type, title = EXCLUDED.title,
+        username = EXCLUDED.username, updated_at = NOW()
+    RETURNING id, telegram_id, chat_type, title, username, created_at, updated_at, is_active,
+              (xmax = 0) AS inserted
+"""
+
 
 class UserRepository:
     """Repository for user operations"""
@@ -26,10 +49,42 @@ class UserRepository:
                 RETURNING id, telegram_id, username, first_name, last_name, language, created_at, updated_at, is_active
             """, telegram_id, username, first_name, last_name, language, datetime.now(), datetime.now())
             
-            return User(**dict(row))
+            user = User(**dict(row))
+            user_cache.set(user.telegram_id, user)
+            return user
+    
+    async def upsert_user(self, telegram_id: int, username: str = None, first_name: str = None,
+                          last_name: str = None, language: str = "ru") -> Tuple[User, bool]:
+        """Get or create user in one round trip, returns (user, created)"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = dict(await conn.fetchrow(UPSERT_USER_SQL, telegram_id, username,
+                                           first_name, last_name, language))
+            created = row.pop("inserted")
+            user = User(**row)
+            user_cache.set(user.telegram_id, user)
+            return user, created
+    
+    async def ensure_user_and_chat(self, from_user, chat) -> Tuple[User, Chat, bool]:
+        """Upsert aiogram user and chat on a single connection, returns (user, chat, user_created)"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            user_row = dict(await conn.fetchrow(UPSERT_USER_SQL, from_user.id, from_user.username,
+                                                from_user.first_name, from_user.last_name, "ru"))
+            chat_row = dict(await conn.fetchrow(UPSERT_CHAT_SQL, chat.id, chat.type,
+                                                chat.title, chat.username))
+            created = user_row.pop("inserted")
+            chat_row.pop("inserted")
+            user = User(**user_row)
+            user_cache.set(user.telegram_id, user)
+            return user, Chat(**chat_row), created
     
     async def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
-        """Get user by telegram ID"""
+        """Get user by telegram ID, served from user_cache when possible"""
+        user = user_cache.get(telegram_id)
+        if user is not None:
+            return user
+        
         pool = await self.db_manager.get_pool()
         async with pool.acquire() as conn:
             row = await conn.fetchrow("""
@@ -37,7 +92,11 @@ class UserRepository:
                 FROM users WHERE telegram_id = $1
             """, telegram_id)
             
-            return User(**dict(row)) if row else None
+            if not row:
+                return None
+            user = User(**dict(row))
+            user_cache.set(telegram_id, user)
+            return user
     
     async def update_user(self, telegram_id: int, **kwargs) -> Optional[User]:
         """Update user data"""
@@ -72,7 +131,12 @@ class UserRepository:
             
             row = await conn.fetchrow(query, *values)
             
-            return User(**dict(row)) if row else None
+            if not row:
+                user_cache.invalidate(telegram_id)
+                return None
+            user = User(**dict(row))
+            user_cache.set(telegram_id, user)
+            return user
 
     async def get_all_users(self) -> List[User]:
         """Get all users"""
@@ -85,13 +149,29 @@ class UserRepository:
             """)
             return [User(**dict(row)) for row in rows]
     
+    async def get_active_users_after(self, last_user_id: int, limit: int) -> List[User]:
+        """Get next page of active users ordered by id (keyset pagination)"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, telegram_id, username, first_name, last_name, language, created_at, updated_at, is_active
+                FROM users WHERE is_active = TRUE AND id > $1
+                ORDER BY id
+                LIMIT $2
+            """, last_user_id, limit)
+            return [User(**dict(row)) for row in rows]
+    
     async def delete_user(self, user_id: int) -> bool:
         """Delete user by ID (cascade delete due to foreign keys)"""
         try:
             pool = await self.db_manager.get_pool()
             async with pool.acquire() as conn:
                 # Delete user (cascade will handle related records)
-                await conn.execute("DELETE FROM users WHERE id = $1", user_id)
+                telegram_id = await conn.fetchval(
+                    "DELETE FROM users WHERE id = $1 RETURNING telegram_id", user_id
+                )
+                if telegram_id is not None:
+                    user_cache.invalidate(telegram_id)
                 return True
         except Exception as e:
             logger.error(f"Error deleting user {user_id}: {e}")
@@ -116,6 +196,15 @@ class ChatRepository:
             
             return Chat(**dict(row))
     
+    async def upsert_chat(self, telegram_id: int, chat_type: str, title: str = None,
+                          username: str = None) -> Tuple[Chat, bool]:
+        """Get or create chat in one round trip, returns (chat, created)"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = dict(await conn.fetchrow(UPSERT_CHAT_SQL, telegram_id, chat_type, title, username))
+            created = row.pop("inserted")
+            return Chat(**row), created
+    
     async def get_chat_by_telegram_id(self, telegram_id: int) -> Optional[Chat]:
         """Get chat by telegram ID"""
         pool = await self.db_manager.get_pool()
@@ -204,6 +293,24 @@ class PremiumPricingRepository:
             return [PremiumPricing(**dict(row)) for row in rows]
 
 
+class StarsPricingRepository:
+    """Repository for stars pricing operations"""
+    
+    def __init__(self, database_url: str):
+        self.db_manager = get_db_manager(database_url)
+    
+    async def get_all_pricing(self) -> List[StarsPricing]:
+        """Get all active pricing"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, stars_count, price_usd, is_active, created_at, updated_at
+                FROM stars_pricing WHERE is_active = TRUE
+                ORDER BY stars_count
+            """)
+            return [StarsPricing(**dict(row)) for row in rows]
+
+
 class UserBalanceRepository:
     """Repository for user balance operations"""
     
@@ -233,42 +340,284 @@ class UserBalanceRepository:
             
             return UserBalance(**dict(row))
     
-    async def add_to_balance(self, user_id: int, amount: float) -> bool:
-        """Add amount to user balance"""
+    async def add_to_balance(self, user_id: int, amount: float) -> Optional[float]:
+        """Credit user balance in one statement (creates the record if missing).
+        
+        Returns new balance, or None if the credit failed.
+        """
         try:
             pool = await self.db_manager.get_pool()
             async with pool.acquire() as conn:
-                # First, ensure user has a balance record
-                balance = await self.get_user_balance(user_id)
-                if not balance:
-                    await self.create_user_balance(user_id)
-                
-                await conn.execute("""
-                    UPDATE user_balance 
-                    SET balance_usd = balance_usd + $1, updated_at = $2
-                    WHERE user_id = $3
-                """, amount, datetime.now(), user_id)
+                balance = await conn.fetchval("""
+                    INSERT INTO user_balance (user_id, balance_usd, balance_usdt, created_at, updated_at)
+                    VALUES ($1, $2, 0, NOW(), NOW())
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET balance_usd = user_balance.balance_usd + EXCLUDED.balance_usd, updated_at = NOW()
+                    RETURNING balance_usd
+                """, user_id, amount)
                 
-                return True
+                return float(balance)
         except Exception as e:
             logger.error(f"Error adding to balance: {e}")
-            return False
+            return None
     
-    async def subtract_from_balance(self, user_id: int, amount: float) -> bool:
-        """Subtract amount from user balance"""
+    async def subtract_from_balance(self, user_id: int, amount: float) -> Optional[float]:
+        """Debit user balance only if it covers the amount, in one statement.
+        
+        Returns new balance, or None if the balance was insufficient or the debit failed.
+        """
         try:
             pool = await self.db_manager.get_pool()
             async with pool.acquire() as conn:
-                await conn.execute("""
+                balance = await conn.fetchval("""
                     UPDATE user_balance 
-                    SET balance_usd = balance_usd - $1, updated_at = $2
-                    WHERE user_id = $3 AND balance_usd >= $1
-                """, amount, datetime.now(), user_id)
+                    SET balance_usd = balance_usd - $1, updated_at = NOW()
+                    WHERE user_id = $2 AND balance_usd >= $1
+                    RETURNING balance_usd
+                """, amount, user_id)
                 
-                return True
+                return float(balance) if balance is not None else None
         except Exception as e:
             logger.error(f"Error subtracting from balance: {e}")
-            return False
+            return None
+
+
+ORDER_COLUMNS = """id, user_id, service, quantity, recipient, amount_usd, source, invoice_id, status, attempts,
+                   next_attempt_at, locked_at, fragment_order_id, last_error, created_at, updated_at, completed_at"""
+
+
+class OrderRepository:
+    """Repository for order operations"""
+    
+    def __init__(self, database_url: str):
+        self.db_manager = get_db_manager(database_url)
+    
+    async def checkout(self, user_id: int, service: str, quantity: int, recipient: str,
+                       amount: float) -> Tuple[Optional[Order], float]:
+        """Pay for an order from balance: debit and queue the order in one statement.
+        
+        The debit only applies if the balance covers the amount and the order row is
+        only inserted if the debit applied, so parallel checkouts cannot overdraw.
+        Returns (order, balance after) on success, (None, current balance) otherwise.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(f"""
+                WITH debit AS (
+                    UPDATE user_balance
+                    SET balance_usd = balance_usd - $5, updated_at = NOW()
+                    WHERE user_id = $1 AND balance_usd >= $5
+                    RETURNING balance_usd
+                ), new_order AS (
+                    INSERT INTO orders (user_id, service, quantity, recipient, amount_usd, source)
+                    SELECT $1, $2, $3, $4, $5, 'balance' FROM debit
+                    RETURNING {ORDER_COLUMNS}
+                )
+                SELECT o.*,
+                       COALESCE((SELECT balance_usd FROM debit),
+                                (SELECT balance_usd FROM user_balance WHERE user_id = $1), 0) AS balance
+                FROM (SELECT 1) one
+                LEFT JOIN new_order o ON TRUE
+            """, user_id, service, quantity, recipient, amount)
+            
+            data = dict(row)
+            balance = float(data.pop("balance"))
+            return (Order(**data) if data["id"] is not None else None), balance
+    
+    async def create_paid_invoice_order(self, invoice_id: str, service: str, quantity: int,
+                                        recipient: str) -> Optional[Order]:
+        """Mark Crypto Pay invoice paid and queue the order it paid for, in one statement.
+        
+        Either both happen or neither, so a failure leaves the invoice pending for the next
+        check. Returns None if the invoice was already processed.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(f"""
+                WITH claimed AS (
+                    UPDATE crypto_pay_invoices
+                    SET status = 'paid', paid_at = NOW(), updated_at = NOW()
+                    WHERE invoice_id = $1 AND status <> 'paid'
+                    RETURNING invoice_id, user_id, amount_usd
+                )
+                INSERT INTO orders (user_id, service, quantity, recipient, amount_usd, source, invoice_id)
+                SELECT user_id, $2, $3, $4, amount_usd, 'invoice', invoice_id FROM claimed
+                ON CONFLICT (invoice_id) DO NOTHING
+                RETURNING {ORDER_COLUMNS}
+            """, invoice_id, service, quantity, recipient)
+            
+            return Order(**dict(row)) if row else None
+    
+    async def get_order(self, order_id: int) -> Optional[Order]:
+        """Get order by ID"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(f"SELECT {ORDER_COLUMNS} FROM orders WHERE id = $1", order_id)
+            return Order(**dict(row)) if row else None
+    
+    async def count_user_orders(self, user_id: int) -> int:
+        """Total number of orders of user"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval("SELECT COUNT(*) FROM orders WHERE user_id = $1", user_id)
+    
+    async def get_user_orders(self, user_id: int, limit: int = 10) -> List[Order]:
+        """Latest orders of user with their Fragment status"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT o.*, f.status AS fragment_status
+                FROM orders o
+                LEFT JOIN fragment_orders f ON f.order_id = o.id
+                WHERE o.user_id = $1
+                ORDER BY o.id DESC
+                LIMIT $2
+            """, user_id, limit)
+            return [Order(**dict(row)) for row in rows]
+    
+    async def get_user_order(self, user_id: int, order_id: int) -> Optional[Order]:
+        """Order of user with its Fragment status, None if it belongs to someone else"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT o.*, f.status AS fragment_status
+                FROM orders o
+                LEFT JOIN fragment_orders f ON f.order_id = o.id
+                WHERE o.id = $1 AND o.user_id = $2
+            """, order_id, user_id)
+            return Order(**dict(row)) if row else None
+    
+    async def claim_orders(self, limit: int) -> List[Order]:
+        """Claim due queued orders for processing.
+        
+        Rows locked by another worker or replica are skipped, so concurrent claims
+        never return the same order.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                WITH claimed AS (
+                    UPDATE orders
+                    SET status = 'processing', attempts = attempts + 1, locked_at = NOW(), updated_at = NOW()
+                    WHERE id IN (
+                        SELECT id FROM orders
+                        WHERE status = 'queued' AND next_attempt_at <= NOW()
+                        ORDER BY next_attempt_at
+                        LIMIT $1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING {ORDER_COLUMNS}
+                )
+                SELECT c.*, u.telegram_id, u.language
+                FROM claimed c LEFT JOIN users u ON u.id = c.user_id
+                ORDER BY c.id
+            """, limit)
+            return [Order(**dict(row)) for row in rows]
+    
+    async def complete_order(self, order_id: int, fragment_order):
+        """Mark order fulfilled and record the Fragment order in the same statement"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                WITH completed AS (
+                    UPDATE orders
+                    SET status = 'completed', fragment_order_id = $1, last_error = NULL, locked_at = NULL,
+                        completed_at = NOW(), updated_at = NOW()
+                    WHERE id = $2
+                    RETURNING id, user_id
+                )
+                INSERT INTO fragment_orders (id, order_id, user_id, username, months, stars_count,
+                                             price, currency, status)
+                SELECT $1, id, user_id, $3, $4, $5, $6, $7, $8 FROM completed
+                ON CONFLICT (id) DO NOTHING
+            """, str(fragment_order.id), order_id, fragment_order.username, fragment_order.months,
+                 fragment_order.stars_count, fragment_order.price, fragment_order.currency,
+                 fragment_order.status)
+    
+    async def retry_order(self, order_id: int, error: str, delay: float):
+        """Put order back in the queue, due again in delay seconds"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE orders
+                SET status = 'queued', last_error = $1, locked_at = NULL,
+                    next_attempt_at = NOW() + $2 * INTERVAL '1 second', updated_at = NOW()
+                WHERE id = $3
+            """, error, delay, order_id)
+    
+    async def fail_order(self, order_id: int, error: str):
+        """Mark order failed for good"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE orders
+                SET status = 'failed', last_error = $1, locked_at = NULL, updated_at = NOW()
+                WHERE id = $2
+            """, error, order_id)
+    
+    async def fail_stale_orders(self, timeout: int) -> List[Order]:
+        """Fail orders claimed more than timeout seconds ago, returns them.
+        
+        A worker that died mid-call may or may not have bought the order on Fragment,
+        so these are left for manual review rather than retried.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                WITH stale AS (
+                    UPDATE orders
+                    SET status = 'failed', last_error = 'interrupted during processing', locked_at = NULL,
+                        updated_at = NOW()
+                    WHERE status = 'processing' AND locked_at < NOW() - $1::int * INTERVAL '1 second'
+                    RETURNING {ORDER_COLUMNS}
+                )
+                SELECT s.*, u.telegram_id, u.language
+                FROM stale s LEFT JOIN users u ON u.id = s.user_id
+            """, timeout)
+            return [Order(**dict(row)) for row in rows]
+
+
+class FragmentOrderRepository:
+    """Repository for orders placed on Fragment"""
+    
+    def __init__(self, database_url: str):
+        self.db_manager = get_db_manager(database_url)
+    
+    async def get_open_orders(self, limit: int, checked_before: int) -> List[FragmentOrderRecord]:
+        """Orders not in a final status, least recently checked first.
+        
+        Only orders last checked more than checked_before seconds ago are returned.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, order_id, user_id, username, months, stars_count, price, currency, status,
+                       created_at, updated_at, checked_at, completed_at
+                FROM fragment_orders
+                WHERE status NOT IN ('completed', 'failed', 'cancelled', 'expired')
+                  AND checked_at < NOW() - $2 * INTERVAL '1 second'
+                ORDER BY checked_at
+                LIMIT $1
+            """, limit, checked_before)
+            return [FragmentOrderRecord(**dict(row)) for row in rows]
+    
+    async def update_statuses(self, statuses: List[Tuple[str, Optional[str]]]):
+        """Store checked statuses in one statement, None keeps the status and only marks it checked"""
+        if not statuses:
+            return
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE fragment_orders f
+                SET status = COALESCE(c.status, f.status),
+                    updated_at = CASE WHEN c.status IS DISTINCT FROM f.status AND c.status IS NOT NULL
+                                      THEN NOW() ELSE f.updated_at END,
+                    completed_at = CASE WHEN c.status = 'completed' AND f.completed_at IS NULL
+                                        THEN NOW() ELSE f.completed_at END,
+                    checked_at = NOW()
+                FROM unnest($1::text[], $2::text[]) AS c(id, status)
+                WHERE f.id = c.id
+            """, [order_id for order_id, _ in statuses], [status for _, status in statuses])
 
 
 class CryptoPayInvoiceRepository:
@@ -278,20 +627,23 @@ class CryptoPayInvoiceRepository:
         self.db_manager = get_db_manager(database_url)
     
     async def create_invoice(self, invoice_id: str, user_id: int, amount_usd: float,
-                           amount_crypto: float, asset: str, payload: str = None) -> CryptoPayInvoice:
-        """Create new crypto pay invoice"""
+                           amount_crypto: float, asset: str, payload: str = None,
+                           crypto_pay_url: str = None, expires_in: int = 3600) -> CryptoPayInvoice:
+        """Create new crypto pay invoice expiring in expires_in seconds"""
         pool = await self.db_manager.get_pool()
         async with pool.acquire() as conn:
-            expires_at = datetime.now() + timedelta(hours=1)
-            
             row = await conn.fetchrow("""
-                INSERT INTO crypto_pay_invoices (invoice_id, user_id, amount_usd, amount_crypto, 
-                                               asset, payload, expires_at, created_at, updated_at)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                RETURNING id, invoice_id, user_id, amount_usd, amount_crypto, asset, status, 
-                         crypto_pay_url, payload, created_at, updated_at, paid_at, expires_at
-            """, invoice_id, user_id, amount_usd, amount_crypto, asset, payload, expires_at, 
-                 datetime.now(), datetime.now())
+                WITH inserted AS (
+                    INSERT INTO crypto_pay_invoices (invoice_id, user_id, amount_usd, amount_crypto, 
+                                                   asset, payload, crypto_pay_url, expires_at, created_at, updated_at)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7, NOW() + $8 * INTERVAL '1 second', NOW(), NOW())
+                    RETURNING id, invoice_id, user_id, amount_usd, amount_crypto, asset, status, 
+                             crypto_pay_url, payload, created_at, updated_at, paid_at, expires_at
+                )
+                SELECT i.*, u.telegram_id, u.language
+                FROM inserted i LEFT JOIN users u ON u.id = i.user_id
+            """, invoice_id, user_id, amount_usd, amount_crypto, asset, payload, crypto_pay_url,
+                 expires_in)
             
             return CryptoPayInvoice(**dict(row))
     
@@ -300,16 +652,23 @@ class CryptoPayInvoiceRepository:
         pool = await self.db_manager.get_pool()
         async with pool.acquire() as conn:
             row = await conn.fetchrow("""
-                SELECT id, invoice_id, user_id, amount_usd, amount_crypto, asset, status, 
-                       crypto_pay_url, payload, created_at, updated_at, paid_at, expires_at
-                FROM crypto_pay_invoices WHERE invoice_id = $1
+                SELECT i.id, i.invoice_id, i.user_id, i.amount_usd, i.amount_crypto, i.asset, i.status, 
+                       i.crypto_pay_url, i.payload, i.created_at, i.updated_at, i.paid_at, i.expires_at,
+                       u.telegram_id, u.language
+                FROM crypto_pay_invoices i
+                LEFT JOIN users u ON u.id = i.user_id
+                WHERE i.invoice_id = $1
             """, invoice_id)
             
             return CryptoPayInvoice(**dict(row)) if row else None
     
     async def update_invoice_status(self, invoice_id: str, status: str, 
-                                  crypto_pay_url: str = None) -> bool:
-        """Update invoice status"""
+                                  crypto_pay_url: str = None, expected_status: str = None) -> bool:
+        """Update invoice status.
+        
+        If expected_status is given, only updates an invoice still in that status
+        and returns False when nothing was changed.
+        """
         try:
             pool = await self.db_manager.get_pool()
             async with pool.acquire() as conn:
@@ -328,28 +687,145 @@ class CryptoPayInvoiceRepository:
                     param_num += 1
                 
                 params.append(invoice_id)
+                conditions = [f"invoice_id = ${param_num}"]
+                param_num += 1
+                
+                if expected_status:
+                    conditions.append(f"status = ${param_num}")
+                    params.append(expected_status)
+                    param_num += 1
                 
                 query = f"""
                     UPDATE crypto_pay_invoices 
                     SET {', '.join(update_fields)}
-                    WHERE invoice_id = ${param_num}
+                    WHERE {' AND '.join(conditions)}
                 """
                 
-                await conn.execute(query, *params)
-                return True
+                result = await conn.execute(query, *params)
+                return result != "UPDATE 0"
         except Exception as e:
             logger.error(f"Error updating invoice status: {e}")
             return False
     
-    async def get_pending_invoices(self) -> List[CryptoPayInvoice]:
-        """Get all pending invoices"""
+    async def credit_paid_invoice(self, invoice_id: str) -> Optional[float]:
+        """Mark invoice paid and credit its amount to the owner's balance, in one statement.
+        
+        Either both happen or neither, so a failure leaves the invoice pending for the next
+        check. Returns the new balance, or None if the invoice was already processed.
+        """
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            balance = await conn.fetchval("""
+                WITH claimed AS (
+                    UPDATE crypto_pay_invoices 
+                    SET status = 'paid', paid_at = NOW(), updated_at = NOW()
+                    WHERE invoice_id = $1 AND status <> 'paid'
+                    RETURNING user_id, amount_usd
+                )
+                INSERT INTO user_balance (user_id, balance_usd, balance_usdt, created_at, updated_at)
+                SELECT user_id, amount_usd, 0, NOW(), NOW() FROM claimed
+                ON CONFLICT (user_id) DO UPDATE
+                SET balance_usd = user_balance.balance_usd + EXCLUDED.balance_usd, updated_at = NOW()
+                RETURNING balance_usd
+            """, invoice_id)
+            
+            return float(balance) if balance is not None else None
+    
+    async def expire_stale_invoices(self, grace_seconds: int = 0) -> List[CryptoPayInvoice]:
+        """Expire pending invoices more than grace_seconds past expires_at in one statement.
+        
+        Returns expired invoices.
+        """
         pool = await self.db_manager.get_pool()
         async with pool.acquire() as conn:
             rows = await conn.fetch("""
-                SELECT id, invoice_id, user_id, amount_usd, amount_crypto, asset, status, 
-                       crypto_pay_url, payload, created_at, updated_at, paid_at, expires_at
-                FROM crypto_pay_invoices 
-                WHERE status = 'pending' AND expires_at > NOW()
-                ORDER BY created_at ASC
+                WITH expired AS (
+                    UPDATE crypto_pay_invoices 
+                    SET status = 'expired', updated_at = NOW()
+                    WHERE status = 'pending' AND expires_at <= NOW() - $1::int * INTERVAL '1 second'
+                    RETURNING id, invoice_id, user_id, amount_usd, amount_crypto, asset, status, 
+                              crypto_pay_url, payload, created_at, updated_at, paid_at, expires_at
+                )
+                SELECT e.*, u.telegram_id, u.language
+                FROM expired e LEFT JOIN users u ON u.id = e.user_id
+            """, grace_seconds)
+            return [CryptoPayInvoice(**dict(row)) for row in rows]
+    
+    async def get_pending_invoices(self, grace_seconds: int = 0) -> List[CryptoPayInvoice]:
+        """Get pending invoices not more than grace_seconds past expires_at"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT i.id, i.invoice_id, i.user_id, i.amount_usd, i.amount_crypto, i.asset, i.status, 
+                       i.crypto_pay_url, i.payload, i.created_at, i.updated_at, i.paid_at, i.expires_at,
+                       u.telegram_id, u.language
+                FROM crypto_pay_invoices i
+                LEFT JOIN users u ON u.id = i.user_id
+                WHERE i.status = 'pending' AND i.expires_at > NOW() - $1::int * INTERVAL '1 second'
+                ORDER BY i.created_at ASC
+            """, grace_seconds)
+            return [CryptoPayInvoice(**dict(row)) for row in rows]
+
+
+class BroadcastCampaignRepository:
+    """Repository for broadcast campaign operations"""
+    
+    def __init__(self, database_url: str):
+        self.db_manager = get_db_manager(database_url)
+    
+    async def create_campaign(self, text: str, admin_chat_id: int) -> BroadcastCampaign:
+        """Create running campaign, recipients are all active users"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                INSERT INTO broadcast_campaigns (text, admin_chat_id, total_users)
+                SELECT $1, $2, COUNT(*) FROM users WHERE is_active = TRUE
+                RETURNING id, text, status, last_user_id, total_users, sent_count, failed_count,
+                          admin_chat_id, progress_message_id, created_at, updated_at, finished_at
+            """, text, admin_chat_id)
+            
+            return BroadcastCampaign(**dict(row))
+    
+    async def get_running_campaigns(self) -> List[BroadcastCampaign]:
+        """Get campaigns that have not finished yet"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT id, text, status, last_user_id, total_users, sent_count, failed_count,
+                       admin_chat_id, progress_message_id, created_at, updated_at, finished_at
+                FROM broadcast_campaigns WHERE status = 'running'
+                ORDER BY id
             """)
-            return [CryptoPayInvoice(**dict(row)) for row in rows] 
\ No newline at end of file
+            return [BroadcastCampaign(**dict(row)) for row in rows]
+    
+    async def set_progress_message(self, campaign_id: int, message_id: int):
+        """Remember admin message that shows campaign progress"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE broadcast_campaigns SET progress_message_id = $1, updated_at = NOW()
+                WHERE id = $2
+            """, message_id, campaign_id)
+    
+    async def advance_cursor(self, campaign_id: int, last_user_id: int,
+                             sent: int, failed: int) -> Optional[str]:
+        """Move cursor past a delivered batch and add its counters, returns campaign status"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval("""
+                UPDATE broadcast_campaigns
+                SET last_user_id = $1, sent_count = sent_count + $2, failed_count = failed_count + $3,
+                    updated_at = NOW()
+                WHERE id = $4
+                RETURNING status
+            """, last_user_id, sent, failed, campaign_id)
+    
+    async def finish_campaign(self, campaign_id: int, status: str = "completed") -> bool:
+        """Mark running campaign as completed or cancelled"""
+        pool = await self.db_manager.get_pool()
+        async with pool.acquire() as conn:
+            result = await conn.execute("""
+                UPDATE broadcast_campaigns SET status = $1, finished_at = NOW(), updated_at = NOW()
+                WHERE id = $2 AND status = 'running'
+            """, status, campaign_id)
+            return result != "UPDATE 0"
@@ -1,12 +1,18 @@
-import requests
+import aiohttp
+import asyncio
 import json
 import logging
 import datetime
 from typing import Dict, List, Optional
 from dataclasses import dataclass
 
+from bot.pricing import pricing_service
+
 logger = logging.getLogger(__name__)
 
+# Fragment error codes worth retrying: TON network error, TON connection error, general TON/Telegram error
+TRANSIENT_ERROR_CODES = {"10", "12", "13"}
+
 @dataclass
 class FragmentProduct:
     """Fragment product model"""
@@ -32,14 +38,33 @@ class FragmentOrder:
     completed_at: Optional[str] = None
     show_sender: bool = False
 
+@dataclass
+class FragmentResponse:
+    """Buffered HTTP response from Fragment API"""
+    status_code: int
+    text: str
+    headers: Dict[str, str]
+    
+    def json(self):
+        """Decode response body as JSON"""
+        return json.loads(self.text)
+
 class FragmentAPI:
     """Fragment API client with JWT token authentication"""
     
-    def __init__(self, token: str = "", base_url: str = "https://api.fragment-api.com/v1", demo_mode: bool = False):
+    def __init__(self, token: str = "", base_url: str = "https://api.fragment-api.com/v1", demo_mode: bool = False,
+                 timeout: float = 15.0, order_timeout: float = 90.0, pool_size: int = 20):
         self.token = token.strip() if token else ""
         self.base_url = base_url
         self.demo_mode = demo_mode  # Don't auto-switch to demo mode
         
+        # HTTP transport: one keep-alive session shared by all calls, created lazily
+        # inside the running event loop
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.order_timeout = aiohttp.ClientTimeout(total=order_timeout)  # Orders wait for TON transaction
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        
         logger.info(f"FragmentAPI initialized: token={bool(self.token)}, demo_mode={self.demo_mode}")
         
         self.headers = {
@@ -85,127 +110,43 @@ class FragmentAPI:
             )
         ]
     
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Get shared HTTP session, create it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=connector,
+                timeout=self.timeout
+            )
+        return self._session
+    
+    async def _request(self, method: str, url: str, timeout: Optional[aiohttp.ClientTimeout] = None,
+                       **kwargs) -> FragmentResponse:
+        """Send request through the shared session and read the whole body"""
+        session = await self._get_session()
+        async with session.request(method, url, timeout=timeout or self.timeout, **kwargs) as response:
+            text = await response.text()
+            return FragmentResponse(
+                status_code=response.status,
+                text=text,
+                headers=dict(response.headers)
+            )
+    
+    async def close(self):
+        """Close HTTP session and release pooled connections"""
+        if self._session and not self._session.closed:
+            await self._session.close()
+            logger.info("Fragment API session closed")
+        self._session = None
+
     def _get_price_for_months(self, months: int) -> float:
-        """Get price for given number of months from database or fallback to default"""
-        try:
-            # Try to get price from database
-            import asyncio
-            from bot.database.connection import get_connection
-            from bot.database.repository import PremiumPricingRepository
-            from bot.config import Config
-            
-            config = Config()
-            
-            # Create event loop if none exists
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # Get price from database
-            async def get_db_price():
-                try:
-                    pool = await get_connection(config.database_url)
-                    pricing_repo = PremiumPricingRepository(pool)
-                    pricing = await pricing_repo.get_pricing_by_months(months)
-                    if pricing and pricing.is_active:
-                        return pricing.price_usd
-                except Exception as e:
-                    logger.error(f"Error getting price from database: {e}")
-                return None
-            
-            # Run async function
-            if loop.is_running():
-                # If loop is running, schedule the coroutine
-                future = asyncio.create_task(get_db_price())
-                # Wait for result (this might not work in all contexts)
-                try:
-                    price = loop.run_until_complete(future)
-                    if price is not None:
-                        return price
-                except:
-                    pass
-            else:
-                # If no loop is running, run the coroutine
-                price = loop.run_until_complete(get_db_price())
-                if price is not None:
-                    return price
-            
-        except Exception as e:
-            logger.error(f"Error in _get_price_for_months: {e}")
-        
-        # Fallback to default prices
-        if months == 3:
-            return 12.99
-        elif months == 9:
-            return 29.99
-        elif months == 12:
-            return 39.99
-        else:
-            return 12.99  # Default to 3 months price
+        """Get price for given number of months from the in-memory price list"""
+        return pricing_service.get_premium_price(months) or 0.0
 
     def _get_price_for_stars(self, stars_count: int) -> float:
-        """Get price for given number of stars from database or fallback to default"""
-        try:
-            # Try to get price from database
-            import asyncio
-            from bot.database.connection import get_connection
-            from bot.database.repository import StarsPricingRepository
-            from bot.config import Config
-            
-            config = Config()
-            
-            # Create event loop if none exists
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # Get price from database
-            async def get_db_price():
-                try:
-                    pool = await get_connection(config.database_url)
-                    pricing_repo = StarsPricingRepository(pool)
-                    pricing = await pricing_repo.get_pricing_by_stars(stars_count)
-                    if pricing and pricing.is_active:
-                        return pricing.price_usd
-                except Exception as e:
-                    logger.error(f"Error getting stars price from database: {e}")
-                return None
-            
-            # Run async function
-            if loop.is_running():
-                # If loop is running, schedule the coroutine
-                future = asyncio.create_task(get_db_price())
-                # Wait for result (this might not work in all contexts)
-                try:
-                    price = loop.run_until_complete(future)
-                    if price is not None:
-                        return price
-                except:
-                    pass
-            else:
-                # If no loop is running, run the coroutine
-                price = loop.run_until_complete(get_db_price())
-                if price is not None:
-                    return price
-            
-        except Exception as e:
-            logger.error(f"Error in _get_price_for_stars: {e}")
-        
-        # Fallback to default prices
-        if stars_count == 50:
-            return 1.00
-        elif stars_count == 100:
-            return 1.50
-        elif stars_count == 200:
-            return 2.50
-        elif stars_count == 500:
-            return 5.00
-        else:
-            return 1.00  # Default to 50 stars price
+        """Get price for given number of stars from the in-memory price list"""
+        return pricing_service.get_stars_price(stars_count) or 0.0
 
     async def test_authentication(self) -> bool:
         """Test API authentication using the auth endpoint"""
@@ -226,7 +167,7 @@ class FragmentAPI:
                 "api_key": self.token
             }
             
-            response = requests.post(auth_url, headers=self.headers, json=payload)
+            response = await self._request("POST", auth_url, json=payload)
             
             logger.info(f"Authentication test response status: {response.status_code}")
             logger.info(f"Authentication test response: {response.text}")
@@ -261,7 +202,7 @@ class FragmentAPI:
             # Let's try the orders endpoint which should require authentication
             test_url = f"{self.base_url}/orders"
             
-            response = requests.get(test_url, headers=self.headers)
+            response = await self._request("GET", test_url)
             
             logger.info(f"Connection test response status: {response.status_code}")
             logger.info(f"Connection test response: {response.text}")
@@ -316,9 +257,10 @@ class FragmentAPI:
             logger.info(f"Sending request to {self.base_url}/order/premium/ with payload: {payload}")
             logger.info(f"Using headers: {self.headers}")
             
-            response = requests.post(
-                f"{self.base_url}/order/premium/", 
-                headers=self.headers,
+            response = await self._request(
+                "POST",
+                f"{self.base_url}/order/premium/",
+                timeout=self.order_timeout,
                 json=payload
             )
             
@@ -345,9 +287,20 @@ class FragmentAPI:
             else:
                 # Handle different error codes
                 error_info = self._parse_error_response(response)
+                error_info["status_code"] = response.status_code
                 logger.error(f"API error: {response.status_code} - {error_info}")
                 return None, error_info
             
+        except aiohttp.ClientConnectorError as e:
+            # The connection was never established, so the order was not placed
+            logger.error(f"Could not connect to Fragment to create premium order: {e}")
+            error_info = {
+                "type": "connection_error",
+                "code": "connection_error",
+                "message": str(e),
+                "raw_response": str(e)
+            }
+            return None, error_info
         except Exception as e:
             logger.error(f"Error creating premium order: {e}")
             import traceback
@@ -396,9 +349,10 @@ class FragmentAPI:
             logger.info(f"Sending request to {self.base_url}/order/stars/ with payload: {payload}")
             logger.info(f"Using headers: {self.headers}")
             
-            response = requests.post(
-                f"{self.base_url}/order/stars/", 
-                headers=self.headers,
+            response = await self._request(
+                "POST",
+                f"{self.base_url}/order/stars/",
+                timeout=self.order_timeout,
                 json=payload
             )
             
@@ -425,9 +379,20 @@ class FragmentAPI:
             else:
                 # Handle different error codes
                 error_info = self._parse_error_response(response)
+                error_info["status_code"] = response.status_code
                 logger.error(f"API error: {response.status_code} - {error_info}")
                 return None, error_info
             
+        except aiohttp.ClientConnectorError as e:
+            # The connection was never established, so the order was not placed
+            logger.error(f"Could not connect to Fragment to create stars order: {e}")
+            error_info = {
+                "type": "connection_error",
+                "code": "connection_error",
+                "message": str(e),
+                "raw_response": str(e)
+            }
+            return None, error_info
         except Exception as e:
             logger.error(f"Error creating stars order: {e}")
             import traceback
@@ -576,6 +541,24 @@ class FragmentAPI:
         # Check for general indicators
         return any(indicator in message_lower for indicator in insufficient_indicators)
     
+    def is_transient_error(self, error_info: dict) -> bool:
+        """Check if the order can safely be retried.
+        
+        Order creation is not idempotent: timeouts, server errors and unreadable responses
+        may come back after the purchase went through, so only failed connections and
+        explicit TON error codes count as transient.
+        """
+        if error_info.get("type") == "connection_error":
+            return True
+        if error_info.get("type") == "exception":
+            return False
+        
+        if error_info["type"] == "multiple_errors":
+            codes = [str(error.get("code")) for error in error_info["errors"]]
+        else:
+            codes = [str(error_info.get("code"))]
+        return any(code in TRANSIENT_ERROR_CODES for code in codes)
+    
     def is_wallet_balance_error(self, error_info: dict) -> bool:
         """Check if the error is related to wallet balance"""
         if error_info["type"] == "multiple_errors":
@@ -590,13 +573,15 @@ class FragmentAPI:
             return "pending"
         
         try:
-            response = requests.get(f"{self.base_url}/orders/{order_id}", headers=self.headers)
-            response.raise_for_status()
+            response = await self._request("GET", f"{self.base_url}/orders/{order_id}")
+            if response.status_code != 200:
+                logger.error(f"Error fetching order status: {response.status_code} - {response.text}")
+                return None
             
             data = response.json()
             return data.get("status")
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"Error fetching order status: {e}")
             return None
     
@@ -606,8 +591,10 @@ class FragmentAPI:
             return []
         
         try:
-            response = requests.get(f"{self.base_url}/users/{user_id}/orders", headers=self.headers)
-            response.raise_for_status()
+            response = await self._request("GET", f"{self.base_url}/users/{user_id}/orders")
+            if response.status_code != 200:
+                logger.error(f"Error fetching user orders: {response.status_code} - {response.text}")
+                return []
             
             data = response.json()
             orders = []
@@ -628,7 +615,7 @@ class FragmentAPI:
             
             return orders
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"Error fetching user orders: {e}")
             return []
     
@@ -638,10 +625,33 @@ class FragmentAPI:
             return True
         
         try:
-            response = requests.delete(f"{self.base_url}/orders/{order_id}", headers=self.headers)
-            response.raise_for_status()
+            response = await self._request("DELETE", f"{self.base_url}/orders/{order_id}")
+            if response.status_code >= 400:
+                logger.error(f"Error canceling order: {response.status_code} - {response.text}")
+                return False
             return True
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"Error canceling order: {e}")
-            return False 
\ No newline at end of file
+            return False 
+
+
+# Global Fragment API client instance
+fragment_client: Optional[FragmentAPI] = None
+
+
+def get_fragment_api(token: str = "") -> FragmentAPI:
+    """Get shared Fragment API client instance"""
+    global fragment_client
+    if not fragment_client:
+        fragment_client = FragmentAPI(
+            token=token,
+            demo_mode=not bool(token and token.strip())
+        )
+    return fragment_client
+
+
+async def close_fragment_api():
+    """Close shared Fragment API client session"""
+    if fragment_client:
+        await fragment_client.close()
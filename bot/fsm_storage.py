@@ -0,0 +1,114 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot.database.connection import get_db_manager
+
+logger = logging.getLogger(__name__)
+
+
+def build_key(key: StorageKey, part: str) -> str:
+    """Storage key in the Redis storage format with bot id, so both backends agree"""
+    parts = ["fsm", str(key.bot_id), str(key.chat_id)]
+    if key.thread_id:
+        parts.append(str(key.thread_id))
+    parts.extend([str(key.user_id), key.destiny, part])
+    return ":".join(parts)
+
+
+class PostgresStorage(BaseStorage):
+    """FSM storage in the fsm_storage table.
+    
+    Mirrors the Redis storage: state and data are separate rows, every write resets the
+    row TTL and clearing deletes it. Reads skip expired rows, which are purged on write
+    at most once per purge_interval.
+    """
+    
+    def __init__(self, database_url: str, state_ttl: Optional[int] = None, purge_interval: int = 300):
+        self.database_url = database_url
+        self.state_ttl = state_ttl  # seconds, None never expires
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+    
+    async def _get_pool(self):
+        return await get_db_manager(self.database_url).get_pool()
+    
+    async def _get(self, storage_key: str) -> Optional[str]:
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            return await conn.fetchval("""
+                SELECT value FROM fsm_storage
+                WHERE key = $1 AND (expires_at IS NULL OR expires_at > NOW())
+            """, storage_key)
+    
+    async def _set(self, storage_key: str, value: Optional[str]):
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            if value is None:
+                await conn.execute("DELETE FROM fsm_storage WHERE key = $1", storage_key)
+            else:
+                await conn.execute("""
+                    INSERT INTO fsm_storage (key, value, expires_at, updated_at)
+                    VALUES ($1, $2, NOW() + $3::int * INTERVAL '1 second', NOW())
+                    ON CONFLICT (key) DO UPDATE SET
+                        value = EXCLUDED.value,
+                        expires_at = EXCLUDED.expires_at,
+                        updated_at = NOW()
+                """, storage_key, value, self.state_ttl)
+            
+            if self.state_ttl and time.monotonic() - self._last_purge >= self.purge_interval:
+                self._last_purge = time.monotonic()
+                result = await conn.execute("DELETE FROM fsm_storage WHERE expires_at <= NOW()")
+                logger.debug(f"Purged expired FSM records: {result}")
+    
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await self._set(build_key(key, "state"), value)
+    
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await self._get(build_key(key, "state"))
+    
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await self._set(build_key(key, "data"), json.dumps(data) if data else None)
+    
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        value = await self._get(build_key(key, "data"))
+        return json.loads(value) if value else {}
+    
+    async def close(self) -> None:
+        # The connection pool is shared with repositories and closed with them
+        pass
+
+
+def create_fsm_storage(config) -> BaseStorage:
+    """FSM storage selected by config.fsm_storage.
+    
+    memory keeps states in this process only. redis and postgres survive restarts and are
+    shared by bot replicas; there states idle longer than config.fsm_state_ttl expire.
+    """
+    state_ttl = config.fsm_state_ttl or None
+    
+    if config.fsm_storage == "redis":
+        # Imported here, redis is only required for this backend
+        from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+        
+        storage = RedisStorage.from_url(
+            config.redis_url,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=state_ttl,
+            data_ttl=state_ttl
+        )
+        logger.info(f"FSM storage: Redis, state TTL {state_ttl}s")
+        return storage
+    
+    if config.fsm_storage == "postgres":
+        logger.info(f"FSM storage: PostgreSQL, state TTL {state_ttl}s")
+        return PostgresStorage(config.database_url, state_ttl=state_ttl)
+    
+    logger.info("FSM storage: memory")
+    return MemoryStorage()
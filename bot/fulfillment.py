@@ -0,0 +1,307 @@
+import asyncio
+import html
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from bot.config import get_config
+from bot.database.models import Order
+from bot.database.repository import OrderRepository, FragmentOrderRepository
+from bot.fragment_api import get_fragment_api
+from bot.send_queue import send_queue, PRIORITY_PAYMENT, PRIORITY_ADMIN
+
+logger = logging.getLogger(__name__)
+
+
+def build_order_payload(user_id: int, service: str, quantity: int, username: str) -> str:
+    """Invoice payload for a Premium or Stars purchase paid by Crypto Pay"""
+    if service == "premium":
+        return f"user_{user_id}_premium_{quantity}m_{username}"
+    return f"user_{user_id}_stars_{quantity}_{username}"
+
+
+def parse_order_payload(payload: Optional[str]) -> Optional[Tuple[str, int, str]]:
+    """Parse invoice payload into (service, quantity, username), None for other payloads.
+    
+    Formats: user_{user_id}_premium_{months}m_{username} and user_{user_id}_stars_{count}_{username}.
+    The username is the tail, so underscores in it are kept.
+    """
+    if not payload:
+        return None
+    parts = payload.split("_", 4)
+    if len(parts) != 5 or parts[0] != "user" or parts[2] not in ("premium", "stars"):
+        return None
+    try:
+        quantity = int(parts[3].rstrip("m"))
+    except ValueError:
+        return None
+    return parts[2], quantity, parts[4]
+
+
+class FulfillmentManager:
+    """Buys queued orders on Fragment.
+    
+    The orders table is the queue: workers claim due orders with FOR UPDATE SKIP LOCKED,
+    so several workers and bot replicas can share it. Errors that prove the order was not
+    placed (failed connection, TON error codes) put it back with exponential backoff;
+    others and exhausted retries fail it for manual review, since retrying a purchase
+    that may have gone through would buy it twice.
+    
+    Placed Fragment orders are stored in fragment_orders, a status poller follows the
+    ones not in a final status, so order screens never have to call Fragment.
+    """
+    
+    def __init__(self):
+        self.running = False
+        self.workers = 4
+        self.max_attempts = 5
+        self.retry_delay = 30  # seconds before the first retry, doubled on each next one
+        self.poll_interval = 5  # seconds between queue checks when idle
+        self.stale_timeout = 600  # seconds an order may stay claimed before it counts as interrupted
+        self.stale_check_interval = 60  # seconds between sweeps for interrupted orders
+        self.status_poll_interval = 60  # seconds between status checks of one Fragment order
+        self.status_batch_size = 50  # Fragment orders checked per round
+        self.status_concurrency = 5  # concurrent status requests to Fragment
+        self._wakeup = asyncio.Event()
+        self._stop_event = asyncio.Event()
+        self._worker_tasks: List[asyncio.Task] = []
+    
+    def _get_config(self):
+        """Get current config snapshot"""
+        return get_config()
+    
+    async def start(self):
+        """Start fulfillment workers"""
+        if self.running:
+            return
+        self.running = True
+        self._stop_event.clear()
+        
+        config = self._get_config()
+        self.workers = config.order_workers
+        self.max_attempts = config.order_max_attempts
+        self.status_poll_interval = config.order_status_poll_interval
+        self.status_batch_size = config.order_status_batch_size
+        self.status_concurrency = config.order_status_concurrency
+        
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._worker_tasks.append(asyncio.create_task(self._status_poller()))
+        self._worker_tasks.append(asyncio.create_task(self._stale_sweeper()))
+        logger.info(f"Order fulfillment started with {self.workers} workers")
+    
+    async def stop(self):
+        """Stop workers after their current order"""
+        self.running = False
+        self._wakeup.set()
+        self._stop_event.set()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+    
+    def notify(self):
+        """Wake idle workers, call after queueing an order"""
+        self._wakeup.set()
+    
+    async def _worker(self):
+        config = self._get_config()
+        order_repo = OrderRepository(config.database_url)
+        
+        while self.running:
+            try:
+                orders = await order_repo.claim_orders(1)
+            except Exception as e:
+                logger.error(f"Error claiming orders: {e}")
+                orders = []
+            
+            if not orders:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            for order in orders:
+                await self._process_order(order, order_repo)
+    
+    async def _process_order(self, order: Order, order_repo: OrderRepository):
+        """Buy one claimed order and record the outcome"""
+        logger.info(f"Processing order {order.id} (attempt {order.attempts}): "
+                    f"{order.service} {order.quantity} for @{order.recipient}")
+        
+        try:
+            config = self._get_config()
+            fragment_api = get_fragment_api(config.token_fragment)
+            
+            if order.service == "premium":
+                fragment_order, error_info = await fragment_api.create_premium_order(
+                    order.recipient, order.quantity, show_sender=False)
+            else:
+                fragment_order, error_info = await fragment_api.create_stars_order(
+                    order.recipient, order.quantity, show_sender=False)
+            
+            if fragment_order:
+                await order_repo.complete_order(order.id, fragment_order)
+                logger.info(f"Order {order.id} fulfilled, Fragment order {fragment_order.id}")
+                await self._send_success_notification(order, fragment_order)
+                await self._notify_admins_order_completed(order, fragment_order)
+                return
+            
+            error_text = fragment_api.get_error_message(error_info, "en")
+            if fragment_api.is_transient_error(error_info) and order.attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (order.attempts - 1)
+                await order_repo.retry_order(order.id, error_text, delay)
+                logger.warning(f"Order {order.id} failed with transient error, retrying in {delay}s: {error_text}")
+                return
+            
+            if error_info.get("type") == "exception" or error_info.get("status_code", 0) >= 500:
+                # No clear answer from Fragment, the purchase may have gone through
+                error_text = f"Outcome unknown, check Fragment before refunding: {error_text}"
+            await order_repo.fail_order(order.id, error_text)
+            logger.error(f"Order {order.id} failed: {error_text}")
+            await self._send_error_notification(order, fragment_api.get_error_message(error_info, "ru"))
+            await self._notify_admins_order_failed(order, error_text)
+        
+        except Exception as e:
+            # Leave the order claimed, the stale order sweep fails it for manual review
+            logger.error(f"Error processing order {order.id}: {e}")
+            import traceback
+            logger.error(f"Traceback: {traceback.format_exc()}")
+    
+    async def _status_poller(self):
+        """Refresh status of open Fragment orders in bounded batches"""
+        config = self._get_config()
+        fragment_order_repo = FragmentOrderRepository(config.database_url)
+        semaphore = asyncio.Semaphore(self.status_concurrency)
+        
+        async def check(fragment_api, record):
+            async with semaphore:
+                return record.id, await fragment_api.get_order_status(record.id)
+        
+        while self.running:
+            batch_full = False
+            try:
+                fragment_api = get_fragment_api(self._get_config().token_fragment)
+                if not fragment_api.demo_mode:
+                    records = await fragment_order_repo.get_open_orders(self.status_batch_size,
+                                                                        self.status_poll_interval)
+                    if records:
+                        statuses = await asyncio.gather(*[check(fragment_api, record) for record in records])
+                        await fragment_order_repo.update_statuses(statuses)
+                        changed = sum(1 for record, (_, status) in zip(records, statuses)
+                                      if status and status != record.status)
+                        logger.info(f"Checked {len(records)} Fragment orders, {changed} changed status")
+                    batch_full = len(records) == self.status_batch_size
+            except Exception as e:
+                logger.error(f"Error refreshing Fragment order statuses: {e}")
+            
+            # A full batch means more orders are due, continue right away
+            if not batch_full:
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=self.status_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _stale_sweeper(self):
+        """Sweep for interrupted orders on a fixed interval, busy workers never skip it"""
+        while self.running:
+            await self._fail_stale_orders()
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=self.stale_check_interval)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _fail_stale_orders(self):
+        """Fail orders left claimed by a crashed worker and tell admins"""
+        try:
+            config = self._get_config()
+            order_repo = OrderRepository(config.database_url)
+            for order in await order_repo.fail_stale_orders(self.stale_timeout):
+                logger.error(f"Order {order.id} was interrupted during processing, marked failed")
+                await self._notify_admins_order_failed(order, order.last_error)
+        except Exception as e:
+            logger.error(f"Error failing stale orders: {e}")
+    
+    def _describe(self, order: Order) -> str:
+        """Service line for notifications"""
+        if order.service == "premium":
+            return f"Telegram Premium, {order.quantity} месяцев"
+        return f"Telegram Stars, {order.quantity} звезд"
+    
+    async def _send_user_message(self, order: Order, message_text: str):
+        """Queue notification to order owner"""
+        if not order.telegram_id:
+            logger.warning(f"telegram_id unknown for order {order.id}, notification skipped")
+            return
+        send_queue.enqueue(order.telegram_id, message_text, PRIORITY_PAYMENT, parse_mode="HTML")
+    
+    async def _send_success_notification(self, order: Order, fragment_order):
+        """Tell user the order was fulfilled"""
+        message_text = (
+            f"🎉 <b>Заказ #{order.id} выполнен!</b>\n\n"
+            f"📱 <b>Услуга:</b> {self._describe(order)}\n"
+            f"👤 <b>Для аккаунта:</b> @{order.recipient}\n"
+            f"💰 <b>Сумма:</b> ${order.amount_usd:.2f}\n"
+            f"🆔 <b>ID заказа Fragment:</b> {fragment_order.id}"
+        )
+        await self._send_user_message(order, message_text)
+    
+    async def _send_error_notification(self, order: Order, error_message: str):
+        """Tell user the order could not be fulfilled"""
+        message_text = (
+            f"❌ <b>Не удалось выполнить заказ #{order.id}</b>\n\n"
+            f"📱 <b>Услуга:</b> {self._describe(order)}\n"
+            f"👤 <b>Для аккаунта:</b> @{order.recipient}\n"
+            f"💰 <b>Сумма:</b> ${order.amount_usd:.2f}\n"
+            f"🚫 <b>Ошибка:</b> {html.escape(error_message)}\n\n"
+            f"💡 <b>Что делать:</b>\n"
+            f"• Обратитесь в поддержку\n"
+            f"• Укажите номер заказа: {order.id}\n"
+            f"• Деньги будут возвращены"
+        )
+        await self._send_user_message(order, message_text)
+    
+    async def _notify_admins(self, admin_message: str):
+        """Queue message to every admin"""
+        config = self._get_config()
+        for admin_id in config.admin_ids:
+            send_queue.enqueue(admin_id, admin_message, PRIORITY_ADMIN, parse_mode="HTML")
+    
+    async def _notify_admins_order_completed(self, order: Order, fragment_order):
+        """Notify admins about fulfilled order"""
+        await self._notify_admins(
+            f"🎉 <b>Заказ #{order.id} выполнен</b>\n\n"
+            f"👤 <b>Пользователь:</b> {order.user_id}\n"
+            f"📱 <b>Услуга:</b> {self._describe(order)}\n"
+            f"👤 <b>Для аккаунта:</b> @{order.recipient}\n"
+            f"💰 <b>Сумма:</b> ${order.amount_usd:.2f} ({order.source})\n"
+            f"🆔 <b>Fragment ID:</b> {fragment_order.id}\n"
+            f"💳 <b>Счет:</b> {order.invoice_id or '-'}\n"
+            f"⏰ <b>Время:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+        )
+    
+    async def _notify_admins_order_failed(self, order: Order, error_text: str):
+        """Notify admins about order that needs manual handling"""
+        await self._notify_admins(
+            f"🚨 <b>Заказ #{order.id} не выполнен</b>\n\n"
+            f"👤 <b>Пользователь:</b> {order.user_id}\n"
+            f"📱 <b>Услуга:</b> {self._describe(order)}\n"
+            f"👤 <b>Для аккаунта:</b> @{order.recipient}\n"
+            f"💰 <b>Сумма:</b> ${order.amount_usd:.2f} ({order.source})\n"
+            f"💳 <b>Счет:</b> {order.invoice_id or '-'}\n"
+            f"🔁 <b>Попыток:</b> {order.attempts}\n"
+            f"🚫 <b>Ошибка:</b> {html.escape(error_text or '-')}"
+        )
+
+
+# Global fulfillment manager instance
+fulfillment_manager = FulfillmentManager()
+
+
+async def start_fulfillment():
+    """Start order fulfillment workers"""
+    await fulfillment_manager.start()
+
+
+async def stop_fulfillment():
+    """Stop order fulfillment workers"""
+    await fulfillment_manager.stop()
@@ -6,9 +6,13 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from bot.database import UserRepository, MessageRepository, PremiumPricingRepository
+from bot.database import UserRepository, MessageRepository, BroadcastCampaignRepository
+from bot.database.cache import user_cache
 from bot.config import Config
 from bot.locales.translations import get_text
+from bot.send_queue import send_queue, PRIORITY_ADMIN
+from bot.broadcast import broadcast_manager, format_campaign_progress, campaign_progress_keyboard
+from bot.pricing import pricing_service
 
 
 logger = logging.getLogger(__name__)
@@ -22,11 +26,7 @@ async def notify_admins(bot, message: str, config: Config):
         return
     
     for admin_id in config.admin_ids:
-        try:
-            await bot.send_message(admin_id, message, parse_mode="HTML")
-            logger.info(f"Admin notification sent to {admin_id}")
-        except Exception as e:
-            logger.error(f"Failed to send admin notification to {admin_id}: {e}")
+        send_queue.enqueue(admin_id, message, PRIORITY_ADMIN, parse_mode="HTML")
 
 
 class AdminStates(StatesGroup):
@@ -49,16 +49,13 @@ class AdminStates(StatesGroup):
 
 def is_admin(user_id: int, config: Config) -> bool:
     """Check if user is admin"""
-    is_admin_user = user_id in config.admin_ids
-    logger.info(f"Admin check for user {user_id}: {is_admin_user} (admin_ids: {config.admin_ids})")
-    return is_admin_user
+    return user_id in config.admin_ids
 
 
 @router.message(Command("admin"))
-async def cmd_admin(message: Message):
+async def cmd_admin(message: Message, config: Config):
     """Handle /admin command"""
     logger.info(f"Admin command received from user {message.from_user.id}")
-    config = Config()
     
     if not is_admin(message.from_user.id, config):
         logger.warning(f"Access denied for user {message.from_user.id}")
@@ -86,12 +83,9 @@ async def cmd_admin(message: Message):
 
 
 @router.callback_query(F.data == "admin_stats")
-async def admin_stats_callback(callback: CallbackQuery):
+async def admin_stats_callback(callback: CallbackQuery, config: Config, user_repo: UserRepository,
+                               message_repo: MessageRepository):
     """Handle admin stats button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    message_repo = MessageRepository(config.database_url)
-    
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
         return
@@ -111,6 +105,12 @@ async def admin_stats_callback(callback: CallbackQuery):
             orders=0     # No orders in this version
         )
         
+        cache_stats = user_cache.stats()
+        stats_text += (
+            f"\n\n🗄 <b>Кэш пользователей:</b> {cache_stats['hit_rate']:.0%} попаданий "
+            f"({cache_stats['hits']} / {cache_stats['misses']} промахов, {cache_stats['size']} записей)"
+        )
+        
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=get_text("btn_back", "ru"), callback_data="admin_back")]
         ])
@@ -129,9 +129,8 @@ async def admin_stats_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "admin_users")
-async def admin_users_callback(callback: CallbackQuery):
+async def admin_users_callback(callback: CallbackQuery, config: Config):
     """Handle admin users button"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
@@ -153,9 +152,8 @@ async def admin_users_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "admin_find_user")
-async def admin_find_user_callback(callback: CallbackQuery, state: FSMContext):
+async def admin_find_user_callback(callback: CallbackQuery, state: FSMContext, config: Config):
     """Handle find user button"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
@@ -170,9 +168,9 @@ async def admin_find_user_callback(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(AdminStates.waiting_for_user_id)
-async def handle_user_id_input(message: Message, state: FSMContext):
+async def handle_user_id_input(message: Message, state: FSMContext, config: Config,
+                               user_repo: UserRepository):
     """Handle user ID input"""
-    config = Config()
     
     if not is_admin(message.from_user.id, config):
         await message.answer("Доступ запрещен")
@@ -185,7 +183,6 @@ async def handle_user_id_input(message: Message, state: FSMContext):
         await message.answer("❌ Неверный формат ID. Введите число.")
         return
     
-    user_repo = UserRepository(config.database_url)
     user = await user_repo.get_user_by_telegram_id(user_id)
     
     if not user:
@@ -225,26 +222,25 @@ async def handle_user_id_input(message: Message, state: FSMContext):
 
 
 @router.callback_query(F.data == "admin_premium_pricing")
-async def admin_premium_pricing_callback(callback: CallbackQuery):
+async def admin_premium_pricing_callback(callback: CallbackQuery, config: Config):
     """Handle admin premium pricing button"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
         return
     
-    pricing_repo = PremiumPricingRepository(config.database_url)
-    pricing_list = await pricing_repo.get_all_pricing()
+    # Reload so prices changed in the database show up here and in the bot right away
+    await pricing_service.refresh()
     
     pricing_text = "⭐ <b>Управление ценами Premium</b>\n\n"
     keyboard_buttons = []
     
-    for pricing in pricing_list:
-        pricing_text += f"📅 <b>{pricing.months} месяцев:</b> ${pricing.price_usd}\n"
+    for months, price in pricing_service.get_premium_options():
+        pricing_text += f"📅 <b>{months} месяцев:</b> ${price:.2f}\n"
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=f"✏️ {pricing.months} месяцев",
-                callback_data=f"admin_edit_premium_{pricing.months}"
+                text=f"✏️ {months} месяцев",
+                callback_data=f"admin_edit_premium_{months}"
             )
         ])
     
@@ -260,9 +256,8 @@ async def admin_premium_pricing_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "admin_broadcast")
-async def admin_broadcast_callback(callback: CallbackQuery, state: FSMContext):
+async def admin_broadcast_callback(callback: CallbackQuery, state: FSMContext, config: Config):
     """Handle admin broadcast button"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
@@ -277,9 +272,8 @@ async def admin_broadcast_callback(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(AdminStates.waiting_for_broadcast_text)
-async def handle_broadcast_text(message: Message, state: FSMContext):
+async def handle_broadcast_text(message: Message, state: FSMContext, config: Config):
     """Handle broadcast text input"""
-    config = Config()
     
     if not is_admin(message.from_user.id, config):
         await message.answer("Доступ запрещен")
@@ -303,9 +297,9 @@ async def handle_broadcast_text(message: Message, state: FSMContext):
 
 
 @router.callback_query(F.data == "admin_broadcast_confirm")
-async def admin_broadcast_confirm_callback(callback: CallbackQuery, state: FSMContext):
+async def admin_broadcast_confirm_callback(callback: CallbackQuery, state: FSMContext, config: Config,
+                                           campaign_repo: BroadcastCampaignRepository):
     """Handle broadcast confirmation"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
@@ -318,32 +312,39 @@ async def admin_broadcast_confirm_callback(callback: CallbackQuery, state: FSMCo
         await callback.answer("Ошибка: текст сообщения не найден")
         return
     
-    # Send broadcast to all users
-    user_repo = UserRepository(config.database_url)
-    users = await user_repo.get_all_users()
-    
-    sent_count = 0
-    for user in users:
-        try:
-            await callback.bot.send_message(user.telegram_id, broadcast_text, parse_mode="HTML")
-            sent_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send broadcast to user {user.telegram_id}: {e}")
-    
-
+    # Campaign is persisted and delivered in the background, this message shows its progress
+    campaign = await campaign_repo.create_campaign(broadcast_text, callback.message.chat.id)
     
     await callback.message.edit_text(
-        f"✅ <b>Сообщение отправлено!</b>\n\n📤 Отправлено пользователям: {sent_count}\n📝 Текст: {broadcast_text[:100]}{'...' if len(broadcast_text) > 100 else ''}",
+        format_campaign_progress(campaign),
+        reply_markup=campaign_progress_keyboard(campaign),
         parse_mode="HTML"
     )
+    campaign.progress_message_id = callback.message.message_id
+    await campaign_repo.set_progress_message(campaign.id, campaign.progress_message_id)
     
+    broadcast_manager.start_campaign(campaign)
     await state.clear()
 
 
+@router.callback_query(F.data.startswith("admin_broadcast_cancel_"))
+async def admin_broadcast_cancel_callback(callback: CallbackQuery, config: Config):
+    """Handle broadcast campaign cancel button"""
+    
+    if not is_admin(callback.from_user.id, config):
+        await callback.answer("Доступ запрещен")
+        return
+    
+    campaign_id = int(callback.data.split("_")[-1])
+    if await broadcast_manager.cancel_campaign(campaign_id):
+        await callback.answer("Рассылка будет остановлена")
+    else:
+        await callback.answer("Рассылка уже завершена")
+
+
 @router.callback_query(F.data == "admin_back")
-async def admin_back_callback(callback: CallbackQuery):
+async def admin_back_callback(callback: CallbackQuery, config: Config):
     """Handle admin back button"""
-    config = Config()
     
     if not is_admin(callback.from_user.id, config):
         await callback.answer("Доступ запрещен")
@@ -5,9 +5,13 @@ from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKe
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from bot.database import UserRepository, ChatRepository, MessageRepository, PremiumPricingRepository, UserBalanceRepository
+from bot.database import User, Chat, Order, UserRepository, MessageRepository, UserBalanceRepository, OrderRepository, CryptoPayInvoiceRepository
 from bot.config import Config
-from bot.locales.translations import get_text
+from bot.crypto_pay_api import get_crypto_pay_api
+from bot.background_tasks import background_manager
+from bot.fulfillment import fulfillment_manager, build_order_payload
+from bot.pricing import pricing_service
+from bot.locales.translations import TRANSLATIONS, get_text
 
 
 def get_main_menu_keyboard(user_language: str) -> InlineKeyboardMarkup:
@@ -33,6 +37,23 @@ logger = logging.getLogger(__name__)
 router = Router()
 
 
+async def save_crypto_pay_invoice(config: Config, invoice_repo: CryptoPayInvoiceRepository, user_id: int,
+                                  invoice: dict, amount: float, payload: str):
+    """Save created Crypto Pay invoice and schedule its payment checks right away"""
+    db_invoice = await invoice_repo.create_invoice(
+        invoice_id=str(invoice["invoice_id"]),
+        user_id=user_id,
+        amount_usd=amount,
+        amount_crypto=float(invoice.get("amount") or amount),
+        asset=invoice.get("asset") or "USDT",
+        payload=payload,
+        crypto_pay_url=invoice.get("pay_url"),
+        expires_in=config.invoice_expires_in
+    )
+    background_manager.schedule_invoice(db_invoice)
+    return db_invoice
+
+
 class FragmentStates(StatesGroup):
     """States for Fragment operations"""
     waiting_for_username = State()
@@ -45,35 +66,9 @@ class DepositStates(StatesGroup):
 
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, user: User, is_new_user: bool = False):
     """Handle /start command"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    chat_repo = ChatRepository(config.database_url)
-    
-    # Get or create user
-    user = await user_repo.get_user_by_telegram_id(message.from_user.id)
-    is_new_user = False
-    
-    if not user:
-        user = await user_repo.create_user(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name,
-            language="ru"  # Default language
-        )
-        is_new_user = True
-    
-    # Get or create chat
-    chat = await chat_repo.get_chat_by_telegram_id(message.chat.id)
-    if not chat:
-        chat = await chat_repo.create_chat(
-            telegram_id=message.chat.id,
-            chat_type=message.chat.type,
-            title=message.chat.title,
-            username=message.chat.username
-        )
+    # User and chat are upserted by DatabaseMiddleware
     
     # Create main menu keyboard
     keyboard = get_main_menu_keyboard(user.language)
@@ -90,16 +85,8 @@ async def cmd_start(message: Message, state: FSMContext):
 
 
 @router.callback_query(F.data == "main_menu")
-async def main_menu_callback(callback: CallbackQuery):
+async def main_menu_callback(callback: CallbackQuery, user: User):
     """Handle main menu button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     keyboard = get_main_menu_keyboard(user.language)
     
     await callback.message.edit_text(
@@ -110,20 +97,13 @@ async def main_menu_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "profile")
-async def profile_callback(callback: CallbackQuery):
+async def profile_callback(callback: CallbackQuery, user: User, balance_repo: UserBalanceRepository,
+                           order_repo: OrderRepository):
     """Handle profile button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    balance_repo = UserBalanceRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     # Get user balance
     balance = await balance_repo.get_user_balance(user.id)
     balance_amount = balance.balance_usd if balance else 0.0
+    orders_count = await order_repo.count_user_orders(user.id)
     
     # Format profile text
     profile_text = get_text("profile_title", user.language).format(
@@ -134,12 +114,13 @@ async def profile_callback(callback: CallbackQuery):
         created_at=user.created_at.strftime("%d.%m.%Y") if user.created_at else "Неизвестно",
         status="Активен" if user.is_active else "Неактивен",
         balance=f"${balance_amount:.2f}",
-        orders="0",  # No orders in this version
+        orders=str(orders_count),
         rating="⭐"  # Default rating
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=get_text("btn_deposit_balance", user.language), callback_data="deposit_balance")],
+        [InlineKeyboardButton(text=get_text("btn_my_orders", user.language), callback_data="my_orders")],
         [InlineKeyboardButton(text=get_text("btn_change_language", user.language), callback_data="change_language")],
         [InlineKeyboardButton(text=get_text("btn_main_menu", user.language), callback_data="main_menu")]
     ])
@@ -151,17 +132,70 @@ async def profile_callback(callback: CallbackQuery):
     )
 
 
-@router.callback_query(F.data == "deposit_balance")
-async def deposit_balance_callback(callback: CallbackQuery, state: FSMContext):
-    """Handle deposit balance button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
+def format_order_service(order: Order, language: str) -> str:
+    """Service description of order"""
+    return get_text(f"order_{order.service}", language, quantity=order.quantity)
+
+
+def format_order_status(order: Order, language: str) -> str:
+    """Order status, Fragment's status once the order was placed there"""
+    status = order.fragment_status or order.status
+    if f"order_status_{status}" in TRANSLATIONS["ru"]:
+        return get_text(f"order_status_{status}", language)
+    return status
+
+
+@router.callback_query(F.data == "my_orders")
+async def my_orders_callback(callback: CallbackQuery, user: User, order_repo: OrderRepository):
+    """Handle order history button, served from the local orders tables"""
+    orders = await order_repo.get_user_orders(user.id, limit=10)
+    
+    keyboard_buttons = [
+        [InlineKeyboardButton(
+            text=f"#{order.id} · {format_order_service(order, user.language)} · {format_order_status(order, user.language)}",
+            callback_data=f"my_order_{order.id}"
+        )]
+        for order in orders
+    ]
+    keyboard_buttons.append([InlineKeyboardButton(text=get_text("btn_back", user.language), callback_data="profile")])
     
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
+    await callback.message.edit_text(
+        get_text("orders_title" if orders else "orders_empty", user.language),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard_buttons),
+        parse_mode="HTML"
+    )
+
+
+@router.callback_query(F.data.startswith("my_order_"))
+async def my_order_callback(callback: CallbackQuery, user: User, order_repo: OrderRepository):
+    """Handle order status screen"""
+    order = await order_repo.get_user_order(user.id, int(callback.data.split("_")[2]))
+    if not order:
+        await callback.answer("Заказ не найден")
         return
     
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=get_text("btn_back", user.language), callback_data="my_orders")]
+    ])
+    
+    await callback.message.edit_text(
+        get_text(
+            "order_details", user.language,
+            id=order.id,
+            service=format_order_service(order, user.language),
+            recipient=order.recipient,
+            amount=f"{order.amount_usd:.2f}",
+            created_at=order.created_at.strftime("%d.%m.%Y %H:%M") if order.created_at else "-",
+            status=format_order_status(order, user.language)
+        ),
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+
+
+@router.callback_query(F.data == "deposit_balance")
+async def deposit_balance_callback(callback: CallbackQuery, state: FSMContext, user: User):
+    """Handle deposit balance button"""
     # Set state for amount input
     await state.set_state(DepositStates.waiting_for_amount)
     
@@ -179,18 +213,10 @@ async def deposit_balance_callback(callback: CallbackQuery, state: FSMContext):
     )
 
 
-@router.message(DepositStates.waiting_for_amount)
-async def handle_deposit_amount(message: Message, state: FSMContext):
+@router.message(DepositStates.waiting_for_amount, flags={"throttling": "expensive"})
+async def handle_deposit_amount(message: Message, state: FSMContext, user: User, config: Config,
+                                invoice_repo: CryptoPayInvoiceRepository):
     """Handle deposit amount input"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(message.from_user.id)
-    if not user:
-        await message.answer("Ошибка: пользователь не найден")
-        await state.clear()
-        return
-    
     try:
         amount = float(message.text)
         if amount < 1.0 or amount > 1000.0:
@@ -204,18 +230,18 @@ async def handle_deposit_amount(message: Message, state: FSMContext):
         await state.update_data(deposit_amount=amount)
         
         # Create payment invoice using Crypto Pay API
-        from bot.crypto_pay_api import CryptoPayAPI
-        
-        crypto_api = CryptoPayAPI(config.crypto_pay_token, config.crypto_pay_testnet)
+        crypto_api = get_crypto_pay_api(config.crypto_pay_token, config.crypto_pay_testnet)
         
         # Create invoice
+        payload = f"deposit_{user.id}_{int(amount * 100)}"
         invoice = await crypto_api.create_invoice(
             amount=amount,
             asset="USDT",
             currency_type="fiat",
             fiat="USD",
             description=f"Пополнение баланса для @{user.username or user.telegram_id}",
-            payload=f"deposit_{user.id}_{int(amount * 100)}"
+            payload=payload,
+            expires_in=config.invoice_expires_in
         )
         
         if not invoice:
@@ -227,6 +253,9 @@ async def handle_deposit_amount(message: Message, state: FSMContext):
             await state.clear()
             return
         
+        await save_crypto_pay_invoice(config, invoice_repo, user.id, invoice, amount, payload)
+        await state.clear()
+        
         # Show payment information
         payment_url = invoice.get("pay_url")
         
@@ -239,7 +268,7 @@ async def handle_deposit_amount(message: Message, state: FSMContext):
         await message.answer(
             get_text("deposit_invoice_created", user.language) + "\n\n" +
             get_text("deposit_amount", user.language, amount=f"{amount:.2f}") + "\n" +
-            get_text("deposit_expires", user.language) + "\n\n" +
+            get_text("deposit_expires", user.language, minutes=config.invoice_expires_in // 60) + "\n\n" +
             get_text("deposit_instructions", user.language) + "\n\n" +
             get_text("deposit_important", user.language),
             reply_markup=keyboard,
@@ -265,16 +294,8 @@ async def handle_deposit_amount(message: Message, state: FSMContext):
 
 
 @router.callback_query(F.data == "help")
-async def help_callback(callback: CallbackQuery):
+async def help_callback(callback: CallbackQuery, user: User):
     """Handle help button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text=get_text("btn_support", user.language), callback_data="support"),
@@ -292,16 +313,8 @@ async def help_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "support")
-async def support_callback(callback: CallbackQuery):
+async def support_callback(callback: CallbackQuery, user: User):
     """Handle support button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=get_text("btn_change_language", user.language), callback_data="change_language")],
         [InlineKeyboardButton(text=get_text("btn_main_menu", user.language), callback_data="main_menu")]
@@ -315,16 +328,8 @@ async def support_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "faq")
-async def faq_callback(callback: CallbackQuery):
+async def faq_callback(callback: CallbackQuery, user: User):
     """Handle FAQ button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=get_text("btn_change_language", user.language), callback_data="change_language")],
         [InlineKeyboardButton(text=get_text("btn_main_menu", user.language), callback_data="main_menu")]
@@ -339,26 +344,14 @@ async def faq_callback(callback: CallbackQuery):
 
 # Fragment Premium handlers
 @router.callback_query(F.data == "fragment_premium")
-async def fragment_premium_callback(callback: CallbackQuery):
+async def fragment_premium_callback(callback: CallbackQuery, user: User):
     """Handle Fragment Premium button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    pricing_repo = PremiumPricingRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
-    # Get available pricing
-    pricing_list = await pricing_repo.get_all_pricing()
-    
     keyboard_buttons = []
-    for pricing in pricing_list:
+    for months, price in pricing_service.get_premium_options():
         keyboard_buttons.append([
             InlineKeyboardButton(
-                text=get_text("premium_months", user.language, months=pricing.months, price=f"{pricing.price_usd:.2f}"),
-                callback_data=f"premium_{pricing.months}"
+                text=get_text("premium_months", user.language, months=months, price=f"{price:.2f}"),
+                callback_data=f"premium_{months}"
             )
         ])
     
@@ -375,33 +368,26 @@ async def fragment_premium_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("premium_"))
-async def premium_months_callback(callback: CallbackQuery, state: FSMContext):
+async def premium_months_callback(callback: CallbackQuery, state: FSMContext, user: User,
+                                  balance_repo: UserBalanceRepository):
     """Handle premium months selection"""
     months = int(callback.data.split("_")[1])
     
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    pricing_repo = PremiumPricingRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     # Get price for selected months
-    price = await pricing_repo.get_price_for_months(months)
+    price = pricing_service.get_premium_price(months)
     if not price:
         await callback.answer("Ошибка: цена не найдена")
         return
     
     # Check user balance
-    balance_repo = UserBalanceRepository(config.database_url)
     balance = await balance_repo.get_user_balance(user.id)
     current_balance = balance.balance_usd if balance else 0.0
     
-    # Store months and balance info in state
+    # Store months and balance info in state, dropping a previously selected stars count
     await state.update_data(
         fragment_months=months, 
+        fragment_stars_count=None,
+        required_amount=None,
         fragment_price=price,
         user_balance=current_balance,
         has_sufficient_balance=(current_balance >= price)
@@ -424,23 +410,10 @@ async def premium_months_callback(callback: CallbackQuery, state: FSMContext):
 
 # Fragment Stars handlers
 @router.callback_query(F.data == "fragment_stars")
-async def fragment_stars_callback(callback: CallbackQuery):
+async def fragment_stars_callback(callback: CallbackQuery, user: User):
     """Handle Fragment Stars button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
-    # Define available stars options
-    stars_options = [50, 100, 200, 500]
-    
     keyboard_buttons = []
-    for stars in stars_options:
-        # Calculate price (you can adjust these prices)
-        price = stars * 0.01  # $0.01 per star
+    for stars, price in pricing_service.get_stars_options():
         keyboard_buttons.append([
             InlineKeyboardButton(
                 text=get_text("stars_count", user.language, count=stars, price=f"{price:.2f}"),
@@ -461,22 +434,17 @@ async def fragment_stars_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("stars_"))
-async def stars_count_callback(callback: CallbackQuery, state: FSMContext):
+async def stars_count_callback(callback: CallbackQuery, state: FSMContext, user: User,
+                               balance_repo: UserBalanceRepository):
     """Handle stars count selection"""
     stars_count = int(callback.data.split("_")[1])
     
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    balance_repo = UserBalanceRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
+    # Get price for selected stars count
+    required_amount = pricing_service.get_stars_price(stars_count)
+    if not required_amount:
+        await callback.answer("Ошибка: цена не найдена")
         return
     
-    # Calculate required amount
-    required_amount = stars_count * 0.01  # $0.01 per star
-    
     try:
         # Check user balance
         balance = await balance_repo.get_user_balance(user.id)
@@ -490,6 +458,7 @@ async def stars_count_callback(callback: CallbackQuery, state: FSMContext):
             required_amount=required_amount,
             has_sufficient_balance=(current_balance >= required_amount),
             fragment_stars_count=stars_count,
+            fragment_months=None,  # Drop a previously selected Premium option
             fragment_price=required_amount  # Add this for consistency with premium
         )
         
@@ -500,7 +469,7 @@ async def stars_count_callback(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer("⚠️ Ошибка проверки баланса, но можно продолжить")
         
         # Store stars count in state even if balance check fails
-        await state.update_data(fragment_stars_count=stars_count)
+        await state.update_data(fragment_stars_count=stars_count, fragment_months=None)
         logger.info(f"Stored {stars_count} stars in FSM state after balance check error")
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -518,17 +487,12 @@ async def stars_count_callback(callback: CallbackQuery, state: FSMContext):
     await state.set_state(FragmentStates.waiting_for_username)
 
 
-@router.message(lambda message: message.text and not message.text.startswith('/'))
-async def handle_fragment_username(message: Message, state: FSMContext):
+@router.message(FragmentStates.waiting_for_username,
+                lambda message: message.text and not message.text.startswith('/'),
+                flags={"throttling": "expensive"})
+async def handle_fragment_username(message: Message, state: FSMContext, user: User,
+                                   order_repo: OrderRepository):
     """Handle username input for Fragment operations"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(message.from_user.id)
-    if not user:
-        await message.answer("Ошибка: пользователь не найден")
-        return
-    
     # Get data from state
     state_data = await state.get_data()
     fragment_months = state_data.get('fragment_months')
@@ -549,58 +513,62 @@ async def handle_fragment_username(message: Message, state: FSMContext):
         await message.answer(get_text("fragment_invalid_username", user.language))
         return
     
-    # Check user balance before creating order
-    balance_repo = UserBalanceRepository(config.database_url)
-    balance = await balance_repo.get_user_balance(user.id)
-    current_balance = balance.balance_usd if balance else 0.0
-    
+    # The price always comes from the current price list, never from state
     if fragment_months:
         # Premium subscription
-        required_amount = state_data.get('fragment_price', 0)
+        service_key, quantity = "premium", fragment_months
+        required_amount = pricing_service.get_premium_price(fragment_months)
         service_type = "Telegram Premium"
         service_details = f"{fragment_months} месяцев"
         logger.info(f"Processing PREMIUM: {fragment_months} months, price: ${required_amount}")
     else:
         # Stars
-        required_amount = state_data.get('required_amount', 0)
+        service_key, quantity = "stars", fragment_stars_count
+        required_amount = pricing_service.get_stars_price(fragment_stars_count)
         service_type = "Telegram Stars"
         service_details = f"{fragment_stars_count} звезд"
         logger.info(f"Processing STARS: {fragment_stars_count} stars, price: ${required_amount}")
     
+    if not required_amount:
+        await message.answer("Ошибка: цена не найдена")
+        await state.clear()
+        return
+    
     logger.info(f"Final service_type: {service_type}, service_details: {service_details}")
-    logger.info(f"User {user.id} balance: ${current_balance}, required: ${required_amount}")
-    
-    if current_balance >= required_amount:
-        # User has sufficient balance - deduct from balance
-        try:
-            await balance_repo.subtract_from_balance(user.id, required_amount)
-            logger.info(f"Successfully deducted ${required_amount} from user {user.id} balance")
-            
-            # Show success message with balance deduction
-            await message.answer(
-                f"✅ <b>Заказ создан!</b>\n\n"
-                f"📱 <b>{service_type}:</b> {service_details}\n"
-                f"👤 <b>Для аккаунта:</b> @{username}\n"
-                f"💰 <b>Сумма:</b> ${required_amount:.2f}\n"
-                f"💳 <b>Списано с баланса:</b> ${required_amount:.2f}\n"
-                f"💵 <b>Остаток баланса:</b> ${(current_balance - required_amount):.2f}\n\n"
-                f"📝 <b>Статус:</b> Обрабатывается\n\n"
-                f"⏰ <b>Время обработки:</b> 5-15 минут",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logger.error(f"Error deducting from balance: {e}")
-            await message.answer(
-                "❌ <b>Ошибка списания с баланса!</b>\n\n"
-                "Попробуйте позже или обратитесь в поддержку.",
-                parse_mode="HTML"
-            )
-            await state.clear()
-            return
+    
+    # Debit and order creation happen in one statement, the result decides the answer
+    try:
+        order, balance = await order_repo.checkout(user.id, service_key, quantity, username, required_amount)
+    except Exception as e:
+        logger.error(f"Error during checkout: {e}")
+        await message.answer(
+            "❌ <b>Ошибка списания с баланса!</b>\n\n"
+            "Попробуйте позже или обратитесь в поддержку.",
+            parse_mode="HTML"
+        )
+        await state.clear()
+        return
+    
+    logger.info(f"User {user.id} checkout for ${required_amount}: order={order.id if order else None}, balance=${balance}")
+    
+    if order:
+        fulfillment_manager.notify()
+        await message.answer(
+            f"✅ <b>Заказ #{order.id} создан!</b>\n\n"
+            f"📱 <b>{service_type}:</b> {service_details}\n"
+            f"👤 <b>Для аккаунта:</b> @{username}\n"
+            f"💰 <b>Сумма:</b> ${required_amount:.2f}\n"
+            f"💳 <b>Списано с баланса:</b> ${required_amount:.2f}\n"
+            f"💵 <b>Остаток баланса:</b> ${balance:.2f}\n\n"
+            f"📝 <b>Статус:</b> Обрабатывается\n\n"
+            f"⏰ <b>Время обработки:</b> 5-15 минут",
+            parse_mode="HTML"
+        )
     else:
-        # Insufficient balance - offer payment options
+        # Insufficient balance - offer payment options, the invoice takes the order from state
+        await state.update_data(fragment_username=username)
+        
         # Create safe callback data without spaces and special characters
-        service_key = "premium" if "premium" in service_type.lower() else "stars"
         safe_username = username.replace("_", "").replace(" ", "")[:20]  # Limit length and remove special chars
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -613,7 +581,7 @@ async def handle_fragment_username(message: Message, state: FSMContext):
         await message.answer(
             f"❌ <b>Недостаточно средств!</b>\n\n"
             f"💰 <b>Требуется:</b> ${required_amount:.2f}\n"
-            f"💵 <b>Ваш баланс:</b> ${current_balance:.2f}\n"
+            f"💵 <b>Ваш баланс:</b> ${balance:.2f}\n"
             f"📱 <b>Услуга:</b> {service_type} - {service_details}\n"
             f"👤 <b>Для аккаунта:</b> @{username}\n\n"
             f"💡 <b>Выберите способ оплаты:</b>",
@@ -635,47 +603,48 @@ async def handle_fragment_username(message: Message, state: FSMContext):
     )
 
 
-@router.callback_query(F.data.startswith("pay_crypto_"))
-async def pay_crypto_callback(callback: CallbackQuery):
+@router.callback_query(F.data.startswith("pay_crypto_"), flags={"throttling": "expensive"})
+async def pay_crypto_callback(callback: CallbackQuery, state: FSMContext, user: User, config: Config,
+                              invoice_repo: CryptoPayInvoiceRepository):
     """Handle crypto payment for services"""
     try:
-        # Parse callback data: pay_crypto_service_amount_username
-        data_parts = callback.data.split("_")
-        logger.info(f"Parsing callback data: {callback.data} -> parts: {data_parts}")
-        
-        if len(data_parts) < 4:
-            await callback.answer("Ошибка: неверные данные")
+        # Order details come from the checkout state, callback data only has a shortened username
+        state_data = await state.get_data()
+        months = state_data.get('fragment_months')
+        stars_count = state_data.get('fragment_stars_count')
+        username = state_data.get('fragment_username')
+        logger.info(f"Crypto payment for {callback.data}: months={months}, stars={stars_count}, username={username}")
+        
+        if not username or not (months or stars_count):
+            await callback.answer("Ошибка: данные заказа устарели, оформите заказ заново")
             return
         
-        service_type = data_parts[2]  # premium or stars
-        amount_cents = int(data_parts[3])  # amount in cents
-        amount = amount_cents / 100.0  # convert back to dollars
-        username = data_parts[4] if len(data_parts) > 4 else "unknown"  # username
-        
-        logger.info(f"Parsed: service_type={service_type}, amount_cents={amount_cents}, amount=${amount}, username={username}")
+        # The invoice amount comes from the current price list, never from state
+        if months:
+            service_type, quantity = "premium", months
+            amount = pricing_service.get_premium_price(months)
+        else:
+            service_type, quantity = "stars", stars_count
+            amount = pricing_service.get_stars_price(stars_count)
         
-        config = Config()
-        user_repo = UserRepository(config.database_url)
-        
-        user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-        if not user:
-            await callback.answer("Ошибка: пользователь не найден")
+        if not amount:
+            await callback.answer("Ошибка: цена не найдена")
             return
         
         # Create payment invoice using Crypto Pay API
-        from bot.crypto_pay_api import CryptoPayAPI
-        
-        crypto_api = CryptoPayAPI(config.crypto_pay_token, config.crypto_pay_testnet)
+        crypto_api = get_crypto_pay_api(config.crypto_pay_token, config.crypto_pay_testnet)
         
         # Create invoice for the service
         service_name = "Telegram Premium" if "premium" in service_type else "Telegram Stars"
+        payload = build_order_payload(user.id, service_type, quantity, username)
         invoice = await crypto_api.create_invoice(
             amount=amount,
             asset="USDT",
             currency_type="fiat",
             fiat="USD",
             description=f"Оплата {service_name} для @{username}",
-            payload=f"service_{service_type}_{user.id}_{int(amount * 100)}_{username}"
+            payload=payload,
+            expires_in=config.invoice_expires_in
         )
         
         if not invoice:
@@ -686,6 +655,9 @@ async def pay_crypto_callback(callback: CallbackQuery):
             )
             return
         
+        await save_crypto_pay_invoice(config, invoice_repo, user.id, invoice, amount, payload)
+        await state.clear()
+        
         # Show payment information
         payment_url = invoice.get("pay_url")
         
@@ -699,7 +671,7 @@ async def pay_crypto_callback(callback: CallbackQuery):
             f"💳 <b>Счет для оплаты {service_name} создан!</b>\n\n"
             f"💰 <b>Сумма:</b> ${amount:.2f}\n"
             f"👤 <b>Для аккаунта:</b> @{username}\n"
-            f"⏰ <b>Время действия:</b> 1 час\n\n"
+            f"⏰ <b>Время действия:</b> {config.invoice_expires_in // 60} мин.\n\n"
             f"💡 <b>Инструкция:</b>\n"
             f"1. Нажмите кнопку 'Оплатить'\n"
             f"2. Выберите криптовалюту\n"
@@ -720,16 +692,8 @@ async def pay_crypto_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data == "change_language")
-async def change_language_callback(callback: CallbackQuery):
+async def change_language_callback(callback: CallbackQuery, user: User):
     """Handle language change button"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     # Create language selection keyboard
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -751,19 +715,11 @@ async def change_language_callback(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("set_language_"))
-async def set_language_callback(callback: CallbackQuery):
+async def set_language_callback(callback: CallbackQuery, user: User, user_repo: UserRepository):
     """Handle language selection"""
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    
     # Extract language from callback data
     language = callback.data.split("_")[2]  # set_language_ru -> ru
     
-    user = await user_repo.get_user_by_telegram_id(callback.from_user.id)
-    if not user:
-        await callback.answer("Ошибка: пользователь не найден")
-        return
-    
     try:
         # Update user language in database
         await user_repo.update_user(user.telegram_id, language=language)
@@ -787,38 +743,14 @@ async def set_language_callback(callback: CallbackQuery):
 
 
 @router.message()
-async def handle_message(message: Message):
+async def handle_message(message: Message, user: User, chat: Chat, message_repo: MessageRepository):
     """Handle all other messages"""
     # Skip if message is a command
     if message.text and message.text.startswith('/'):
         logger.info(f"Skipping command message: {message.text}")
         return
-        
-    config = Config()
-    user_repo = UserRepository(config.database_url)
-    chat_repo = ChatRepository(config.database_url)
-    message_repo = MessageRepository(config.database_url)
-    
-    # Get or create user
-    user = await user_repo.get_user_by_telegram_id(message.from_user.id)
-    if not user:
-        user = await user_repo.create_user(
-            telegram_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
-    
-    # Get or create chat
-    chat = await chat_repo.get_chat_by_telegram_id(message.chat.id)
-    if not chat:
-        chat = await chat_repo.create_chat(
-            telegram_id=message.chat.id,
-            chat_type=message.chat.type,
-            title=message.chat.title,
-            username=message.chat.username
-        )
     
+    # User and chat are upserted by DatabaseMiddleware
     # Log message
     await message_repo.create_message(
         telegram_id=message.message_id,
@@ -7,7 +7,7 @@ TRANSLATIONS = {
         "main_menu": "🌟 <b>CosmicPerks</b> 🌟\n\n🚀 Мы предлагаем Telegram Premium подписки и Stars!\n✨ Выберите действие ниже:",
         
         # Profile
-        "profile_title": "👤 <b>Ваш профиль</b> 👤\n\n🆔 <b>ID:</b> {telegram_id}\n👤 <b>Имя:</b> {first_name}\n📝 <b>Фамилия:</b> {last_name}\n🔗 <b>Username:</b> @{username}\n📅 <b>Дата регистрации:</b> {created_at}\n✅ <b>Статус:</b> {status}\n\n💰 <b>Баланс:</b> {balance}\n⭐ <b>Рейтинг:</b> {rating}",
+        "profile_title": "👤 <b>Ваш профиль</b> 👤\n\n🆔 <b>ID:</b> {telegram_id}\n👤 <b>Имя:</b> {first_name}\n📝 <b>Фамилия:</b> {last_name}\n🔗 <b>Username:</b> @{username}\n📅 <b>Дата регистрации:</b> {created_at}\n✅ <b>Статус:</b> {status}\n\n💰 <b>Баланс:</b> {balance}\n📦 <b>Заказов:</b> {orders}\n⭐ <b>Рейтинг:</b> {rating}",
         "profile_not_found": "❌ Профиль не найден. Попробуйте /start",
         
         # Help
@@ -57,6 +57,7 @@ TRANSLATIONS = {
         "btn_pay": "💳 Оплатить",
         "btn_confirm": "✅ Отправить",
         "btn_cancel": "❌ Отмена",
+        "btn_my_orders": "📦 Мои заказы",
         
         # Admin buttons
         "btn_admin_panel": "🔧 Админ панель",
@@ -77,7 +78,7 @@ TRANSLATIONS = {
         "deposit_invalid_format": "❌ <b>Неверный формат суммы!</b>\n\nВведите число, например: 10.50",
         "deposit_invoice_created": "💳 <b>Счет для оплаты создан!</b>",
         "deposit_amount": "💰 <b>Сумма:</b> ${amount}",
-        "deposit_expires": "⏰ <b>Время действия:</b> 1 час",
+        "deposit_expires": "⏰ <b>Время действия:</b> {minutes} мин.",
         "deposit_instructions": "💡 <b>Инструкция:</b>\n1. Нажмите кнопку 'Оплатить'\n2. Выберите криптовалюту\n3. Отправьте платеж\n4. Дождитесь подтверждения",
         "deposit_important": "⚠️ <b>Важно:</b> Баланс пополнится автоматически после подтверждения платежа.",
         
@@ -92,6 +93,19 @@ TRANSLATIONS = {
         # Premium pricing
         "premium_months": "{months} месяцев - ${price}",
         "stars_count": "{count} Stars - ${price}",
+        
+        # Orders
+        "orders_title": "📦 <b>Мои заказы</b>",
+        "orders_empty": "📦 <b>Мои заказы</b>\n\nУ вас пока нет заказов.",
+        "order_details": "📦 <b>Заказ #{id}</b>\n\n📱 <b>Услуга:</b> {service}\n👤 <b>Для аккаунта:</b> @{recipient}\n💰 <b>Сумма:</b> ${amount}\n📅 <b>Создан:</b> {created_at}\n📝 <b>Статус:</b> {status}",
+        "order_premium": "Telegram Premium, {quantity} мес.",
+        "order_stars": "Telegram Stars, {quantity} ⭐",
+        "order_status_queued": "⏳ В очереди",
+        "order_status_processing": "⚙️ Обрабатывается",
+        "order_status_pending": "🔄 Выполняется на Fragment",
+        "order_status_completed": "✅ Выполнен",
+        "order_status_failed": "❌ Ошибка",
+        "throttled": "⏳ Слишком много запросов, подождите немного.",
     },
     
     "en": {
@@ -100,7 +114,7 @@ TRANSLATIONS = {
         "main_menu": "🌟 <b>CosmicPerks</b> 🌟\n\n🚀 We offer Telegram Premium subscriptions and Stars!\n✨ Choose an action below:",
         
         # Profile
-        "profile_title": "👤 <b>Your Profile</b> 👤\n\n🆔 <b>ID:</b> {telegram_id}\n👤 <b>First Name:</b> {first_name}\n📝 <b>Last Name:</b> {last_name}\n🔗 <b>Username:</b> @{username}\n📅 <b>Registration Date:</b> {created_at}\n✅ <b>Status:</b> {status}\n\n💰 <b>Balance:</b> {balance}\n⭐ <b>Rating:</b> {rating}",
+        "profile_title": "👤 <b>Your Profile</b> 👤\n\n🆔 <b>ID:</b> {telegram_id}\n👤 <b>First Name:</b> {first_name}\n📝 <b>Last Name:</b> {last_name}\n🔗 <b>Username:</b> @{username}\n📅 <b>Registration Date:</b> {created_at}\n✅ <b>Status:</b> {status}\n\n💰 <b>Balance:</b> {balance}\n📦 <b>Orders:</b> {orders}\n⭐ <b>Rating:</b> {rating}",
         "profile_not_found": "❌ Profile not found. Try /start",
         
         # Help
@@ -150,6 +164,7 @@ TRANSLATIONS = {
         "btn_pay": "💳 Pay",
         "btn_confirm": "✅ Send",
         "btn_cancel": "❌ Cancel",
+        "btn_my_orders": "📦 My Orders",
         
         # Admin buttons
         "btn_admin_panel": "🔧 Admin Panel",
@@ -170,7 +185,7 @@ TRANSLATIONS = {
         "deposit_invalid_format": "❌ <b>Invalid amount format!</b>\n\nEnter a number, for example: 10.50",
         "deposit_invoice_created": "💳 <b>Payment invoice created!</b>",
         "deposit_amount": "💰 <b>Amount:</b> ${amount}",
-        "deposit_expires": "⏰ <b>Valid for:</b> 1 hour",
+        "deposit_expires": "⏰ <b>Valid for:</b> {minutes} min",
         "deposit_instructions": "💡 <b>Instructions:</b>\n1. Click the 'Pay' button\n2. Select cryptocurrency\n3. Send payment\n4. Wait for confirmation",
         "deposit_important": "⚠️ <b>Important:</b> Balance will be topped up automatically after payment confirmation.",
         
@@ -185,6 +200,19 @@ TRANSLATIONS = {
         # Premium pricing
         "premium_months": "{months} months - ${price}",
         "stars_count": "{count} Stars - ${price}",
+        
+        # Orders
+        "orders_title": "📦 <b>My Orders</b>",
+        "orders_empty": "📦 <b>My Orders</b>\n\nYou have no orders yet.",
+        "order_details": "📦 <b>Order #{id}</b>\n\n📱 <b>Service:</b> {service}\n👤 <b>For account:</b> @{recipient}\n💰 <b>Amount:</b> ${amount}\n📅 <b>Created:</b> {created_at}\n📝 <b>Status:</b> {status}",
+        "order_premium": "Telegram Premium, {quantity} mo.",
+        "order_stars": "Telegram Stars, {quantity} ⭐",
+        "order_status_queued": "⏳ Queued",
+        "order_status_processing": "⚙️ Processing",
+        "order_status_pending": "🔄 In progress on Fragment",
+        "order_status_completed": "✅ Completed",
+        "order_status_failed": "❌ Failed",
+        "throttled": "⏳ Too many requests, please slow down a little.",
     }
 }
 
@@ -1,9 +1,28 @@
 from aiogram import Dispatcher
 from .logging_middleware import LoggingMiddleware
 from .database_middleware import DatabaseMiddleware
+from .sharding_middleware import ShardingMiddleware
+from .throttling_middleware import FloodCapMiddleware, ThrottlingMiddleware
 
 
 def setup_middlewares(dp: Dispatcher):
     """Setup all middlewares"""
+    # Ahead of aiogram's FSM middleware, so neither dropped floods nor updates handed to
+    # a shard cost an FSM storage read: the flood cap drops them first, then updates
+    # move onto their user's shard when sharding is enabled
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(FloodCapMiddleware())
+    dp.update.outer_middleware(ShardingMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+    
+    # Before any database work, so flooding can't tie up the connection pool
+    throttling_middleware = ThrottlingMiddleware()
+    dp.message.middleware(throttling_middleware)
+    dp.callback_query.middleware(throttling_middleware)
+    
     dp.message.middleware(LoggingMiddleware())
-    dp.message.middleware(DatabaseMiddleware()) 
\ No newline at end of file
+    
+    # One instance for messages and callback queries, it holds the shared repositories
+    database_middleware = DatabaseMiddleware()
+    dp.message.middleware(database_middleware)
+    dp.callback_query.middleware(database_middleware) 
\ No newline at end of file
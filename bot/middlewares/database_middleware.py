@@ -3,20 +3,36 @@ from typing import Any, Awaitable, Callable, Dict
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 
-from bot.database import UserRepository, ChatRepository
-from bot.config import Config
+from bot.database import (
+    UserRepository, ChatRepository, MessageRepository,
+    UserBalanceRepository, OrderRepository, CryptoPayInvoiceRepository, BroadcastCampaignRepository
+)
+from bot.config import get_config
 
 logger = logging.getLogger(__name__)
 
 
 class DatabaseMiddleware(BaseMiddleware):
-    """Middleware for database operations"""
+    """Middleware for database operations.
+    
+    Resolves the user once per update and injects it together with the config and
+    shared repository instances, handlers take what they need as arguments.
+    """
     
     def __init__(self):
         super().__init__()
-        self.config = Config()
-        self.user_repo = UserRepository(self.config.database_url)
-        self.chat_repo = ChatRepository(self.config.database_url)
+        database_url = get_config().database_url
+        self.user_repo = UserRepository(database_url)
+        self.chat_repo = ChatRepository(database_url)
+        self.repositories = {
+            "user_repo": self.user_repo,
+            "chat_repo": self.chat_repo,
+            "message_repo": MessageRepository(database_url),
+            "balance_repo": UserBalanceRepository(database_url),
+            "order_repo": OrderRepository(database_url),
+            "invoice_repo": CryptoPayInvoiceRepository(database_url),
+            "campaign_repo": BroadcastCampaignRepository(database_url),
+        }
     
     async def __call__(
         self,
@@ -24,36 +40,33 @@ class DatabaseMiddleware(BaseMiddleware):
         event: Message | CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
-        # Add repositories to data for handlers
-        data["user_repo"] = self.user_repo
-        data["chat_repo"] = self.chat_repo
+        # Add current config snapshot and repositories to data for handlers
+        data["config"] = get_config()
+        data.update(self.repositories)
+        
+        # Ensure user and chat exist in database (one connection, upserts)
+        if isinstance(event, Message) and event.from_user:
+            user, chat, is_new_user = await self.user_repo.ensure_user_and_chat(event.from_user, event.chat)
+            if is_new_user:
+                logger.info(f"Created new user: {user.telegram_id}")
+            
+            # Add user and chat to data
+            data["user"] = user
+            data["chat"] = chat
+            data["is_new_user"] = is_new_user
         
-        # Ensure user exists in database
-        if isinstance(event, Message):
+        # Callback queries only need the user, usually served from the user cache
+        elif isinstance(event, CallbackQuery):
             user = await self.user_repo.get_user_by_telegram_id(event.from_user.id)
             if not user:
-                user = await self.user_repo.create_user(
+                user, _ = await self.user_repo.upsert_user(
                     telegram_id=event.from_user.id,
                     username=event.from_user.username,
                     first_name=event.from_user.first_name,
                     last_name=event.from_user.last_name
                 )
                 logger.info(f"Created new user: {user.telegram_id}")
-            
-            # Ensure chat exists in database
-            chat = await self.chat_repo.get_chat_by_telegram_id(event.chat.id)
-            if not chat:
-                chat = await self.chat_repo.create_chat(
-                    telegram_id=event.chat.id,
-                    chat_type=event.chat.type,
-                    title=event.chat.title,
-                    username=event.chat.username
-                )
-                logger.info(f"Created new chat: {chat.telegram_id}")
-            
-            # Add user and chat to data
             data["user"] = user
-            data["chat"] = chat
         
         # Call next handler
-        return await handler(event, data) 
\ No newline at end of file
+        return await handler(event, data)
\ No newline at end of file
@@ -0,0 +1,26 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from bot.database.connection import current_db_shard
+from bot.sharding import update_shards
+
+
+class ShardingMiddleware(BaseMiddleware):
+    """Outer update middleware handing updates over to their user's shard.
+    
+    Updates arriving from polling, the webhook or the startup backlog are queued on a
+    shard and processed there; inside a shard worker they pass straight through.
+    """
+    
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not update_shards.running or current_db_shard.get() is not None:
+            return await handler(event, data)
+        
+        await update_shards.submit(data["bot"], event)
+        return None
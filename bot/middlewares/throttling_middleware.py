@@ -0,0 +1,148 @@
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message, CallbackQuery, Update
+
+from bot.config import get_config
+from bot.database.connection import current_db_shard
+from bot.locales.translations import get_text
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_DEFAULT = "default"
+THROTTLING_EXPENSIVE = "expensive"
+
+
+class TokenBuckets:
+    """Token buckets kept in memory, buckets refilled to full are forgotten"""
+    
+    def __init__(self, cleanup_interval: int = 60):
+        self.cleanup_interval = cleanup_interval  # seconds between sweeps of idle buckets
+        self._buckets: Dict[Hashable, Tuple[float, float, float, float]] = {}  # key -> (tokens, updated, rate, burst)
+        self._last_cleanup = time.monotonic()
+    
+    def consume(self, key: Hashable, rate: float, burst: float, now: float) -> bool:
+        """Take a token from key's bucket, False when it is empty"""
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self.cleanup(now)
+        
+        tokens, updated, _, _ = self._buckets.get(key, (burst, now, rate, burst))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now, rate, burst)
+            return False
+        self._buckets[key] = (tokens - 1, now, rate, burst)
+        return True
+    
+    def cleanup(self, now: float):
+        """Forget buckets refilled to full, keeps memory bounded"""
+        self._last_cleanup = now
+        for key, (tokens, updated, rate, burst) in list(self._buckets.items()):
+            if tokens + (now - updated) * rate >= burst:
+                del self._buckets[key]
+
+
+class FloodCapMiddleware(BaseMiddleware):
+    """Outer update middleware capping all updates of a user.
+    
+    Registered ahead of aiogram's FSM middleware, so a flood is dropped before its FSM
+    state is read from storage. The cap is loose, ThrottlingMiddleware applies the
+    per-action budgets later.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self._buckets = TokenBuckets()
+    
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        # Inside a shard worker the update was already counted when it arrived
+        from_user = getattr(event.event, "from_user", None)
+        if not from_user or current_db_shard.get() is not None:
+            return await handler(event, data)
+        
+        config = get_config()
+        if self._buckets.consume(from_user.id, config.throttle_update_rate, config.throttle_update_burst,
+                                 time.monotonic()):
+            return await handler(event, data)
+        
+        logger.info(f"Flood cap dropped update from user {from_user.id}")
+        if event.callback_query:
+            try:
+                await event.callback_query.answer()
+            except Exception as e:
+                logger.warning(f"Failed to answer dropped callback from user {from_user.id}: {e}")
+        return None
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Per-user anti-flood limits, runs before any database work.
+    
+    Every user has a token bucket per budget: handlers flagged with
+    flags={"throttling": "expensive"} (checkout, invoice creation) spend from a small
+    one, everything else from the navigation one. Updates over the limit are dropped,
+    the user gets a "slow down" reply at most once per warn interval. Dropped callback
+    queries are still answered, without text, so the button does not keep loading.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.warn_interval = 10  # seconds between "slow down" replies to one user
+        self._buckets = TokenBuckets()  # keyed by (user, budget)
+        self._warned: Dict[int, float] = {}
+        self._last_cleanup = time.monotonic()
+    
+    def _get_limits(self, budget: str) -> Tuple[float, float]:
+        """(rate per second, burst) of budget"""
+        config = get_config()
+        if budget == THROTTLING_EXPENSIVE:
+            return config.throttle_expensive_rate, config.throttle_expensive_burst
+        return config.throttle_rate, config.throttle_burst
+    
+    def _cleanup(self, now: float):
+        """Forget old warnings, keeps memory bounded"""
+        self._last_cleanup = now
+        for user_id, warned_at in list(self._warned.items()):
+            if now - warned_at >= self.warn_interval:
+                del self._warned[user_id]
+    
+    async def __call__(
+        self,
+        handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: Dict[str, Any]
+    ) -> Any:
+        if not event.from_user:
+            return await handler(event, data)
+        
+        now = time.monotonic()
+        if now - self._last_cleanup >= self._buckets.cleanup_interval:
+            self._cleanup(now)
+        
+        user_id = event.from_user.id
+        budget = get_flag(data, "throttling", default=THROTTLING_DEFAULT)
+        rate, burst = self._get_limits(budget)
+        if self._buckets.consume((user_id, budget), rate, burst, now):
+            return await handler(event, data)
+        
+        logger.info(f"Throttled {budget} update from user {user_id}")
+        warn = user_id not in self._warned or now - self._warned[user_id] >= self.warn_interval
+        if warn:
+            self._warned[user_id] = now
+        elif isinstance(event, Message):
+            return None
+        
+        text = get_text("throttled", event.from_user.language_code or get_config().default_language) if warn else None
+        try:
+            # Callback queries are always answered so the client stops its spinner, the
+            # notice is a toast there and a chat message for messages
+            await event.answer(text)
+        except Exception as e:
+            logger.warning(f"Failed to answer throttled update from user {user_id}: {e}")
+        return None
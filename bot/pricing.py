@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from bot.config import get_config
+from bot.database.repository import PremiumPricingRepository, StarsPricingRepository
+
+logger = logging.getLogger(__name__)
+
+
+# Used until the first load from the database succeeds, same as the schema defaults
+DEFAULT_PREMIUM_PRICES = {3: 12.99, 9: 29.99, 12: 39.99}
+DEFAULT_STARS_PRICES = {50: 0.50, 100: 1.00, 200: 2.00, 500: 5.00}
+
+
+class PricingService:
+    """Premium and Stars prices held in memory.
+    
+    Both pricing tables are loaded at start and reloaded periodically or on refresh(),
+    lookups are plain dict reads and never touch the database. A reload builds new
+    dicts and swaps them in, so readers always see a complete price list.
+    """
+    
+    def __init__(self):
+        self.running = False
+        self.refresh_interval = 300  # seconds between reloads
+        self._premium_prices: Dict[int, float] = dict(DEFAULT_PREMIUM_PRICES)
+        self._stars_prices: Dict[int, float] = dict(DEFAULT_STARS_PRICES)
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+    
+    def _get_config(self):
+        """Get current config snapshot"""
+        return get_config()
+    
+    async def start(self):
+        """Load prices and start periodic reload"""
+        if self.running:
+            return
+        self.running = True
+        self.refresh_interval = self._get_config().pricing_refresh_interval
+        
+        await self.refresh()
+        self._task = asyncio.create_task(self._refresh_loop())
+    
+    async def stop(self):
+        """Stop periodic reload"""
+        self.running = False
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def refresh(self) -> bool:
+        """Reload prices from the database, keeps the current ones on error"""
+        async with self._refresh_lock:
+            try:
+                config = self._get_config()
+                premium_pricing, stars_pricing = await asyncio.gather(
+                    PremiumPricingRepository(config.database_url).get_all_pricing(),
+                    StarsPricingRepository(config.database_url).get_all_pricing()
+                )
+            except Exception as e:
+                logger.error(f"Error loading prices, keeping current ones: {e}")
+                return False
+            
+            self._premium_prices = {pricing.months: float(pricing.price_usd) for pricing in premium_pricing}
+            self._stars_prices = {pricing.stars_count: float(pricing.price_usd) for pricing in stars_pricing}
+            logger.info(f"Prices loaded: {len(self._premium_prices)} Premium, {len(self._stars_prices)} Stars options")
+            return True
+    
+    async def _refresh_loop(self):
+        while self.running:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+    
+    def get_premium_price(self, months: int) -> Optional[float]:
+        """Price in USD for Premium months, None if not offered"""
+        return self._premium_prices.get(months)
+    
+    def get_stars_price(self, stars_count: int) -> Optional[float]:
+        """Price in USD for stars count, None if not offered"""
+        return self._stars_prices.get(stars_count)
+    
+    def get_premium_options(self) -> List[Tuple[int, float]]:
+        """Offered (months, price) pairs, shortest first"""
+        return sorted(self._premium_prices.items())
+    
+    def get_stars_options(self) -> List[Tuple[int, float]]:
+        """Offered (stars count, price) pairs, smallest first"""
+        return sorted(self._stars_prices.items())
+
+
+# Global pricing service instance
+pricing_service = PricingService()
+
+
+async def start_pricing():
+    """Load prices and start periodic reload"""
+    await pricing_service.start()
+
+
+async def stop_pricing():
+    """Stop periodic price reload"""
+    await pricing_service.stop()
@@ -0,0 +1,267 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Delivery priorities, lower is sent first
+PRIORITY_PAYMENT = 0    # payment and order notifications to users
+PRIORITY_ADMIN = 1      # notifications to admins
+PRIORITY_BROADCAST = 2  # mass mailings
+
+PRIORITY_NAMES = {
+    PRIORITY_PAYMENT: "payment",
+    PRIORITY_ADMIN: "admin",
+    PRIORITY_BROADCAST: "broadcast",
+}
+
+
+class TokenBucket:
+    """Token bucket limiter: `rate` tokens per second, bursts up to `capacity`"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass(order=True)
+class OutgoingMessage:
+    """Queued message; ordered by priority, then by enqueue order"""
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False, default_factory=dict)
+    attempts: int = field(compare=False, default=0)
+    future: Optional[asyncio.Future] = field(compare=False, default=None)
+
+
+class SendQueue:
+    """Single outbound queue for bot messages.
+    
+    Paces sends with a global token bucket (Telegram allows about 30 msg/s per bot)
+    and a minimal interval per chat (about 1 msg/s), waits out TelegramRetryAfter,
+    retries transient errors and sends higher priority messages first.
+    """
+    
+    def __init__(self, bot=None, global_rate: float = 30.0, per_chat_interval: float = 1.0,
+                 workers: int = 4, max_retries: int = 3):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self.running = False
+        
+        self._bucket = TokenBucket(global_rate)
+        self._heap: List[OutgoingMessage] = []
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self._chat_next_send: Dict[int, float] = {}
+        self._paused_until = 0.0  # set by TelegramRetryAfter, applies to all workers
+        self._delayed: Dict[asyncio.TimerHandle, OutgoingMessage] = {}  # waiting for chat slot or retry
+        self._worker_tasks: List[asyncio.Task] = []
+        
+        self.metrics: Dict[str, int] = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "retry_after": 0,
+        }
+        self.sent_by_priority: Dict[str, int] = {name: 0 for name in PRIORITY_NAMES.values()}
+    
+    def set_bot(self, bot):
+        """Set bot instance used for sending"""
+        self.bot = bot
+    
+    def configure(self, global_rate: float, per_chat_interval: float, workers: int):
+        """Apply rate limits and worker count, call before start()"""
+        self._bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+    
+    async def start(self):
+        """Start sender workers"""
+        if self.running:
+            return
+        self.running = True
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Send queue started with {self.workers} workers")
+    
+    async def stop(self, timeout: float = 10.0):
+        """Stop workers, giving queued messages up to `timeout` seconds to go out"""
+        deadline = time.monotonic() + timeout
+        while self.running and (self._heap or self._delayed) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        
+        self.running = False
+        self._ready.set()
+        for handle, item in self._delayed.items():
+            handle.cancel()
+            self._heap.append(item)
+        self._delayed.clear()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        
+        for item in self._heap:
+            self._finish(item, None)
+        if self._heap:
+            logger.warning(f"Send queue stopped with {len(self._heap)} undelivered messages")
+        self._heap.clear()
+        logger.info(f"Send queue stopped, metrics: {self.get_metrics()}")
+    
+    def enqueue(self, chat_id: int, text: str, priority: int = PRIORITY_ADMIN,
+                **kwargs) -> asyncio.Future:
+        """Queue message for delivery, kwargs are passed to bot.send_message.
+        
+        Returns a future resolved with the sent Message, or None if delivery failed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = OutgoingMessage(priority, next(self._seq), chat_id, text, kwargs, future=future)
+        self._push(item)
+        self.metrics["enqueued"] += 1
+        return future
+    
+    async def send(self, chat_id: int, text: str, priority: int = PRIORITY_ADMIN, **kwargs):
+        """Queue message and wait for its delivery, returns Message or None"""
+        return await self.enqueue(chat_id, text, priority, **kwargs)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """Delivery counters and current queue size"""
+        return {
+            **self.metrics,
+            "queued": len(self._heap) + len(self._delayed),
+            "sent_by_priority": dict(self.sent_by_priority),
+        }
+    
+    def _push(self, item: OutgoingMessage):
+        heapq.heappush(self._heap, item)
+        self._ready.set()
+    
+    def _push_later(self, item: OutgoingMessage, delay: float):
+        """Put message back after `delay` without holding a worker"""
+        def push():
+            self._delayed.pop(handle, None)
+            self._push(item)
+        handle = asyncio.get_running_loop().call_later(delay, push)
+        self._delayed[handle] = item
+    
+    def _finish(self, item: OutgoingMessage, result):
+        if item.future and not item.future.done():
+            item.future.set_result(result)
+    
+    async def _worker(self):
+        while self.running:
+            if not self._heap:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            
+            item = heapq.heappop(self._heap)
+            
+            # Per chat pacing: reschedule instead of sleeping so other chats keep flowing
+            now = time.monotonic()
+            chat_ready_at = self._chat_next_send.get(item.chat_id, 0.0)
+            if chat_ready_at > now:
+                self._push_later(item, chat_ready_at - now)
+                continue
+            self._chat_next_send[item.chat_id] = now + self.per_chat_interval
+            
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._bucket.acquire()
+            
+            await self._deliver(item)
+            self._prune_chat_slots()
+    
+    async def _deliver(self, item: OutgoingMessage):
+        """Send one message, handle flood control and transient errors"""
+        if not self.bot:
+            logger.warning(f"Bot instance not available, dropping message to {item.chat_id}")
+            self.metrics["failed"] += 1
+            self._finish(item, None)
+            return
+        
+        try:
+            message = await self.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+        except TelegramRetryAfter as e:
+            self.metrics["retry_after"] += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning(f"Flood control, pausing sends for {e.retry_after}s")
+            self._push_later(item, e.retry_after)
+            return
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Blocked bot, deleted chat, bad markup: retrying will not help
+            logger.warning(f"Cannot deliver message to {item.chat_id}: {e}")
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if item.attempts < self.max_retries:
+                item.attempts += 1
+                self.metrics["retried"] += 1
+                logger.warning(f"Send to {item.chat_id} failed: {e}, retrying (attempt {item.attempts})")
+                self._push_later(item, 0.5 * 2 ** item.attempts)
+                return
+            logger.error(f"Giving up on message to {item.chat_id}: {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error sending message to {item.chat_id}: {e}")
+        else:
+            self.metrics["sent"] += 1
+            priority_name = PRIORITY_NAMES.get(item.priority, str(item.priority))
+            self.sent_by_priority[priority_name] = self.sent_by_priority.get(priority_name, 0) + 1
+            self._finish(item, message)
+            return
+        
+        self.metrics["failed"] += 1
+        self._finish(item, None)
+    
+    def _prune_chat_slots(self):
+        """Forget per chat slots that are already in the past"""
+        if len(self._chat_next_send) < 10000:
+            return
+        now = time.monotonic()
+        self._chat_next_send = {chat_id: ready_at for chat_id, ready_at in self._chat_next_send.items()
+                                if ready_at > now}
+
+
+# Global send queue instance
+send_queue = SendQueue()
+
+
+async def start_send_queue(bot=None, config=None):
+    """Start global send queue"""
+    if bot:
+        send_queue.set_bot(bot)
+    if config:
+        send_queue.configure(config.send_rate_limit, config.send_per_chat_interval,
+                             config.send_queue_workers)
+    await send_queue.start()
+
+
+async def stop_send_queue():
+    """Stop global send queue"""
+    await send_queue.stop()
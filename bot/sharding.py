@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from bot.backlog import update_user_id
+from bot.config import Config
+from bot.database.connection import current_db_shard
+
+logger = logging.getLogger(__name__)
+
+
+def update_shard_key(update: Update) -> int:
+    """Id updates are sharded by: the user, or the chat for updates without one"""
+    user_id = update_user_id(update)
+    if user_id is not None:
+        return user_id
+    chat = getattr(update.event, "chat", None)
+    return chat.id if chat else 0
+
+
+class UpdateShards:
+    """Processes updates on N shard workers keyed by user.
+    
+    All updates of a user land on the same shard and run one after another, so a
+    multi-step checkout never races itself, while different users run in parallel.
+    Each shard works with its own slice of database connections.
+    """
+    
+    def __init__(self):
+        self.running = False
+        self.shards = 0
+        self.queue_size = 1000  # queued updates per shard before submit() waits
+        self.dp: Optional[Dispatcher] = None
+        self._queues: List[asyncio.Queue] = []
+        self._worker_tasks: List[asyncio.Task] = []
+    
+    async def start(self, dp: Dispatcher, config: Config):
+        """Start shard workers"""
+        if self.running or config.update_shards <= 0:
+            return
+        self.running = True
+        self.dp = dp
+        self.shards = config.update_shards
+        
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.shards)]
+        self._worker_tasks = [asyncio.create_task(self._worker(shard)) for shard in range(self.shards)]
+        logger.info(f"Update sharding started with {self.shards} shards, "
+                    f"{config.db_shard_pool_size} DB connections each")
+    
+    async def stop(self):
+        """Finish queued updates and stop shard workers"""
+        if not self.running:
+            return
+        self.running = False
+        await asyncio.gather(*[queue.join() for queue in self._queues])
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._queues = []
+    
+    async def submit(self, bot: Bot, update: Update):
+        """Queue update on its shard, waits while that shard is full"""
+        shard = update_shard_key(update) % self.shards
+        await self._queues[shard].put((bot, update))
+    
+    async def _worker(self, shard: int):
+        current_db_shard.set(shard)
+        queue = self._queues[shard]
+        while True:
+            bot, update = await queue.get()
+            try:
+                await self.dp.feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id} on shard {shard}: {e}")
+            finally:
+                queue.task_done()
+
+
+# Global update shards instance
+update_shards = UpdateShards()
+
+
+async def start_update_shards(dp: Dispatcher, config: Config):
+    """Start shard workers if UPDATE_SHARDS is set"""
+    await update_shards.start(dp, config)
+
+
+async def stop_update_shards():
+    """Finish queued updates and stop shard workers"""
+    await update_shards.stop()
@@ -0,0 +1,163 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import signal
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from bot.backlog import is_stale
+from bot.config import Config
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def default_secret_token(bot_token: str) -> str:
+    """Secret token derived from the bot token, the same on every replica"""
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+class TelegramWebhookServer:
+    """Embedded HTTP endpoint receiving Telegram updates.
+    
+    Requests are checked against the secret token and answered as soon as the update is
+    queued, a pool of dispatcher workers runs the handlers. When the queue is full the
+    request waits, which holds back Telegram instead of buffering without bound.
+    """
+    
+    def __init__(self, bot: Bot, dp: Dispatcher, url: str, secret_token: str,
+                 host: str = "0.0.0.0", port: int = 8080, path: str = "/telegram/webhook",
+                 workers: int = 8, max_connections: int = 40, queue_size: int = 1000,
+                 drop_pending_updates: bool = False, max_age: int = 0):
+        self.bot = bot
+        self.dp = dp
+        self.url = url
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.max_connections = max_connections
+        self.drop_pending_updates = drop_pending_updates
+        self.max_age = max_age  # seconds, older messages are skipped (backlog after downtime)
+        self.runner: Optional[web.AppRunner] = None
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._worker_tasks: List[asyncio.Task] = []
+    
+    async def start(self):
+        """Start workers and HTTP server, then point Telegram at it"""
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info(f"Telegram webhook listening on {self.host}:{self.port}{self.path}")
+        
+        allowed_updates = self.dp.resolve_used_update_types()
+        await self.bot.set_webhook(
+            url=self.url,
+            secret_token=self.secret_token,
+            allowed_updates=allowed_updates,
+            max_connections=self.max_connections,
+            drop_pending_updates=self.drop_pending_updates
+        )
+        logger.info(f"Telegram webhook set to {self.url} with {self.workers} workers, "
+                    f"updates: {', '.join(allowed_updates)}")
+    
+    async def stop(self):
+        """Stop HTTP server and finish queued updates.
+        
+        The webhook stays registered with Telegram, other replicas may still be serving it.
+        """
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+        await self._queue.join()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        logger.info("Telegram webhook stopped")
+    
+    async def handle_update(self, request: web.Request) -> web.Response:
+        """Handle update from Telegram"""
+        secret_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(secret_token, self.secret_token):
+            logger.warning(f"Telegram webhook: invalid secret token from {request.remote}")
+            return web.Response(status=401)
+        
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            logger.warning("Telegram webhook: malformed update")
+            return web.Response(status=400)
+        
+        await self._queue.put(update)
+        return web.json_response({"ok": True})
+    
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                if is_stale(update, self.max_age):
+                    logger.info(f"Skipping stale update {update.update_id}")
+                    continue
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+# Global webhook server instance and the event that stops it
+webhook_server: Optional[TelegramWebhookServer] = None
+_stop_event = asyncio.Event()
+
+
+async def run_telegram_webhook(bot: Bot, dp: Dispatcher, config: Config):
+    """Serve updates over the webhook until stop_telegram_webhook() or SIGINT/SIGTERM"""
+    global webhook_server
+    
+    _stop_event.clear()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, _stop_event.set)
+        except NotImplementedError:  # pragma: no cover
+            pass
+    
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    webhook_server = TelegramWebhookServer(
+        bot=bot,
+        dp=dp,
+        url=config.webhook_url,
+        secret_token=config.webhook_secret or default_secret_token(config.bot_token),
+        host=config.webhook_host,
+        port=config.webhook_port,
+        path=config.webhook_path,
+        workers=config.webhook_workers,
+        max_connections=config.webhook_max_connections,
+        drop_pending_updates=config.drop_pending_updates,
+        max_age=config.backlog_max_age
+    )
+    try:
+        await webhook_server.start()
+        await _stop_event.wait()
+    finally:
+        await webhook_server.stop()
+        webhook_server = None
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+
+
+async def stop_telegram_webhook():
+    """Stop serving the Telegram webhook"""
+    _stop_event.set()
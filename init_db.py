@@ -36,6 +36,12 @@ async def init_database():
     print("   • premium_pricing - цены на Telegram Premium")
     print("   • user_balance - баланс пользователей")
     print("   • crypto_pay_invoices - счета для оплаты")
+    print("   • broadcast_campaigns - рассылки")
+    print("   • orders - заказы и очередь их выполнения")
+    print("   • fragment_orders - заказы на Fragment")
+    print("   • stars_pricing - цены на Telegram Stars")
+    print("   • fsm_storage - состояния диалогов (FSM_STORAGE=postgres)")
+    print("   • schema_version - примененные миграции")
 
 
 if __name__ == "__main__":
@@ -4,15 +4,25 @@ import signal
 import sys
 from datetime import datetime
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from dotenv import load_dotenv
 import os
 
-from bot.config import Config
-from bot.database import create_tables
+from bot.config import get_config, reload_config
+from bot.database import run_migrations, get_db_manager
 from bot.handlers import register_handlers
 from bot.middlewares import setup_middlewares
 from bot.background_tasks import start_background_tasks, stop_background_tasks
+from bot.fragment_api import close_fragment_api
+from bot.crypto_pay_api import close_crypto_pay_api
+from bot.crypto_pay_webhook import start_crypto_pay_webhook, stop_crypto_pay_webhook
+from bot.send_queue import start_send_queue, stop_send_queue
+from bot.broadcast import start_broadcasts, stop_broadcasts
+from bot.fulfillment import start_fulfillment, stop_fulfillment
+from bot.pricing import start_pricing, stop_pricing
+from bot.fsm_storage import create_fsm_storage
+from bot.telegram_webhook import run_telegram_webhook, stop_telegram_webhook
+from bot.backlog import drain_pending_updates
+from bot.sharding import start_update_shards, stop_update_shards
 
 # Load environment variables
 load_dotenv()
@@ -30,10 +40,10 @@ dispatcher_instance = None
 start_time = None
 
 
-async def delete_webhook(bot: Bot):
+async def delete_webhook(bot: Bot, drop_pending_updates: bool = False):
     """Delete webhook to enable long polling"""
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
+        await bot.delete_webhook(drop_pending_updates=drop_pending_updates)
         logger.info("✅ Webhook deleted successfully")
         return True
     except Exception as e:
@@ -49,25 +59,28 @@ async def on_startup(bot: Bot):
     logger.info("🚀 Bot is starting up...")
     
     try:
-        # Delete webhook first
-        webhook_deleted = await delete_webhook(bot)
-        if not webhook_deleted:
-            logger.warning("⚠️ Webhook deletion failed, but continuing...")
+        config = get_config()
+        
+        # Polling needs the webhook removed, webhook mode sets it when the server starts
+        if config.bot_mode == "polling":
+            webhook_deleted = await delete_webhook(bot, config.drop_pending_updates)
+            if not webhook_deleted:
+                logger.warning("⚠️ Webhook deletion failed, but continuing...")
+            
+            # Catch up on updates sent while the bot was down before regular polling
+            if not config.drop_pending_updates and dispatcher_instance:
+                try:
+                    await drain_pending_updates(bot, dispatcher_instance,
+                                                config.backlog_max_age, config.backlog_concurrency)
+                except Exception as e:
+                    logger.error(f"❌ Failed to drain startup backlog, polling will pick it up: {e}")
         
         # Check Fragment API configuration
-        config = Config()
         if config.token_fragment and config.token_fragment.strip():
             logger.info(f"Fragment API: Real API configured with token (length: {len(config.token_fragment)})")
         else:
             logger.warning("Fragment API: No token configured, will use demo mode")
         
-        # Check database connection
-        try:
-            await create_tables()
-            logger.info("✅ Database tables created/verified")
-        except Exception as e:
-            logger.error(f"Database connection failed: {e}")
-        
         logger.info("✅ Bot startup completed")
         
     except Exception as e:
@@ -95,6 +108,19 @@ async def on_shutdown(bot: Bot):
         logger.error(f"Error during shutdown: {e}")
 
 
+def reload_signal_handler():
+    """Reload configuration on SIGHUP without restarting.
+    
+    Runs as an event loop callback, not inside a raw signal handler, so a second SIGHUP
+    during a reload waits instead of re-entering the config lock.
+    """
+    try:
+        reload_config()
+        logger.info("🔄 Configuration reloaded (SIGHUP)")
+    except Exception as e:
+        logger.error(f"❌ Failed to reload configuration, keeping previous one: {e}")
+
+
 def signal_handler(signum, frame):
     """Handle system signals for graceful shutdown"""
     signal_name = "SIGINT" if signum == signal.SIGINT else "SIGTERM"
@@ -113,7 +139,10 @@ async def graceful_shutdown():
     
     try:
         if dispatcher_instance:
-            await dispatcher_instance.stop_polling()
+            if get_config().bot_mode == "webhook":
+                await stop_telegram_webhook()
+            else:
+                await dispatcher_instance.stop_polling()
             logger.info("✅ Dispatcher stopped")
         
         if bot_instance:
@@ -134,12 +163,12 @@ async def main():
     
     try:
         # Load configuration
-        config = Config()
+        config = get_config()
         logger.info("✅ Configuration loaded successfully")
         
         # Initialize bot and dispatcher
         bot = Bot(token=config.bot_token)
-        storage = MemoryStorage()
+        storage = create_fsm_storage(config)
         dp = Dispatcher(storage=storage)
         
         # Store global references
@@ -156,27 +185,56 @@ async def main():
         register_handlers(dp)
         logger.info("✅ Handlers registered")
         
-        # Create database tables
-        await create_tables()
-        logger.info("✅ Database tables created/verified")
+        # Split database connections between shard pools and the main pool
+        get_db_manager(config.database_url).configure_pools(
+            config.db_pool_size, config.update_shards, config.db_shard_pool_size)
+        
+        # Apply pending schema migrations, a single version check when up to date
+        schema_version = await run_migrations(config.database_url)
+        logger.info(f"✅ Database schema version {schema_version}")
+        
+        # Load prices into memory before handlers and Fragment orders need them
+        await start_pricing()
+        logger.info("✅ Prices loaded")
+        
+        # Start outbound message queue before anything that sends notifications
+        await start_send_queue(bot, config)
+        logger.info("✅ Send queue started")
+        
+        # Start order fulfillment workers, they pick up orders queued before restart
+        await start_fulfillment()
+        logger.info("✅ Order fulfillment started")
         
         # Start background tasks
         await start_background_tasks(bot)
         logger.info("✅ Background tasks started")
         
+        # Resume unfinished broadcast campaigns
+        await start_broadcasts(bot)
+        logger.info("✅ Broadcast manager started")
+        
+        # Start per-user update shards (optional), before any update is received
+        await start_update_shards(dp, config)
+        
+        # Start Crypto Pay webhook receiver (optional)
+        await start_crypto_pay_webhook(config)
+        
         # Setup signal handlers
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_signal_handler)
         logger.info("✅ Signal handlers configured")
         
-        # Start polling with startup/shutdown handlers
-        logger.info("🚀 Starting bot polling...")
+        dp.startup.register(on_startup)
+        dp.shutdown.register(on_shutdown)
         
-        await dp.start_polling(
-            bot,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown
-        )
+        if config.bot_mode == "webhook":
+            logger.info("🚀 Starting bot webhook...")
+            await run_telegram_webhook(bot, dp, config)
+        else:
+            logger.info("🚀 Starting bot polling...")
+            await dp.start_polling(bot)
         
     except Exception as e:
         logger.error(f"Critical error during bot operation: {e}")
@@ -185,12 +243,39 @@ async def main():
     finally:
         # Cleanup
         try:
+            await stop_crypto_pay_webhook()
+            
+            # Finish updates already queued on shards
+            await stop_update_shards()
+            
+            await stop_background_tasks()
+            logger.info("✅ Background tasks stopped")
+            
+            await stop_broadcasts()
+            logger.info("✅ Broadcast manager stopped")
+            
+            await stop_fulfillment()
+            logger.info("✅ Order fulfillment stopped")
+            
+            await stop_pricing()
+            
+            # Flush queued notifications while the bot session is still open
+            await stop_send_queue()
+            logger.info("✅ Send queue stopped")
+            
             if bot_instance:
                 await bot_instance.session.close()
                 logger.info("✅ Bot session closed in finally block")
             
-            await stop_background_tasks()
-            logger.info("✅ Background tasks stopped")
+            if dispatcher_instance:
+                await dispatcher_instance.storage.close()
+                logger.info("✅ FSM storage closed")
+            
+            await close_fragment_api()
+            logger.info("✅ Fragment API session closed")
+            
+            await close_crypto_pay_api()
+            logger.info("✅ Crypto Pay API session closed")
             
         except Exception as e:
             logger.error(f"❌ Error during cleanup: {e}")
@@ -64,6 +64,8 @@ async def test_fragment_api():
             print("❌ Connection failed")
     except Exception as e:
         print(f"❌ Error: {e}")
+    finally:
+        await api.close()
     
     print("\n🔍 Authentication test completed")
 
@@ -0,0 +1,182 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from bot.fsm_storage import PostgresStorage, build_key, create_fsm_storage
+
+KEY = StorageKey(bot_id=42, chat_id=100, user_id=200)
+
+
+class CheckoutStates(StatesGroup):
+    waiting_for_username = State()
+
+
+def make_config(**overrides):
+    config = dict(fsm_storage="memory", fsm_state_ttl=3600, redis_url="redis://localhost:6379/0",
+                  database_url="postgresql://localhost/test")
+    config.update(overrides)
+    return SimpleNamespace(**config)
+
+
+class FakeConnection:
+    """In-memory stand-in for the fsm_storage table, understands the storage's queries"""
+    
+    def __init__(self):
+        self.rows = {}  # key -> (value, expires_at)
+        self.queries = []
+    
+    async def fetchval(self, query, key):
+        self.queries.append(query)
+        value, expires_at = self.rows.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return value
+    
+    async def execute(self, query, *args):
+        self.queries.append(query)
+        if "INSERT INTO fsm_storage" in query:
+            key, value, ttl = args
+            self.rows[key] = (value, time.time() + ttl if ttl else None)
+        elif "WHERE key = $1" in query:
+            self.rows.pop(args[0], None)
+        elif "WHERE expires_at <= NOW()" in query:
+            now = time.time()
+            self.rows = {key: row for key, row in self.rows.items() if row[1] is None or row[1] > now}
+        return "OK"
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakePool:
+    def __init__(self):
+        self.conn = FakeConnection()
+    
+    def acquire(self):
+        return self.conn
+
+
+def make_postgres_storage(state_ttl=3600, purge_interval=300):
+    storage = PostgresStorage("postgresql://localhost/test", state_ttl=state_ttl, purge_interval=purge_interval)
+    pool = FakePool()
+    
+    async def get_pool():
+        return pool
+    
+    storage._get_pool = get_pool
+    return storage, pool.conn
+
+
+def test_build_key_matches_redis_key_builder():
+    redis_storage = pytest.importorskip("aiogram.fsm.storage.redis")
+    key_builder = redis_storage.DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+    assert build_key(KEY, "state") == key_builder.build(KEY, "state")
+    assert build_key(KEY, "data") == key_builder.build(KEY, "data")
+
+
+def test_create_fsm_storage_defaults_to_memory():
+    assert isinstance(create_fsm_storage(make_config()), MemoryStorage)
+
+
+def test_postgres_round_trip():
+    async def run():
+        storage, conn = make_postgres_storage()
+        
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        
+        await storage.set_state(KEY, CheckoutStates.waiting_for_username)
+        await storage.set_data(KEY, {"fragment_months": 3})
+        assert await storage.update_data(KEY, {"fragment_username": "someone"}) == {
+            "fragment_months": 3, "fragment_username": "someone"}
+        
+        assert await storage.get_state(KEY) == CheckoutStates.waiting_for_username.state
+        assert await storage.get_data(KEY) == {"fragment_months": 3, "fragment_username": "someone"}
+        
+        # Clearing deletes the rows instead of storing empty values
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert conn.rows == {}
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        
+        await storage.close()
+    
+    asyncio.run(run())
+
+
+def test_postgres_expired_rows_are_ignored_and_purged():
+    async def run():
+        storage, conn = make_postgres_storage(state_ttl=60, purge_interval=0)
+        await storage.set_state(KEY, "CheckoutStates:waiting_for_username")
+        await storage.set_data(KEY, {"fragment_stars_count": 50})
+        
+        # Age both rows past their TTL
+        for key, (value, _) in list(conn.rows.items()):
+            conn.rows[key] = (value, time.time() - 1)
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        
+        # The next write purges them
+        other_key = StorageKey(bot_id=42, chat_id=101, user_id=201)
+        await storage.set_state(other_key, "CheckoutStates:waiting_for_username")
+        assert set(conn.rows) == {build_key(other_key, "state")}
+    
+    asyncio.run(run())
+
+
+def test_postgres_without_ttl_never_expires():
+    async def run():
+        storage, conn = make_postgres_storage(state_ttl=None)
+        await storage.set_state(KEY, "CheckoutStates:waiting_for_username")
+        assert conn.rows[build_key(KEY, "state")][1] is None
+        assert not any("expires_at <= NOW()" in query for query in conn.queries)
+    
+    asyncio.run(run())
+
+
+def test_redis_storage_wiring_and_round_trip():
+    pytest.importorskip("redis")
+    fakeredis = pytest.importorskip("fakeredis")
+    from aiogram.fsm.storage.redis import RedisStorage
+    
+    async def run():
+        storage = create_fsm_storage(make_config(fsm_storage="redis", fsm_state_ttl=120))
+        assert isinstance(storage, RedisStorage)
+        assert storage.state_ttl == 120
+        assert storage.data_ttl == 120
+        
+        await storage.redis.aclose(close_connection_pool=True)
+        storage.redis = fakeredis.aioredis.FakeRedis()
+        
+        await storage.set_state(KEY, CheckoutStates.waiting_for_username)
+        await storage.set_data(KEY, {"fragment_months": 12})
+        assert await storage.get_state(KEY) == CheckoutStates.waiting_for_username.state
+        assert await storage.get_data(KEY) == {"fragment_months": 12}
+        assert 0 < await storage.redis.ttl(build_key(KEY, "state")) <= 120
+        assert 0 < await storage.redis.ttl(build_key(KEY, "data")) <= 120
+        
+        await storage.set_state(KEY, None)
+        await storage.set_data(KEY, {})
+        assert await storage.get_state(KEY) is None
+        assert await storage.get_data(KEY) == {}
+        
+        await storage.close()
+    
+    asyncio.run(run())
+
+
+def test_redis_storage_without_ttl():
+    pytest.importorskip("redis")
+    
+    storage = create_fsm_storage(make_config(fsm_storage="redis", fsm_state_ttl=0))
+    assert storage.state_ttl is None
+    assert storage.data_ttl is None